@@ -3,13 +3,17 @@ import pandas as pd
 import json
 import tempfile
 import os
-import queue
-import threading
+import time
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode
 from parallel_processing.prompts import v1_system_message, v1_prompt_message
 from parallel_processing.generate_requests import generate_chat_completion_requests
-from parallel_processing.main import main as parallel_processing_main
-from parallel_processing.main import process_data
+from parallel_processing.job_manager import (
+    JobStore,
+    finished_statuses,
+    job_fraction_done,
+    job_progress_seconds,
+    start_worker,
+)
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
@@ -19,9 +23,6 @@ load_dotenv()
 # Initialize logger for error tracking
 logging.basicConfig(filename='app_errors.log', level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize a Queue to manage the batch runs
-batch_run_queue = queue.Queue()
-
 # Initialize session state variables for UI elements and data selections
 if 'manual_load_clicked' not in st.session_state:
     st.session_state['manual_load_clicked'] = False
@@ -37,38 +38,21 @@ if 'auto_selection' not in st.session_state:
     st.session_state['auto_selection'] = False
 if 'selected_rows' not in st.session_state:
     st.session_state.selected_rows = []
-if 'batch_status' not in st.session_state:
-    st.session_state['batch_status'] = 'Not started'
-if 'progress_bar' not in st.session_state:
-    st.session_state['progress_bar'] = None
-if 'log_messages' not in st.session_state:
-    st.session_state['log_messages'] = []
 if 'selected_mcqs_list' not in st.session_state:
     st.session_state['selected_mcqs_list'] = []
-if 'batch_run_is_complete' not in st.session_state:
-    st.session_state['batch_run_is_complete'] = False
+if 'job_id' not in st.session_state:
+    # batch runs are jobs in the job manager, so a reconnecting browser finds its run again from the URL
+    job_id = st.query_params.get('job')
+    st.session_state['job_id'] = int(job_id) if job_id else None
 if 'formatted_system_message' not in st.session_state:
     st.session_state['formatted_system_message'] = ""
 if 'formatted_prompt' not in st.session_state:
     st.session_state['formatted_prompt'] = ""
-     
-# Other random initializations
-data_file_path = ""
-requests_file_path = ""
-results_file_path = ""
-output_file_path = ""
 
 # Function to update the session state with selected rows
 def update_selected_rows(selected_rows_data):
     st.session_state.selected_rows = selected_rows_data
 
-def run_in_thread(fn, *args, **kwargs):
-    """Run a function in a separate thread while maintaining Streamlit context."""
-    def wrapped_fn():
-        with st.script_run_ctx():
-            fn(*args, **kwargs)
-    threading.Thread(target=wrapped_fn).start()
-
 # Function to normalize the dataframe structure
 def normalize_df(df, vignette_type):
     column_name = None
@@ -87,83 +71,66 @@ def normalize_df(df, vignette_type):
 
     return df
 
-        
-def process_batch_runs(batch_run_data):
-    # Define the file paths within the function scope
-    data_file_path = None
-    requests_file_path = None
-    results_file_path = None
-    output_file_path = None
-    while True:
-        batch_run = batch_run_queue.get()
-        if batch_run is None:
-            # Signal the end of the queue and break the loop
-            st.session_state['batch_run_is_complete'] = True  # Update the state here
-            break
-        
-        try:
-            # Now we're sure batch_run is not None, we can unpack it
-            # ATTENTION ****!!!!""""Streamlit Documentation Expert Chatbot""""!!!!**** I NEED THIS PORTION OF CODE TO BE CHECKED AND CHANGED AS WE ARE CHANGING THE STRUCTURE OF HOW WE ARE 'CUSTOMIZING' PROMPTS IF USER SELECTS TO CUSTOMIZE VIGNETTES
-            selected_mcqs_list, formatted_system_message, formatted_prompt = batch_run
-            
-            # Initialize progress
-            total_tasks = len(selected_mcqs_list)
-            completed_tasks = 0
-                
-            for task in selected_mcqs_list:
-                # Simulate task processing (e.g., calling an API, processing data)
-                # ...
-                # Update task progress
-                completed_tasks += 1
-                progress = int((completed_tasks / total_tasks) * 100)
-                st.session_state['progress'] = progress
-                st.session_state['progress_bar'].progress(progress)
-                
-                # Update log messages periodically or upon certain events
-                log_message = f"Completed task {completed_tasks} of {total_tasks}"
-                st.session_state['log_messages'].append(log_message)
-                st.session_state['log_output'].text('\n'.join(st.session_state['log_messages']))
-            
-                # Update completion message and status
-                completion_message = f"Batch run completed. Results saved."
-                st.session_state['log_messages'].append(completion_message)
-                st.session_state['log_output'].text('\n'.join(st.session_state['log_messages']))
-                st.session_state['batch_status'] = 'Completed'
-                pass
-        
-        except Exception as e:
-            error_message = f"Error occurred: {e}"
-            st.session_state['log_messages'].append(error_message)
-            st.session_state['log_output'].text('\n'.join(st.session_state['log_messages']))
-            logging.error(error_message)
-            st.session_state['batch_status'] = 'Failed'
-
-        finally:
-            batch_run_queue.task_done()
-
-    # Indicate the batch run is complete
-    if st.session_state['batch_run_is_complete']:
-        st.session_state['batch_status'] = 'Completed'
-        selected_mcqs_list, formatted_system_message, formatted_prompt = batch_run
-
-        # Call the refactored parallel processing script
-        parallel_processing_main.main(
-            data=selected_mcqs_list,
-            prompt=formatted_system_message + formatted_prompt,
-            model_name=os.getenv('MODEL_NAME'),
-            data_file_path=data_file_path,
-            requests_file_path=requests_file_path,
-            results_file_path=results_file_path,
-            output_file_path=output_file_path
+
+def submit_batch_run(selected_mcqs_list, formatted_prompt):
+    """Queue the batch run with the job manager, which runs it in its own process."""
+    with JobStore() as job_store:
+        job_id = job_store.submit(selected_mcqs_list, formatted_prompt, model_name=os.getenv('MODEL_NAME'))
+    start_worker()  # unless one is already running
+    st.session_state['job_id'] = job_id
+    st.query_params['job'] = str(job_id)
+    return job_id
+
+def job_log_lines(job):
+    # Summarize the job's latest StatusTracker snapshot for the log output
+    progress = job['progress'] or {}
+    lines = [f"Job {job['id']}: {job['status']}"]
+    if progress:
+        lines.append(f"Completed {progress['num_tasks_succeeded']} of {job['num_requests']} requests")
+        if progress['num_tasks_failed']:
+            lines.append(f"Failed {progress['num_tasks_failed']} requests after all attempts")
+        if progress['num_rate_limit_errors']:
+            lines.append(f"Rate limit errors: {progress['num_rate_limit_errors']}")
+    if job['cancel_requested'] and job['status'] == 'running':
+        lines.append("Cancelling...")
+    if job['error']:
+        lines.append(f"Error occurred: {job['error'].strip().splitlines()[-1]}")
+    return lines
+
+def show_batch_run(job_id):
+    with JobStore() as job_store:
+        job = job_store.get(job_id)
+    if job is None:
+        st.error(f"Batch run {job_id} not found.")
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("**📊 Batch Progress:**")
+        st.progress(job_fraction_done(job))
+        if job['status'] not in finished_statuses and st.button('Cancel batch run'):
+            with JobStore() as job_store:
+                job_store.cancel(job_id)
+            st.rerun()
+    with col2:
+        st.write("**📜 Log Output:**")
+        st.text('\n'.join(job_log_lines(job)))
+
+    if job['status'] in ('completed', 'cancelled') and os.path.exists(job['output_filepath']):
+        with open(job['output_filepath'], "rb") as file:
+            st.download_button(
+                label="💻 Download Results as CSV",
+                data=file,
+                file_name=f"batch_results_{job_id}.csv",
+                mime="text/csv",
             )
-        pass
+    elif job['status'] == 'failed':
+        logging.error(f"Batch run {job_id} failed: {job['error']}")
 
-def update_ui():
-    # Update the Streamlit UI based on the progress
-    # You will need to define the logic of this function based on your requirements
-    # For example:
-    st.session_state['progress_bar'].progress(st.session_state['progress'])
-    st.session_state['log_output'].text('\n'.join(st.session_state['log_messages']))
+    if job['status'] not in finished_statuses:
+        # the job runs in the worker either way; this only refreshes what this page shows
+        time.sleep(job_progress_seconds)
+        st.rerun()
 
 # This function should update the state when manual questions are loaded
 def manual_load():
@@ -345,57 +312,21 @@ def main():
         st.session_state['formatted_system_message'] = v1_system_message,
         st.session_state['formatted_prompt'] = v1_prompt_message
 
-        if 'batch_initiated' not in st.session_state:
-            st.session_state['batch_initiated'] = False
-
-        if 'batch_status' not in st.session_state:
-            st.session_state['batch_status'] = 'Not started'
-
-        if 'log_messages' not in st.session_state:
-            st.session_state['log_messages'] = []
-            
         # Check if 'Initiate batch run' button was pressed and if 'selected_mcqs_list' is not empty
         if st.button('Initiate batch run'):
-            st.session_state['batch_initiated'] = True
-            st.session_state['progress'] = 0
-
         # Check if 'selected_mcqs_list' is defined and not empty
             if 'selected_mcqs_list' in st.session_state and st.session_state['selected_mcqs_list']:
-                # Add the batch run data to the queue
-                batch_run_data = (
-                    st.session_state['selected_mcqs_list'], 
-                    st.session_state['formatted_system_message'], 
-                    st.session_state['formatted_prompt']
-                )                    
-                batch_run_queue.put(batch_run_data)
-
-                # Start threads to process batch runs and update the UI
-                run_in_thread(process_batch_runs, batch_run_data)
-
-                st.write("**🤓 Batch run initiated!**")
+                # The system message is added to each request by generate_requests
+                job_id = submit_batch_run(
+                    st.session_state['selected_mcqs_list'],
+                    st.session_state['formatted_prompt'],
+                )
+                st.session_state['batch_initiated'] = True
+                st.write(f"**🤓 Batch run {job_id} initiated!**")
             else:
                 st.error("No MCQs selected. Please select MCQs before initiating the batch run.")
 
-    if st.session_state['batch_initiated']:
-        # Display progress and logs
-        col1, col2 = st.columns(2)
-
-        with col1:
-            st.write("**📊 Batch Progress:**")
-            st.session_state['progress_bar'] = st.progress(st.session_state['progress'])
-
-        with col2:
-            st.write("**📜 Log Output:**")
-            st.session_state['log_output'] = st.empty()
-            st.session_state['log_output'].text('\n'.join(st.session_state['log_messages']))
-
-        if st.session_state['batch_status'] == 'Completed':
-            with open(output_file_path, "rb") as file:
-                st.download_button(
-                    label="💻 Download Results as CSV",
-                    data=file,
-                    file_name="batch_results.csv",
-                    mime="text/csv",
-                )
+    if st.session_state['job_id'] is not None:
+        show_batch_run(st.session_state['job_id'])
 if __name__ == "__main__":
     main()
\ No newline at end of file
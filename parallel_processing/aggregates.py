@@ -0,0 +1,311 @@
+# aggregates.py
+# Summary statistics of a run that are kept up to date as results are written, so reading them never means
+# re-reading the results file. Each batch the ResultsWriter writes is scored (see scoring.py) and folded into
+# running counts, accuracy, token totals and latency per model and per specialty, demographic value or
+# overall, using Welford's online algorithm for the means and variances. The totals are saved to a small
+# SQLite file after every batch, so they can be read while the run is still going, e.g.:
+#   AGGREGATES_PATH=outputs/aggregates.sqlite python -m parallel_processing.api_request_parallel_processor
+#   read_aggregates("outputs/aggregates.sqlite", dimension="specialty")
+# or from the command line, also to build them from an existing results file:
+#   python -m parallel_processing.aggregates outputs/aggregates.sqlite --from-results outputs/results.jsonl
+import argparse  # for reading options from the command line
+import dataclasses  # for the running statistics
+import logging  # for logging missing gold answers and results that can't be aggregated
+import math  # for standard deviations
+import os  # for replacing aggregates rebuilt from results
+import sqlite3  # for the on-disk aggregates
+import pandas as pd  # for scoring a batch at once
+from parallel_processing.results_store import iter_results
+from parallel_processing.save_generated_data_to_csv import result_to_row
+from parallel_processing.scoring import load_gold_answers, score_frame
+
+overall = ("all", "")  # dimension and value of the totals over all of a model's results
+stats_columns = ("prompt_tokens", "completion_tokens", "latency_seconds")
+
+
+@dataclasses.dataclass
+class RunningStats:
+    """Count, mean, variance, min and max of a stream of values, updated one value at a time."""
+
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0  # sum of squared differences from the mean
+    min: float = None
+    max: float = None
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "RunningStats") -> None:
+        """Add the values summarized by another RunningStats, e.g. from another process."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def total(self) -> float:
+        return self.mean * self.count
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance) if self.count > 1 else None
+
+
+@dataclasses.dataclass
+class Aggregate:
+    """Totals for one model and one specialty, demographic value or all results."""
+
+    num_results: int = 0
+    num_failed: int = 0  # requests that ran out of attempts
+    num_graded: int = 0  # results for questions with a gold answer
+    num_correct: int = 0
+    prompt_tokens: RunningStats = dataclasses.field(default_factory=RunningStats)
+    completion_tokens: RunningStats = dataclasses.field(default_factory=RunningStats)
+    latency_seconds: RunningStats = dataclasses.field(default_factory=RunningStats)
+
+    def merge(self, other: "Aggregate") -> None:
+        self.num_results += other.num_results
+        self.num_failed += other.num_failed
+        self.num_graded += other.num_graded
+        self.num_correct += other.num_correct
+        for name in stats_columns:
+            getattr(self, name).merge(getattr(other, name))
+
+    @property
+    def accuracy(self):
+        return self.num_correct / self.num_graded if self.num_graded else None
+
+
+def create_table(connection: sqlite3.Connection) -> None:
+    stats_fields = ", ".join(
+        f"{name}_{part} {kind}"
+        for name in stats_columns
+        for part, kind in (("count", "INTEGER"), ("mean", "REAL"), ("m2", "REAL"), ("min", "REAL"), ("max", "REAL"))
+    )
+    connection.execute(
+        f"""CREATE TABLE IF NOT EXISTS aggregates (
+            model TEXT NOT NULL,
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            num_results INTEGER NOT NULL,
+            num_failed INTEGER NOT NULL,
+            num_graded INTEGER NOT NULL,
+            num_correct INTEGER NOT NULL,
+            {stats_fields},
+            PRIMARY KEY (model, dimension, value)
+        )"""
+    )
+
+
+def aggregate_to_row(key: tuple, aggregate: Aggregate) -> tuple:
+    row = list(key) + [
+        aggregate.num_results,
+        aggregate.num_failed,
+        aggregate.num_graded,
+        aggregate.num_correct,
+    ]
+    for name in stats_columns:
+        stats = getattr(aggregate, name)
+        row += [stats.count, stats.mean, stats.m2, stats.min, stats.max]
+    return tuple(row)
+
+
+def aggregate_from_row(row: tuple) -> tuple:
+    """(key, Aggregate) from a row of the aggregates table."""
+    aggregate = Aggregate(*row[3:7])
+    for i, name in enumerate(stats_columns):
+        setattr(aggregate, name, RunningStats(*row[7 + 5 * i : 12 + 5 * i]))
+    return tuple(row[:3]), aggregate
+
+
+def load_aggregates(filename: str) -> dict:
+    """Every (model, dimension, value) key's Aggregate in an aggregates file."""
+    connection = sqlite3.connect(filename)
+    try:
+        create_table(connection)
+        return dict(aggregate_from_row(row) for row in connection.execute("SELECT * FROM aggregates"))
+    finally:
+        connection.close()
+
+
+def read_aggregates(filename: str, model: str = None, dimension: str = None) -> pd.DataFrame:
+    """Summaries from an aggregates file, one row per model and dimension value.
+
+    The file is as small as the number of groups, however many results there are, and can be read
+    while a run is writing it."""
+    rows = []
+    for (row_model, row_dimension, value), aggregate in load_aggregates(filename).items():
+        if (model is not None and row_model != model) or (
+            dimension is not None and row_dimension != dimension
+        ):
+            continue
+        row = {
+            "model": row_model,
+            "dimension": row_dimension,
+            "value": value,
+            "num_results": aggregate.num_results,
+            "num_failed": aggregate.num_failed,
+            "num_graded": aggregate.num_graded,
+            "accuracy": aggregate.accuracy,
+        }
+        for name in stats_columns:
+            stats = getattr(aggregate, name)
+            row[f"{name}_total"] = stats.total
+            row[f"{name}_mean"] = stats.mean if stats.count else None
+            row[f"{name}_std"] = stats.std
+        rows.append(row)
+    if not rows:
+        return pd.DataFrame(columns=["model", "dimension", "value"])
+    return pd.DataFrame(rows).sort_values(["model", "dimension", "value"]).reset_index(drop=True)
+
+
+class ResultsAggregates:
+    """Keeps an aggregates file up to date with the results a ResultsWriter writes.
+
+    Pass it as one of the writer's `observers`. Each result counts towards its model's totals overall,
+    for its question's specialty and for each of its demographic values; latency comes from the
+    `latency_seconds` the processor passes to the writer with each response. Aggregates already in the
+    file are added to, so a resumed run keeps counting; failed results are counted as they are written,
+    just as they are appended to the results file. A result that can't be aggregated is logged and left
+    out rather than stopping the writer."""
+
+    def __init__(self, filename: str, gold: pd.DataFrame = None, data_dir: str = "data"):
+        self.filename = filename
+        if gold is None:
+            try:
+                gold = load_gold_answers(data_dir)
+            except FileNotFoundError as e:
+                logging.warning(f"Not grading results for aggregates: {e}")
+                gold = pd.DataFrame(columns=["correct_answer", "specialty"])
+        self.gold = gold
+        # the writer calls in from its worker thread, one batch at a time
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        create_table(self.connection)
+        self.aggregates = dict(
+            aggregate_from_row(row) for row in self.connection.execute("SELECT * FROM aggregates")
+        )
+
+    def __call__(self, batch: list) -> None:
+        """Fold a batch of (result, stats) pairs into the aggregates and save the ones that changed."""
+        try:
+            self.add_batch(batch)
+        except Exception as e:
+            logging.error(f"Failed to aggregate {len(batch)} results in {self.filename}: {e}")
+
+    def add_batch(self, batch: list) -> None:
+        rows, row_stats = [], []
+        for data, stats in batch:
+            try:
+                rows.append(result_to_row(data))
+                row_stats.append(stats)
+            except Exception as e:
+                logging.error(f"Not aggregating result {str(data)[:200]}: {e}")
+        if not rows:
+            return
+        scored = score_frame(pd.DataFrame(rows), self.gold)
+        slot_columns = [name for name in scored.columns if name.startswith("demographic_")]
+        changed = set()
+        for row, stats in zip(scored.to_dict("records"), row_stats):
+            try:
+                changed.update(self.add(row, stats, slot_columns))
+            except Exception as e:
+                logging.error(f"Not aggregating result for qid {row.get('qid')}: {e}")
+        self.save(changed)
+
+    def add(self, row: dict, stats: dict, slot_columns: list) -> list:
+        """Count one scored row towards each of its keys and return them."""
+        keys = [overall]
+        if not pd.isna(row["specialty"]):
+            keys.append(("specialty", row["specialty"]))
+        keys += [
+            (name[len("demographic_") :], str(row[name]))
+            for name in slot_columns
+            if not pd.isna(row[name]) and row[name] != ""
+        ]
+        keys = [(row["model"] or "", dimension, value) for dimension, value in keys]
+        latency_seconds = (stats or {}).get("latency_seconds")
+        for key in keys:
+            aggregate = self.aggregates.setdefault(key, Aggregate())
+            aggregate.num_results += 1
+            if not pd.isna(row["error"]):
+                aggregate.num_failed += 1
+            else:
+                for name in ("prompt_tokens", "completion_tokens"):
+                    if not pd.isna(row[name]):  # a response may leave out its usage
+                        getattr(aggregate, name).add(row[name])
+            if not pd.isna(row["correct"]):
+                aggregate.num_graded += 1
+                aggregate.num_correct += bool(row["correct"])
+            if latency_seconds is not None:
+                aggregate.latency_seconds.add(latency_seconds)
+        return keys
+
+    def save(self, keys) -> None:
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO aggregates VALUES ({', '.join('?' * (7 + 5 * len(stats_columns)))})",
+                [aggregate_to_row(key, self.aggregates[key]) for key in keys],
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def merge_aggregates(filenames: list, filename: str) -> None:
+    """Add up the aggregates in several files, e.g. from the processes of a multi-process run, into one."""
+    with ResultsAggregates(filename, gold=pd.DataFrame()) as aggregates:
+        for other in filenames:
+            for key, aggregate in load_aggregates(other).items():
+                aggregates.aggregates.setdefault(key, Aggregate()).merge(aggregate)
+        aggregates.save(aggregates.aggregates.keys())
+
+
+def aggregate_results(results_path: str, filename: str, data_dir: str = "data", batch_size: int = 1000) -> None:
+    """Build an aggregates file from an existing results file or normalized store, without latencies."""
+    if os.path.exists(filename):
+        os.remove(filename)
+    with ResultsAggregates(filename, data_dir=data_dir) as aggregates:
+        batch = []
+        for result in iter_results(results_path):
+            batch.append((result, None))
+            if len(batch) == batch_size:
+                aggregates(batch)
+                batch = []
+        if batch:
+            aggregates(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the aggregates of a run.")
+    parser.add_argument("aggregates_path")
+    parser.add_argument("--from-results", help="first rebuild the aggregates from this results file")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--model")
+    parser.add_argument("--dimension", help='"all", "specialty" or a demographic slot')
+    args = parser.parse_args()
+
+    if args.from_results:
+        aggregate_results(args.from_results, args.aggregates_path, data_dir=args.data_dir)
+    print(read_aggregates(args.aggregates_path, model=args.model, dimension=args.dimension).to_string())
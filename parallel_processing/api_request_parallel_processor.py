@@ -1,9 +1,16 @@
 # api_request_parallel_processor.py
 import aiohttp  # for making API calls concurrently
 import asyncio  # for running API calls concurrently
+import collections  # for keeping a window of observed completion lengths
+import contextlib  # for optional context managers
+import email.utils  # for parsing retry-after dates
+import functools  # for caching the encoder and token counts
+import io  # for telling a requests file from other iterables of requests
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
+import math  # for rounding learned completion budgets
 import os  # for reading API key
+import random  # for jittering retry backoff
 import re  # for matching endpoint from request URL
 import tiktoken  # for counting tokens
 import time  # for sleeping after rate limit is hit
@@ -12,25 +19,77 @@ from dataclasses import (
     field,
 )  # for storing API inputs, outputs, and metadata
 from dotenv import load_dotenv
+from parallel_processing.aggregates import ResultsAggregates
+from parallel_processing.compression import open_text
+from parallel_processing.request_store import (
+    MappedRequestsFile,
+    decode_request,
+    encode_request,
+    open_requests,
+)
+from parallel_processing.response_cache import (
+    ResponseCache,
+    is_deterministic_request,
+)
+from parallel_processing.results_store import (
+    NormalizedResultsWriter,
+    iter_results,
+    is_normalized_store,
+    request_key,
+    results_filename,
+    results_formats,
+    store_filepath,
+    truncate_partial_last_line,
+)
+from parallel_processing.results_writer import ResultsWriter
+from parallel_processing.telemetry import (
+    Histogram,
+    MetricsExporter,
+    attempts_buckets,
+    tokens_buckets,
+)
+from parallel_processing.token_counts import load_or_count_tokens
 
 load_dotenv()
 
 # Fetching configuration from environment variables
 request_url = os.getenv("API_REQUEST_URL", "https://api.openai.com/v1/chat/completions")
 api_key = os.getenv("OPENAI_API_KEY")
+endpoints_filepath = os.getenv("API_ENDPOINTS_FILE_PATH") or None
 max_requests_per_minute = float(os.getenv("MAX_REQUESTS_PER_MINUTE", "500"))
 max_tokens_per_minute = float(os.getenv("MAX_TOKENS_PER_MINUTE", "60000"))
 token_encoding_name = os.getenv("TOKEN_ENCODING_NAME", "cl100k_base")
 max_attempts = int(os.getenv("MAX_ATTEMPTS", "5"))
 logging_level = int(os.getenv("LOGGING_LEVEL", "20"))
+learn_completion_budgets = os.getenv("LEARN_COMPLETION_BUDGETS", "false").lower() in ("1", "true", "yes")
+completion_budget_percentile = float(os.getenv("COMPLETION_BUDGET_PERCENTILE", "0.95"))
 requests_filepath = os.getenv("REQUESTS_FILE_PATH", "requests_to_chat_completion.jsonl")
 save_filepath = os.getenv("RESULTS_FILE_PATH", "results_of_chat_completion.jsonl")
+results_flush_lines = int(os.getenv("RESULTS_FLUSH_LINES", "100"))
+results_flush_seconds = float(os.getenv("RESULTS_FLUSH_SECONDS", "1"))
+results_fsync_policy = os.getenv("RESULTS_FSYNC_POLICY", "close")
+results_format = os.getenv("RESULTS_FORMAT", "jsonl")
+response_cache_filepath = os.getenv("RESPONSE_CACHE_PATH") or None
+response_cache_max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "0")) or None
+response_cache_max_age_seconds = float(os.getenv("RESPONSE_CACHE_MAX_AGE_SECONDS", "0")) or None
+bypass_response_cache = os.getenv("BYPASS_RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")
+resume = os.getenv("RESUME", "false").lower() in ("1", "true", "yes")
+max_requests_in_flight = int(os.getenv("MAX_REQUESTS_IN_FLIGHT", "100"))
+request_timeout_seconds = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "300"))
+connect_timeout_seconds = float(os.getenv("CONNECT_TIMEOUT_SECONDS", "10"))
+hedge_requests = os.getenv("HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+hedge_percentile = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+metrics_snapshot_filepath = os.getenv("METRICS_SNAPSHOT_PATH") or None
+precount_tokens = os.getenv("PRECOUNT_TOKENS", "false").lower() in ("1", "true", "yes")
+metrics_snapshot_seconds = float(os.getenv("METRICS_SNAPSHOT_SECONDS", "10"))
+metrics_port = int(os.getenv("METRICS_PORT", "0")) or None
+metrics_host = os.getenv("METRICS_HOST") or "127.0.0.1"
+model_rate_limits = json.loads(os.getenv("MODEL_RATE_LIMITS") or "null")
+aggregates_filepath = os.getenv("AGGREGATES_PATH") or None
 
 # Constants
-seconds_to_pause_after_rate_limit_error = 15
-seconds_to_sleep_each_loop = (
-    0.001  # 1 ms limits max throughput to 1,000 requests per second
-)
+seconds_to_backoff_base = 1  # first retry waits up to this long, doubling with each error
+seconds_to_backoff_max = 60  # cap on the exponential backoff between retries
 
 # Initialize logging
 logging.basicConfig(level=logging_level)
@@ -47,145 +106,438 @@ async def process_api_requests_from_file(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    learn_completion_budgets: bool = False,
+    completion_budget_percentile: float = 0.95,
+    results_flush_lines: int = 100,
+    results_flush_seconds: float = 1.0,
+    results_fsync_policy: str = "close",
+    response_cache_filepath: str = None,
+    response_cache_max_entries: int = None,
+    response_cache_max_age_seconds: float = None,
+    bypass_response_cache: bool = False,
+    resume: bool = False,
+    max_requests_in_flight: int = 100,
+    request_timeout_seconds: float = 300,
+    connect_timeout_seconds: float = 10,
+    hedge_requests: bool = False,
+    hedge_percentile: float = 0.95,
+    endpoints: list = None,
+    trace_configs: list = None,
+    status_tracker: "StatusTracker" = None,
+    metrics_snapshot_filepath: str = None,
+    metrics_snapshot_seconds: float = 10,
+    metrics_port: int = None,
+    precount_tokens: bool = False,
+    requests=None,
+    results_format: str = "jsonl",
+    model_rate_limits: dict = None,
+    aggregates_filepath: str = None,
+    metrics_host: str = "127.0.0.1",
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
+    """Processes API requests in parallel, throttling to stay under rate limits.
+
+    Requests are read from `requests_filepath`, or from `requests` if given: any iterable or async
+    iterable of request dicts, such as generate_requests.iter_chat_completion_requests, so they can be
+    streamed straight from memory without writing a requests file. The dicts are not modified.
+
+    If `response_cache_filepath` is set, deterministic requests are answered from the cache without
+    using any rate limit capacity, and successful responses are added to it. `bypass_response_cache`
+    skips the lookups (to get fresh samples) but still refreshes the cache.
+
+    With `resume`, requests that already succeeded in `save_filepath` are skipped, so an interrupted run
+    can be restarted with the same arguments. Failed requests are sent again, and their new results are
+    appended after the old errors. Task IDs are line numbers in the requests file, so they are the same
+    on every run.
+
+    At most `max_requests_in_flight` requests are sent or waiting to retry at once, which is also the
+    size of the connection pool. The requests file is not read further until one of them finishes.
+
+    Each attempt is abandoned (and retried) after `request_timeout_seconds`, or `connect_timeout_seconds`
+    if no connection can be made. With `hedge_requests`, a request still running after the observed
+    `hedge_percentile` latency is sent again and the first response is kept; both copies are charged
+    against the rate limits.
+
+    Pass `endpoints` to spread requests over several keys or deployments, each with its own limits; see
+    `load_endpoints`. `request_url`, `api_key` and the per-minute limits are then ignored.
 
+    `trace_configs` are aiohttp.TraceConfig hooks for the HTTP session, e.g. to time requests.
+
+    Every request's queue wait, time blocked on the rate limits, HTTP latency, attempts and tokens are
+    recorded in histograms on the StatusTracker. Pass your own `status_tracker` to read it while the run
+    is going, set `metrics_snapshot_filepath` to append a JSON snapshot every `metrics_snapshot_seconds`,
+    or set `metrics_port` to serve Prometheus metrics on `metrics_host`; see telemetry.py.
+
+    With `results_format` "normalized", `save_filepath` is a directory where prompt text and parameters
+    are stored once and results refer to them; see results_store.py.
+
+    Token counts saved next to the requests file by token_counts.py are used instead of tokenizing each
+    request as it is read, as long as the file hasn't changed. With `precount_tokens`, they are counted
+    in a process pool and saved before the first request is sent if they aren't there already.
+
+    `model_rate_limits` gives models their own budgets, as providers set limits per model, e.g.
+    {"gpt-4": {"max_requests_per_minute": 500, "max_tokens_per_minute": 30000}}. Other models each get
+    a budget of the endpoint's limits, resized only by their own rate limit headers. A request for a
+    model that is out of budget is set aside while
+    requests for other models are sent, so a run over several models uses all their quotas at once. Up
+    to `max_requests_in_flight` requests are set aside before reading stops.
+    Endpoints from `load_endpoints` can set their own "model_rate_limits".
+
+    With `aggregates_filepath`, counts, accuracy, tokens and latency per model, specialty and
+    demographic value are kept up to date in that SQLite file as results are written; see aggregates.py.
+    Returns the StatusTracker with the run's final counts."""
     # initialize logging
     logging.basicConfig(level=logging_level)
     logging.debug(f"Logging initialized at level {logging_level}")
 
-    # infer API endpoint and construct request header
-    api_endpoint = api_endpoint_from_url(request_url)
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if "/deployments" in request_url:
-        request_header = {"api-key": f"{api_key}"}
+    # infer API endpoint, which must be the same for every endpoint in the pool
+    if not endpoints:
+        endpoints = [
+            Endpoint(
+                request_url=request_url,
+                api_key=api_key,
+                max_requests_per_minute=max_requests_per_minute,
+                max_tokens_per_minute=max_tokens_per_minute,
+                model_rate_limits=model_rate_limits,
+            )
+        ]
+    if results_format not in results_formats:
+        raise ValueError(
+            f'Expecting results_format to be one of {results_formats}, got "{results_format}"'
+        )
+    api_endpoint = api_endpoint_from_url(endpoints[0].request_url)
+    for endpoint in endpoints:
+        if api_endpoint_from_url(endpoint.request_url) != api_endpoint:
+            raise ValueError(
+                f'Expecting every endpoint to serve "{api_endpoint}", got {endpoint.request_url}'
+            )
+
+    # use token counts from an earlier run or a pre-pass, if there are any
+    token_counts = (
+        await asyncio.to_thread(
+            load_or_count_tokens,
+            requests_filepath,
+            api_endpoint,
+            token_encoding_name,
+            count_if_missing=precount_tokens,
+        )
+        if requests is None
+        else None
+    )
 
     # initialize trackers
     queue_of_requests_to_retry = asyncio.Queue()
     task_id_generator = (
         task_id_generator_function()
     )  # generates integer IDs of 1, 2, 3, ...
-    status_tracker = (
-        StatusTracker()
-    )  # single instance to track a collection of variables
+    if status_tracker is None:
+        status_tracker = (
+            StatusTracker()
+        )  # single instance to track a collection of variables
+    endpoint_pool = EndpointPool(
+        endpoints
+    )  # token buckets for requests and tokens, per endpoint
+    completion_budget_estimator = (
+        CompletionBudgetEstimator(percentile=completion_budget_percentile)
+        if learn_completion_budgets
+        else None
+    )  # sizes completion token reservations from observed usage
+    response_cache = (
+        ResponseCache(
+            response_cache_filepath,
+            max_entries=response_cache_max_entries,
+            max_age_seconds=response_cache_max_age_seconds,
+        )
+        if response_cache_filepath
+        else None
+    )  # responses to deterministic requests from earlier runs
+    request_hedger = (
+        RequestHedger(percentile=hedge_percentile) if hedge_requests else None
+    )  # duplicates requests that are slower than usual
     next_request = None  # variable to hold the next request to call
+    blocked_requests = {}  # model -> deque of requests that didn't fit in its budget, oldest first
+    # every model has its own budget, so keep reading past requests for a model that is out of budget
+    # so the others aren't held up
+    max_blocked_requests = max_requests_in_flight
+    tasks_in_flight = set()  # handles of running call_api tasks, at most max_requests_in_flight
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
+    def forget_task(task):
+        tasks_in_flight.discard(task)
+        endpoint_pool.notify()  # a slot in the pipeline is free
+
+    # find the requests that already succeeded in an earlier run
+    completed_request_keys = collections.Counter()
+    if resume and os.path.exists(save_filepath):
+        completed_request_keys = scan_completed_requests(save_filepath)
+        logging.info(
+            f"Resuming: {sum(completed_request_keys.values())} requests already completed in {save_filepath}"
+        )
 
     # initialize flags
     file_not_finished = True  # after file is empty, we'll skip reading it
     logging.debug(f"Initialization complete.")
 
     # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
-        logging.debug(f"File opened. Entering main loop")
-        async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
-            while True:
-                # get next request (if one is not already waiting for capacity)
-                if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
-                        logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
-                        )
-                    elif file_not_finished:
-                        try:
-                            # get new request
-                            request_json = json.loads(next(requests))
-                            next_request = APIRequest(
-                                task_id=next(task_id_generator),
-                                request_json=request_json,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    request_json, api_endpoint, token_encoding_name
-                                ),
-                                attempts_left=max_attempts,
-                                metadata=request_json.pop("metadata", None),
+    with (
+        open_requests(requests_filepath) if requests is None else contextlib.nullcontext()
+    ) as file, response_cache or contextlib.nullcontext(), (
+        ResultsAggregates(aggregates_filepath) if aggregates_filepath else contextlib.nullcontext()
+    ) as results_aggregates:
+        # `request_iterator` will provide requests one at a time
+        request_iterator = iterate_requests(file if requests is None else requests)
+        logging.debug(f"Requests opened. Entering main loop")
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                # leave room for hedges so they don't queue behind the requests they duplicate
+                limit=max_requests_in_flight * (2 if hedge_requests else 1)
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=request_timeout_seconds, connect=connect_timeout_seconds
+            ),
+            trace_configs=trace_configs,
+        ) as session, (
+            NormalizedResultsWriter if results_format == "normalized" else ResultsWriter
+        )(
+            save_filepath,
+            flush_lines=results_flush_lines,
+            flush_seconds=results_flush_seconds,
+            fsync_policy=results_fsync_policy,
+            observers=[results_aggregates] if results_aggregates is not None else None,
+        ) as results_writer, MetricsExporter(
+            status_tracker,
+            snapshot_filepath=metrics_snapshot_filepath,
+            snapshot_seconds=metrics_snapshot_seconds,
+            port=metrics_port,
+            host=metrics_host,
+        ):  # results are written in batches by a single task; metrics are published alongside
+            # wake the dispatch loop if the writer stops, so a failed write ends the run right away
+            results_writer.task.add_done_callback(lambda _: endpoint_pool.notify())
+            try:
+                while True:
+                    # stop if results can no longer be written
+                    results_writer.check()
+
+                    # send every request that fits within the available capacity
+                    while True:
+                        # stop reading requests while the pipeline is full
+                        if len(tasks_in_flight) >= max_requests_in_flight:
+                            break
+
+                        # first, the oldest set-aside request of a model whose budget has room again
+                        was_blocked = False
+                        for model, requests_waiting in blocked_requests.items():
+                            if (
+                                endpoint_pool.seconds_until_available(
+                                    requests_waiting[0].token_consumption, model
+                                )
+                                <= 0
+                            ):
+                                next_request = requests_waiting.popleft()
+                                was_blocked = True
+                                if not requests_waiting:
+                                    del blocked_requests[model]
+                                break
+
+                        # get next request (unless too many are already waiting for capacity)
+                        num_blocked_requests = sum(map(len, blocked_requests.values()))
+                        if next_request is None and num_blocked_requests < max_blocked_requests:
+                            if not queue_of_requests_to_retry.empty():
+                                next_request = queue_of_requests_to_retry.get_nowait()
+                                logging.debug(
+                                    f"Retrying request {next_request.task_id}: {next_request}"
+                                )
+                            elif file_not_finished:
+                                try:
+                                    # get new request
+                                    request_json, offset, length = await request_iterator.__anext__()
+                                    metadata = request_json.pop("metadata", None)
+                                    task_id = next(task_id_generator)
+
+                                    # skip requests that succeeded in an earlier run
+                                    if completed_request_keys:
+                                        key = request_key(request_json, metadata)
+                                        if completed_request_keys[key] > 0:
+                                            completed_request_keys[key] -= 1
+                                            status_tracker.num_tasks_skipped += 1
+                                            continue
+
+                                    # answer deterministic requests from the cache if we can, with a
+                                    # response from any endpoint the request could be routed to
+                                    cache_response = (
+                                        response_cache is not None
+                                        and is_deterministic_request(request_json)
+                                    )
+                                    if cache_response and not bypass_response_cache:
+                                        for pool_endpoint in endpoint_pool.endpoints:
+                                            cached_response = response_cache.get(
+                                                response_cache.key(
+                                                    request_json, pool_endpoint.request_url
+                                                )
+                                            )
+                                            if cached_response is not None:
+                                                break
+                                        if cached_response is not None:
+                                            status_tracker.num_cache_hits += 1
+                                            status_tracker.num_tasks_started += 1
+                                            status_tracker.num_tasks_succeeded += 1
+                                            results_writer.write(
+                                                [request_json, cached_response, metadata]
+                                                if metadata
+                                                else [request_json, cached_response]
+                                            )
+                                            logging.debug(
+                                                f"Request {task_id} answered from cache"
+                                            )
+                                            continue
+                                        status_tracker.num_cache_misses += 1
+
+                                    if token_counts is not None:
+                                        token_consumption = token_counts.token_consumption[task_id]
+                                        completion_token_reservation = (
+                                            token_counts.completion_token_reservation[task_id]
+                                        )
+                                    else:
+                                        token_consumption = num_tokens_consumed_from_request(
+                                            request_json, api_endpoint, token_encoding_name
+                                        )
+                                        completion_token_reservation = (
+                                            num_completion_tokens_reserved(
+                                                request_json, api_endpoint
+                                            )
+                                        )
+                                    # reserve the learned completion budget instead of the full max_tokens
+                                    if completion_budget_estimator is not None:
+                                        prompt_tokens = (
+                                            token_consumption - completion_token_reservation
+                                        )
+                                        completion_token_reservation = (
+                                            num_completion_tokens_reserved(
+                                                request_json,
+                                                api_endpoint,
+                                                max_tokens=completion_budget_estimator.reservation(
+                                                    completion_budget_key(request_json),
+                                                    request_json.get("max_tokens", 15),
+                                                ),
+                                            )
+                                        )
+                                        token_consumption = (
+                                            prompt_tokens + completion_token_reservation
+                                        )
+                                    next_request = APIRequest(
+                                        task_id=task_id,
+                                        model=request_json.get("model"),
+                                        token_consumption=token_consumption,
+                                        attempts_left=max_attempts,
+                                        # keep where the request is rather than the parsed request
+                                        requests_file=file if offset is not None else None,
+                                        offset=offset,
+                                        length=length,
+                                        body=(
+                                            encode_request(request_json, metadata)
+                                            if offset is None
+                                            else None
+                                        ),
+                                        completion_token_reservation=completion_token_reservation,
+                                        cache_response=cache_response,
+                                    )
+                                    status_tracker.num_tasks_started += 1
+                                    status_tracker.num_tasks_in_progress += 1
+                                    logging.debug(
+                                        f"Reading request {next_request.task_id}: {next_request}"
+                                    )
+                                except StopAsyncIteration:
+                                    # if file runs out, set flag to stop reading it
+                                    logging.debug("Read file exhausted")
+                                    file_not_finished = False
+
+                        # nothing left to send until a request is retried
+                        if next_request is None:
+                            break
+
+                        # if not enough capacity available, set the request aside until its buckets refill
+                        endpoint = (
+                            None  # keep each model's requests in order
+                            if next_request.model in blocked_requests and not was_blocked
+                            else endpoint_pool.try_acquire(
+                                next_request.token_consumption, next_request.model
                             )
-                            status_tracker.num_tasks_started += 1
-                            status_tracker.num_tasks_in_progress += 1
-                            logging.debug(
-                                f"Reading request {next_request.task_id}: {next_request}"
+                        )
+                        if endpoint is None:
+                            if next_request.time_blocked is None:
+                                next_request.time_blocked = time.monotonic()
+                            requests_waiting = blocked_requests.setdefault(
+                                next_request.model, collections.deque()
                             )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
-
-                # update available capacity
-                current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
-                )
-                last_update_time = current_time
-
-                # if enough capacity available, call API
-                if next_request:
-                    next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
-                        # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
-                        next_request.attempts_left -= 1
+                            if was_blocked:
+                                requests_waiting.appendleft(next_request)  # back where it was
+                            else:
+                                requests_waiting.append(next_request)
+                            next_request = None
+                            continue
 
                         # call API
-                        asyncio.create_task(
+                        next_request.record_dispatch(status_tracker)
+                        next_request.attempts_left -= 1
+                        task = asyncio.create_task(
                             next_request.call_api(
                                 session=session,
-                                request_url=request_url,
-                                request_header=request_header,
+                                endpoint=endpoint,
+                                endpoint_pool=endpoint_pool,
                                 retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
+                                results_writer=results_writer,
                                 status_tracker=status_tracker,
+                                api_endpoint=api_endpoint,
+                                completion_budget_estimator=completion_budget_estimator,
+                                response_cache=response_cache,
+                                request_hedger=request_hedger,
                             )
                         )
+                        tasks_in_flight.add(task)
+                        task.add_done_callback(forget_task)
                         next_request = None  # reset next_request to empty
 
-                # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
-                    break
-
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
+                    # if every request has been read, sent and finished, break; a task counts as
+                    # finished once its done callback has run, which is after it wakes this loop
+                    if (
+                        not file_not_finished
+                        and not blocked_requests
+                        and queue_of_requests_to_retry.empty()
+                        and not tasks_in_flight
+                    ):
+                        break
 
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
-                )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
+                    # sleep until the next request fits, or until a request finishes or is queued for retry
+                    blocked_on_rate_limit = (
+                        bool(blocked_requests)
+                        and len(tasks_in_flight) < max_requests_in_flight
                     )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warn(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
+                    seconds_to_wait = (
+                        min(
+                            endpoint_pool.seconds_until_available(
+                                requests_waiting[0].token_consumption, model
+                            )
+                            for model, requests_waiting in blocked_requests.items()
+                        )
+                        if blocked_on_rate_limit
+                        else None
                     )
+                    wait_start_time = time.monotonic()
+                    await endpoint_pool.wait(timeout=seconds_to_wait)
+                    if blocked_on_rate_limit:
+                        status_tracker.seconds_waiting_for_rate_limit += (
+                            time.monotonic() - wait_start_time
+                        )
+                    else:
+                        status_tracker.seconds_waiting_for_requests_in_flight += (
+                            time.monotonic() - wait_start_time
+                        )
+            finally:
+                # on errors or cancellation, stop the requests still in flight before closing the session
+                tasks_to_stop = set(tasks_in_flight)
+                if request_hedger is not None:
+                    tasks_to_stop |= request_hedger.slower_copies
+                for task in tasks_to_stop:
+                    task.cancel()
+                await asyncio.gather(*tasks_to_stop, return_exceptions=True)
 
         # after finishing, log final status
         logging.info(
@@ -199,6 +551,33 @@ async def process_api_requests_from_file(
             logging.warning(
                 f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
             )
+        if status_tracker.num_tasks_skipped > 0:
+            logging.info(
+                f"{status_tracker.num_tasks_skipped} requests skipped because they completed in an earlier run."
+            )
+        if status_tracker.num_hedged_requests > 0:
+            logging.info(
+                f"{status_tracker.num_hedged_requests} / {status_tracker.num_tasks_started} requests hedged. "
+                f"The duplicate finished first {status_tracker.num_hedges_won} times, "
+                f"saving at least {status_tracker.seconds_saved_by_hedging:.1f} seconds of latency in total."
+            )
+        if len(endpoints) > 1:
+            for endpoint in endpoints:
+                logging.info(
+                    f"{endpoint.request_url}: {endpoint.num_requests_sent} requests sent, {endpoint.num_errors} failed."
+                )
+        if response_cache is not None:
+            logging.info(
+                f"Response cache: {status_tracker.num_cache_hits} hits, {status_tracker.num_cache_misses} misses."
+            )
+        if status_tracker.http_latency_seconds.count > 0:
+            logging.info(
+                f"HTTP latency p50 {status_tracker.http_latency_seconds.quantile(0.5):.2f}s, "
+                f"p99 {status_tracker.http_latency_seconds.quantile(0.99):.2f}s. "
+                f"Waited {status_tracker.seconds_waiting_for_rate_limit:.1f}s for rate limits "
+                f"and {status_tracker.seconds_waiting_for_requests_in_flight:.1f}s for requests in flight."
+            )
+    return status_tracker
 
 
 # dataclasses
@@ -215,109 +594,565 @@ class StatusTracker:
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
-    time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    time_of_last_rate_limit_error: int = 0  # when the most recent rate limit error was received
+    num_completion_tokens_refunded: int = 0  # unused reservations returned to the token bucket, less overruns
+    num_cache_hits: int = 0  # requests answered from the response cache
+    num_cache_misses: int = 0  # cacheable requests that had to be sent
+    num_tasks_skipped: int = 0  # already completed in an earlier run
+    num_hedged_requests: int = 0  # requests that were sent a second time for being slow
+    num_hedges_won: int = 0  # hedged requests where the duplicate finished first
+    seconds_saved_by_hedging: float = 0  # sum over won hedges of how much sooner the duplicate finished (at least)
+    num_retries: int = 0  # attempts after the first, for any reason
+    num_prompt_tokens: int = 0  # as reported in the usage of successful responses
+    num_completion_tokens: int = 0
+    seconds_waiting_for_rate_limit: float = 0  # dispatch loop asleep with a request that didn't fit
+    seconds_waiting_for_requests_in_flight: float = 0  # dispatch loop asleep with the pipeline full or empty
+    # per-request distributions; see telemetry.py
+    queue_wait_seconds: Histogram = field(default_factory=Histogram)  # read or retried until first try to send
+    rate_limit_wait_seconds: Histogram = field(default_factory=Histogram)  # first try to send until sent
+    http_latency_seconds: Histogram = field(default_factory=Histogram)  # sent until response, hedges included
+    attempts_per_request: Histogram = field(
+        default_factory=lambda: Histogram(attempts_buckets)
+    )  # of finished requests, successful or not
+    prompt_tokens: Histogram = field(default_factory=lambda: Histogram(tokens_buckets))
+    completion_tokens: Histogram = field(default_factory=lambda: Histogram(tokens_buckets))
+
+
+@dataclass
+class TokenBucket:
+    """Refills continuously at `capacity` units per minute, never holding more than `capacity`."""
+
+    capacity: float
+    available: float = None  # starts full
+    last_update_time: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self):
+        if self.available is None:
+            self.available = self.capacity
+
+    def refill(self, current_time: float) -> None:
+        """Add the capacity earned since the last update."""
+        seconds_since_update = current_time - self.last_update_time
+        self.available = min(
+            self.available + self.capacity * seconds_since_update / 60.0,
+            self.capacity,
+        )
+        self.last_update_time = current_time
+
+    def seconds_until_available(self, amount: float) -> float:
+        """Seconds until `amount` can be consumed, or 0 if it can be consumed now."""
+        # a request larger than the whole bucket is let through once the bucket is full
+        deficit = min(amount, self.capacity) - self.available
+        if deficit <= 0:
+            return 0.0
+        return deficit * 60.0 / self.capacity
+
+    def consume(self, amount: float) -> None:
+        self.available -= amount
+
+    def refund(self, amount: float) -> None:
+        """Return unused capacity to the bucket. A negative amount charges an overrun."""
+        self.available = min(self.available + amount, self.capacity)
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens. Dispatch sleeps until the next request fits, or until woken by a finished or retried request."""
+
+    def __init__(
+        self,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float,
+        wakeup: asyncio.Event = None,
+    ):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.request_bucket = TokenBucket(capacity=max_requests_per_minute)
+        self.token_bucket = TokenBucket(capacity=max_tokens_per_minute)
+        self.wakeup = wakeup or asyncio.Event()  # may be shared by several limiters
+
+    def seconds_until_available(self, num_tokens: int) -> float:
+        """Seconds until one request of `num_tokens` tokens fits in both buckets."""
+        current_time = time.monotonic()
+        self.request_bucket.refill(current_time)
+        self.token_bucket.refill(current_time)
+        return max(
+            self.request_bucket.seconds_until_available(1),
+            self.token_bucket.seconds_until_available(num_tokens),
+        )
+
+    def try_acquire(self, num_tokens: int) -> bool:
+        """Consume capacity for one request if it fits now. Returns whether it did."""
+        if self.seconds_until_available(num_tokens) > 0:
+            return False
+        self.consume(num_tokens)
+        return True
+
+    def headroom(self, num_tokens: int) -> float:
+        """Fraction of the tighter of the two limits left after a request of `num_tokens` tokens."""
+        return min(
+            (self.request_bucket.available - 1) / self.request_bucket.capacity,
+            (self.token_bucket.available - num_tokens) / self.token_bucket.capacity,
+        )
+
+    def consume(self, num_tokens: int) -> None:
+        """Consume capacity for one request, even if that leaves the buckets in debt."""
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(num_tokens)
+
+    def refund_tokens(self, num_tokens: int) -> None:
+        """Return reserved tokens that a request did not use."""
+        self.token_bucket.refund(num_tokens)
+
+    def update_from_headers(self, headers) -> None:
+        """Resize the buckets from the x-ratelimit-* response headers.
+
+        The server's limit caps the configured capacity, and the server's remaining count caps
+        what the bucket thinks is available. Neither header can raise the configured limits."""
+        current_time = time.monotonic()
+        for bucket, configured_capacity, kind in (
+            (self.request_bucket, self.max_requests_per_minute, "requests"),
+            (self.token_bucket, self.max_tokens_per_minute, "tokens"),
+        ):
+            limit = float_from_header(headers, f"x-ratelimit-limit-{kind}")
+            remaining = float_from_header(headers, f"x-ratelimit-remaining-{kind}")
+            bucket.refill(current_time)
+            if limit:
+                bucket.capacity = min(limit, configured_capacity)
+                bucket.available = min(bucket.available, bucket.capacity)
+            if remaining is not None:
+                bucket.available = min(bucket.available, remaining)
+
+    def notify(self) -> None:
+        """Wake the dispatch loop, e.g. after a request finishes or is queued for retry."""
+        self.wakeup.set()
 
 
 @dataclass
+class Endpoint:
+    """One API key or deployment, with its own rate limits."""
+
+    request_url: str
+    api_key: str
+    max_requests_per_minute: float
+    max_tokens_per_minute: float
+    max_consecutive_errors: int = 3  # errors in a row before the endpoint is taken out of rotation
+    seconds_out_of_rotation: float = 30  # how long a failing endpoint is skipped for
+    rate_limiter: RateLimiter = None
+    model_rate_limits: dict = None  # model -> its own max_requests_per_minute and max_tokens_per_minute
+    model_rate_limiters: dict = None  # built from model_rate_limits, then added to as models are seen
+    num_requests_sent: int = 0
+    num_errors: int = 0
+    num_consecutive_errors: int = 0
+    time_back_in_rotation: float = 0  # monotonic time until which the endpoint is skipped
+
+    def __post_init__(self):
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(
+                max_requests_per_minute=self.max_requests_per_minute,
+                max_tokens_per_minute=self.max_tokens_per_minute,
+            )
+        if self.model_rate_limiters is None:
+            self.model_rate_limiters = {
+                model: RateLimiter(
+                    max_requests_per_minute=limits["max_requests_per_minute"],
+                    max_tokens_per_minute=limits["max_tokens_per_minute"],
+                )
+                for model, limits in (self.model_rate_limits or {}).items()
+            }
+
+    def rate_limiter_for(self, model: str = None) -> RateLimiter:
+        """The budget that requests for `model` draw on, or the endpoint's for requests without a model.
+
+        A model without model_rate_limits gets a budget of the endpoint's limits the first time it is
+        asked for, so one model's rate limit headers never shrink another's."""
+        if model is None:
+            return self.rate_limiter
+        rate_limiter = self.model_rate_limiters.get(model)
+        if rate_limiter is None:
+            rate_limiter = self.model_rate_limiters[model] = RateLimiter(
+                max_requests_per_minute=self.max_requests_per_minute,
+                max_tokens_per_minute=self.max_tokens_per_minute,
+                wakeup=self.rate_limiter.wakeup,
+            )
+        return rate_limiter
+
+    @property
+    def request_header(self) -> dict:
+        # use api-key header for Azure deployments
+        if "/deployments" in self.request_url:
+            return {"api-key": f"{self.api_key}"}
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def record_success(self) -> None:
+        self.num_consecutive_errors = 0
+
+    def record_failure(self) -> bool:
+        """Count a server or connection error, returning whether the errors keep coming and the
+        endpoint is still in rotation, so should be taken out of it."""
+        self.num_errors += 1
+        self.num_consecutive_errors += 1
+        # once back in rotation, one more error takes it out again until a request succeeds
+        return (
+            self.num_consecutive_errors >= self.max_consecutive_errors
+            and self.time_back_in_rotation <= time.monotonic()
+        )
+
+    def take_out_of_rotation(self) -> None:
+        logging.warning(
+            f"{self.request_url} failed {self.num_consecutive_errors} times in a row. "
+            f"Skipping it for {self.seconds_out_of_rotation} seconds."
+        )
+        self.time_back_in_rotation = time.monotonic() + self.seconds_out_of_rotation
+
+
+class EndpointPool:
+    """Routes each request to the endpoint with the most rate limit headroom, skipping endpoints that keep failing."""
+
+    def __init__(self, endpoints: list):
+        self.endpoints = endpoints
+        self.wakeup = asyncio.Event()  # shared by every endpoint's rate limiter
+        for endpoint in endpoints:
+            endpoint.rate_limiter.wakeup = self.wakeup
+            for rate_limiter in endpoint.model_rate_limiters.values():
+                rate_limiter.wakeup = self.wakeup
+
+    def try_acquire(self, num_tokens: int, model: str = None):
+        """Consume capacity for one request for `model` on the endpoint with the most headroom.
+
+        Returns that endpoint, or None if the request doesn't fit on any endpoint now."""
+        current_time = time.monotonic()
+        best_endpoint = None
+        for endpoint in self.endpoints:
+            if endpoint.time_back_in_rotation > current_time:
+                continue
+            if endpoint.rate_limiter_for(model).seconds_until_available(num_tokens) > 0:
+                continue
+            if best_endpoint is None or endpoint.rate_limiter_for(model).headroom(
+                num_tokens
+            ) > best_endpoint.rate_limiter_for(model).headroom(num_tokens):
+                best_endpoint = endpoint
+        if best_endpoint is not None:
+            best_endpoint.rate_limiter_for(model).consume(num_tokens)
+            best_endpoint.num_requests_sent += 1
+        return best_endpoint
+
+    def seconds_until_available(self, num_tokens: int, model: str = None) -> float:
+        """Seconds until a request of `num_tokens` tokens for `model` fits on some endpoint."""
+        current_time = time.monotonic()
+        return min(
+            max(
+                endpoint.rate_limiter_for(model).seconds_until_available(num_tokens),
+                endpoint.time_back_in_rotation - current_time,
+            )
+            for endpoint in self.endpoints
+        )
+
+    def record_failure(self, endpoint: Endpoint) -> None:
+        """Count a server or connection error on `endpoint`, taking it out of rotation if they keep coming
+        and another endpoint in rotation can take its requests. Otherwise its requests just back off."""
+        if endpoint.record_failure():
+            current_time = time.monotonic()
+            if any(
+                other is not endpoint and other.time_back_in_rotation <= current_time
+                for other in self.endpoints
+            ):
+                endpoint.take_out_of_rotation()
+
+    def notify(self) -> None:
+        """Wake the dispatch loop, e.g. after a request finishes or is queued for retry."""
+        self.wakeup.set()
+
+    async def wait(self, timeout: float = None) -> None:
+        """Sleep for `timeout` seconds (forever if None), or until `notify` is called."""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+
+def load_endpoints(endpoints_filepath: str) -> list:
+    """Read a pool of endpoints from a JSON file.
+
+    The file holds a list of objects with "request_url", "max_requests_per_minute" and
+    "max_tokens_per_minute", plus either "api_key" or "api_key_env", the name of an environment
+    variable holding the key."""
+    with open(endpoints_filepath) as file:
+        endpoint_configs = json.load(file)
+    endpoints = []
+    for endpoint_config in endpoint_configs:
+        endpoint_config = dict(endpoint_config)
+        api_key_env = endpoint_config.pop("api_key_env", None)
+        if api_key_env is not None:
+            endpoint_config["api_key"] = os.getenv(api_key_env)
+        endpoints.append(Endpoint(**endpoint_config))
+    return endpoints
+
+
+@dataclass(slots=True)
 class APIRequest:
-    """Stores an API request's inputs, outputs, and other metadata. Contains a method to make an API call."""
+    """Stores an API request's inputs, outputs, and other metadata. Contains a method to make an API call.
+
+    The request isn't kept parsed while it waits. It is the line at `offset` of `requests_file`, or the
+    encoded JSON in `body`, and is parsed again on each attempt. Errors are kept as the strings they
+    are saved as, not as exceptions holding on to their tracebacks."""
 
     task_id: int
-    request_json: dict
     token_consumption: int
     attempts_left: int
-    metadata: dict
-    result: list = field(default_factory=list)
+    model: str = None  # whose budget the request draws on
+    requests_file: MappedRequestsFile = None
+    offset: int = None  # of the request's line in requests_file
+    length: int = None
+    body: bytes = None  # the request and its metadata as JSON, if it isn't in requests_file
+    errors: list = field(default_factory=list)
+    completion_token_reservation: int = 0  # part of token_consumption reserved for completions
+    cache_response: bool = False  # whether to add the response to the response cache
+    time_queued: float = field(default_factory=time.monotonic)  # when read, or put back to retry
+    time_blocked: float = None  # when it first didn't fit in the rate limits, this attempt
+
+    def record_dispatch(self, status_tracker: StatusTracker) -> None:
+        """Record how long this attempt waited to be sent, in the queue and on the rate limits."""
+        current_time = time.monotonic()
+        time_blocked = self.time_blocked or current_time
+        status_tracker.queue_wait_seconds.observe(time_blocked - self.time_queued)
+        status_tracker.rate_limit_wait_seconds.observe(current_time - time_blocked)
+        self.time_blocked = None
+
+    def load(self) -> tuple:
+        """Parse the request into (request_json, metadata)."""
+        if self.body is None:
+            return decode_request(self.requests_file.read(self.offset, self.length))
+        return decode_request(self.body)
 
     async def call_api(
         self,
         session: aiohttp.ClientSession,
-        request_url: str,
-        request_header: dict,
+        endpoint: Endpoint,
+        endpoint_pool: EndpointPool,
         retry_queue: asyncio.Queue,
-        save_filepath: str,
+        results_writer: ResultsWriter,
         status_tracker: StatusTracker,
+        api_endpoint: str,
+        completion_budget_estimator: "CompletionBudgetEstimator" = None,
+        response_cache: ResponseCache = None,
+        request_hedger: "RequestHedger" = None,
     ):
         """Calls the OpenAI API and saves results."""
         logging.info(f"Starting request #{self.task_id}")
+        request_json, metadata = self.load()
+        rate_limiter = endpoint.rate_limiter_for(self.model)
         error = None
-        try:
+        seconds_to_retry_after = None  # set from the response headers when the server asks us to wait
+
+        async def post():
             async with session.post(
-                url=request_url, headers=request_header, json=self.request_json
+                url=endpoint.request_url,
+                headers=endpoint.request_header,
+                json=request_json,
             ) as response:
-                response = await response.json()
+                rate_limiter.update_from_headers(response.headers)
+                return response.status, response.headers, await response.json()
+
+        def charge_hedge():
+            # the duplicate counts against the rate limits just like the original
+            rate_limiter.consume(self.token_consumption)
+            logging.debug(f"Hedging request {self.task_id}")
+
+        try:
+            start_time = time.monotonic()
+            if request_hedger is None:
+                status, headers, response = await post()
+            else:
+                status, headers, response = await request_hedger.send(
+                    post, on_hedge=charge_hedge, status_tracker=status_tracker
+                )
+            latency_seconds = time.monotonic() - start_time
+            status_tracker.http_latency_seconds.observe(latency_seconds)
             if "error" in response:
                 logging.warning(
                     f"Request {self.task_id} failed with error {response['error']}"
                 )
                 status_tracker.num_api_errors += 1
                 error = response
-                if "Rate limit" in response["error"].get("message", ""):
+                if status == 429 or "Rate limit" in (
+                    response["error"].get("message") or ""
+                ):
                     status_tracker.time_of_last_rate_limit_error = time.time()
                     status_tracker.num_rate_limit_errors += 1
                     status_tracker.num_api_errors -= (
                         1  # rate limit errors are counted separately
                     )
+                    seconds_to_retry_after = seconds_to_wait_from_headers(headers)
+                elif status >= 500:
+                    endpoint_pool.record_failure(endpoint)
 
         except (
             Exception
         ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
             logging.warning(f"Request {self.task_id} failed with Exception {e}")
             status_tracker.num_other_errors += 1
+            endpoint_pool.record_failure(endpoint)
             error = e
         if error:
-            self.result.append(error)
+            self.errors.append(str(error))
             if self.attempts_left:
+                # back off this request only; the rest of the run keeps going
+                if seconds_to_retry_after is None:
+                    seconds_to_retry_after = random.uniform(
+                        0,
+                        min(
+                            seconds_to_backoff_max,
+                            seconds_to_backoff_base * 2 ** (len(self.errors) - 1),
+                        ),
+                    )
+                else:
+                    seconds_to_retry_after += random.uniform(0, seconds_to_backoff_base)
+                logging.debug(
+                    f"Retrying request {self.task_id} in {seconds_to_retry_after:.2f} seconds"
+                )
+                await asyncio.sleep(seconds_to_retry_after)
+                self.time_queued = time.monotonic()
+                status_tracker.num_retries += 1
                 retry_queue.put_nowait(self)
             else:
                 logging.error(
-                    f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
+                    f"Request {request_json} failed after all attempts. Saving errors: {self.errors}"
                 )
                 data = (
-                    [self.request_json, [str(e) for e in self.result], self.metadata]
-                    if self.metadata
-                    else [self.request_json, [str(e) for e in self.result]]
+                    [request_json, self.errors, metadata]
+                    if metadata
+                    else [request_json, self.errors]
                 )
-                append_to_jsonl(data, save_filepath)
+                results_writer.write(data)
                 status_tracker.num_tasks_in_progress -= 1
                 status_tracker.num_tasks_failed += 1
+                status_tracker.attempts_per_request.observe(len(self.errors))
         else:
+            endpoint.record_success()
+            # give back the part of the completion reservation the response did not use
+            usage = response.get("usage") or {}
+            completion_tokens = usage.get("completion_tokens", 0)
+            status_tracker.num_prompt_tokens += usage.get("prompt_tokens", 0)
+            status_tracker.num_completion_tokens += completion_tokens
+            status_tracker.prompt_tokens.observe(usage.get("prompt_tokens", 0))
+            status_tracker.completion_tokens.observe(completion_tokens)
+            status_tracker.attempts_per_request.observe(len(self.errors) + 1)
+            unused_tokens = self.completion_token_reservation - completion_tokens
+            rate_limiter.refund_tokens(unused_tokens)
+            status_tracker.num_completion_tokens_refunded += unused_tokens
+            if completion_budget_estimator is not None:
+                num_choices = num_completion_tokens_reserved(
+                    request_json, api_endpoint, max_tokens=1
+                )
+                if num_choices:
+                    completion_budget_estimator.observe(
+                        completion_budget_key(request_json),
+                        completion_tokens / num_choices,
+                    )
+            if response_cache is not None and self.cache_response:
+                response_cache.put(response_cache.key(request_json, endpoint.request_url), response)
+
             data = (
-                [self.request_json, response, self.metadata]
-                if self.metadata
-                else [self.request_json, response]
+                [request_json, response, metadata]
+                if metadata
+                else [request_json, response]
             )
-            append_to_jsonl(data, save_filepath)
+            results_writer.write(data, stats={"latency_seconds": latency_seconds})
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            logging.debug(f"Request {self.task_id} saved to {results_writer.filename}")
+
+        # wake the dispatch loop so it can send the retry or notice the run is done
+        rate_limiter.notify()
 
 
 def api_endpoint_from_url(request_url):
     """Extract the API endpoint from the request URL."""
-    match = re.search("^https://[^/]+/v\\d+/(.+)$", request_url)
+    match = re.search("^https?://[^/]+/v\\d+/(.+)$", request_url)
     if match is None:
         # for Azure OpenAI deployment urls
         match = re.search(
-            r"^https://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
+            r"^https?://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
         )
     return match[1]
 
 
+def float_from_header(headers, name: str):
+    """Read a numeric header, returning None if it is missing or malformed."""
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def seconds_from_duration(duration: str):
+    """Parse a rate limit reset duration such as "20ms", "1s" or "6m0s"."""
+    if not duration:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if not parts:
+        try:
+            return float(duration)  # plain number of seconds
+        except ValueError:
+            return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def seconds_to_wait_from_headers(headers):
+    """How long the server asks us to wait before retrying, or None if it doesn't say."""
+    retry_after_ms = float_from_header(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = float_from_header(headers, "retry-after")
+        if seconds is None:  # an HTTP date rather than a number of seconds
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                seconds = retry_at.timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return max(seconds, 0)
+    # otherwise wait for whichever limit is exhausted to reset
+    resets = [
+        seconds_from_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        for kind in ("requests", "tokens")
+        if float_from_header(headers, f"x-ratelimit-remaining-{kind}") == 0
+    ]
+    resets = [seconds for seconds in resets if seconds is not None]
+    return max(resets) if resets else None
+
+
 def append_to_jsonl(data, filename: str) -> None:
     """Append a json payload to the end of a jsonl file."""
     json_string = json.dumps(data)
-    with open(filename, "a") as f:
+    with open_text(filename, "a") as f:
         f.write(json_string + "\n")
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(token_encoding_name: str):
+    """Load a tiktoken encoding once per process."""
+    return tiktoken.get_encoding(token_encoding_name)
+
+
+@functools.lru_cache(maxsize=4096)
+def num_tokens_in_text(text: str, token_encoding_name: str) -> int:
+    """Count the tokens in a piece of text.
+
+    Memoized on the text, so segments shared by many requests, like the system message, are only
+    encoded once. Unique prompts cycle through the cache without growing it past `maxsize` entries."""
+    return len(get_encoding(token_encoding_name).encode(text))
+
+
 def num_tokens_consumed_from_request(
     request_json: dict,
     api_endpoint: str,
     token_encoding_name: str,
 ):
     """Count the number of tokens in the request. Only supports completion and embedding requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
     # if completions request, tokens = prompt + n * max_tokens
     if api_endpoint.endswith("completions"):
         max_tokens = request_json.get("max_tokens", 15)
@@ -330,7 +1165,7 @@ def num_tokens_consumed_from_request(
             for message in request_json["messages"]:
                 num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
                 for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
+                    num_tokens += num_tokens_in_text(value, token_encoding_name)
                     if key == "name":  # if there's a name, the role is omitted
                         num_tokens -= 1  # role is always required and always 1 token
             num_tokens += 2  # every reply is primed with <im_start>assistant
@@ -339,11 +1174,13 @@ def num_tokens_consumed_from_request(
         else:
             prompt = request_json["prompt"]
             if isinstance(prompt, str):  # single prompt
-                prompt_tokens = len(encoding.encode(prompt))
+                prompt_tokens = num_tokens_in_text(prompt, token_encoding_name)
                 num_tokens = prompt_tokens + completion_tokens
                 return num_tokens
             elif isinstance(prompt, list):  # multiple prompts
-                prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
+                prompt_tokens = sum(
+                    [num_tokens_in_text(p, token_encoding_name) for p in prompt]
+                )
                 num_tokens = prompt_tokens + completion_tokens * len(prompt)
                 return num_tokens
             else:
@@ -354,10 +1191,12 @@ def num_tokens_consumed_from_request(
     elif api_endpoint == "embeddings":
         input = request_json["input"]
         if isinstance(input, str):  # single input
-            num_tokens = len(encoding.encode(input))
+            num_tokens = num_tokens_in_text(input, token_encoding_name)
             return num_tokens
         elif isinstance(input, list):  # multiple inputs
-            num_tokens = sum([len(encoding.encode(i)) for i in input])
+            num_tokens = sum(
+                [num_tokens_in_text(i, token_encoding_name) for i in input]
+            )
             return num_tokens
         else:
             raise TypeError(
@@ -370,8 +1209,201 @@ def num_tokens_consumed_from_request(
         )
 
 
+def num_completion_tokens_reserved(
+    request_json: dict,
+    api_endpoint: str,
+    max_tokens: int = None,
+):
+    """Count the completion tokens reserved for a request, i.e. max_tokens for every choice it can return.
+
+    Pass `max_tokens` to size the reservation with a budget other than the request's own."""
+    if not api_endpoint.endswith("completions"):
+        return 0  # embeddings have no completion
+    if max_tokens is None:
+        max_tokens = request_json.get("max_tokens", 15)
+    completion_tokens = request_json.get("n", 1) * max_tokens
+    # normal completions with multiple prompts return n choices per prompt
+    if not api_endpoint.startswith("chat/") and isinstance(
+        request_json.get("prompt"), list
+    ):
+        completion_tokens *= len(request_json["prompt"])
+    return completion_tokens
+
+
+def completion_budget_key(request_json: dict):
+    """Identify a request's prompt template by its model and system message."""
+    messages = request_json.get("messages") or [{}]
+    system_message = (
+        messages[0].get("content") if messages[0].get("role") == "system" else None
+    )
+    return (request_json.get("model"), system_message)
+
+
+class CompletionBudgetEstimator:
+    """Learns how many completion tokens to reserve per prompt template from observed usage.
+
+    Until `min_samples` completions have been seen for a template, the full max_tokens is reserved.
+    After that, the reservation is the `percentile` of the most recent `window` completion lengths.
+    Responses that run over their reservation are charged the difference when they come back."""
+
+    def __init__(self, percentile: float = 0.95, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.samples = {}  # template key -> recent completion tokens per choice
+        self.reservations = {}  # template key -> cached percentile, cleared on observe
+
+    def observe(self, key, completion_tokens: float) -> None:
+        """Record the completion tokens used per choice by a finished request."""
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = collections.deque(maxlen=self.window)
+        samples.append(completion_tokens)
+        self.reservations.pop(key, None)
+
+    def reservation(self, key, max_tokens: int) -> int:
+        """Completion tokens to reserve per choice for a request with this template."""
+        samples = self.samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return max_tokens
+        if key not in self.reservations:
+            ordered = sorted(samples)
+            index = max(math.ceil(self.percentile * len(ordered)) - 1, 0)
+            self.reservations[key] = math.ceil(ordered[index])
+        return min(self.reservations[key], max_tokens)
+
+
+def scan_completed_requests(save_filepath: str) -> collections.Counter:
+    """Count the successful results in a results file or normalized store by request key.
+
+    A partial last line, left by a run that was killed mid-write, is truncated so that new results
+    start on a fresh line."""
+    completed_request_keys = collections.Counter()
+    if is_normalized_store(save_filepath):
+        results_filepath = store_filepath(save_filepath, results_filename)
+        if not os.path.exists(results_filepath):
+            return completed_request_keys
+        truncate_partial_last_line(results_filepath)
+    else:
+        truncate_partial_last_line(save_filepath)
+    for data in iter_results(save_filepath):
+        # failed requests are saved with a list of errors in place of the response
+        response = data[1]
+        if isinstance(response, dict) and "error" not in response:
+            metadata = data[2] if len(data) > 2 else None
+            completed_request_keys[request_key(data[0], metadata)] += 1
+    return completed_request_keys
+
+
+class RequestHedger:
+    """Sends a duplicate of any request still running after the observed `percentile` latency,
+    and keeps whichever response arrives first.
+
+    Hedging only starts after `min_samples` successful responses have been timed. The slower copy is
+    left to finish in the background, since the server does the work either way, so that the latency
+    saved can be measured. Its response is discarded."""
+
+    def __init__(self, percentile: float = 0.95, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)  # seconds, successful responses only
+        self.seconds_to_hedge = None  # cached percentile, cleared when a latency is recorded
+        self.slower_copies = set()  # handles of the slower copies still running
+
+    def record(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.seconds_to_hedge = None
+
+    def hedge_delay(self):
+        """Seconds to wait for a response before hedging, or None while still learning."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        if self.seconds_to_hedge is None:
+            ordered = sorted(self.latencies)
+            self.seconds_to_hedge = ordered[
+                max(math.ceil(self.percentile * len(ordered)) - 1, 0)
+            ]
+        return self.seconds_to_hedge
+
+    async def send(self, post, on_hedge, status_tracker: StatusTracker):
+        """Await `post()`, hedging it with a second `post()` if it is slow. Returns the first success."""
+        start_time = time.monotonic()
+        original = asyncio.create_task(post())
+        copies = {original}
+        hedge = None
+        try:
+            done, pending = await asyncio.wait(copies, timeout=self.hedge_delay())
+            if not done:
+                on_hedge()
+                status_tracker.num_hedged_requests += 1
+                hedge = asyncio.create_task(post())
+                copies.add(hedge)
+                pending = copies
+
+            # the first copy to succeed wins; if both fail, the original's error is raised
+            while True:
+                if not done:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                winner = next((task for task in done if not task.exception()), None)
+                if winner is not None or not pending:
+                    break
+                done = set()
+        except asyncio.CancelledError:
+            for task in copies:
+                task.cancel()
+            raise
+        if winner is None:
+            return original.result()
+
+        seconds_to_win = time.monotonic() - start_time
+        status, headers, response = winner.result()
+        if winner is original and status == 200:
+            self.record(seconds_to_win)
+        if winner is hedge:
+            status_tracker.num_hedges_won += 1
+
+        # let the slower copy finish so we can see how much time the hedge saved
+        for slower_copy in pending:
+
+            def measure(task, slower_copy_is_original=slower_copy is original):
+                self.slower_copies.discard(task)
+                if not slower_copy_is_original:
+                    return
+                # an original cancelled at the end of the run was at least this slow
+                seconds_to_lose = time.monotonic() - start_time
+                if not task.cancelled() and task.exception() is not None:
+                    return
+                if not task.cancelled() and task.result()[0] == 200:
+                    self.record(seconds_to_lose)
+                status_tracker.seconds_saved_by_hedging += seconds_to_lose - seconds_to_win
+
+            self.slower_copies.add(slower_copy)
+            slower_copy.add_done_callback(measure)
+        return status, headers, response
+
+
+async def iterate_requests(requests):
+    """Yield (request_json, offset, length) from an open requests file, or from a sync or async iterable
+    of request dicts, which are copied. `offset` and `length` locate the request's line in a
+    MappedRequestsFile, and are None for other sources."""
+    if isinstance(requests, MappedRequestsFile):
+        for offset, line in requests.iter_lines():
+            yield json.loads(line), offset, len(line)
+    elif isinstance(requests, io.TextIOBase):
+        for line in requests:
+            yield json.loads(line), None, None
+    elif hasattr(requests, "__aiter__"):
+        async for request_json in requests:
+            yield dict(request_json), None, None  # the caller's dict keeps its metadata
+    else:
+        for request_json in requests:
+            yield dict(request_json), None, None
+
+
 def task_id_generator_function():
-    """Generate integers 0, 1, 2, and so on."""
+    """Generate integers 0, 1, 2, and so on. Task IDs are line numbers in the requests file."""
     task_id = 0
     while True:
         yield task_id
@@ -390,5 +1422,29 @@ if __name__ == "__main__":
             token_encoding_name=token_encoding_name,
             max_attempts=max_attempts,
             logging_level=logging_level,
+            learn_completion_budgets=learn_completion_budgets,
+            completion_budget_percentile=completion_budget_percentile,
+            results_flush_lines=results_flush_lines,
+            results_flush_seconds=results_flush_seconds,
+            results_fsync_policy=results_fsync_policy,
+            response_cache_filepath=response_cache_filepath,
+            response_cache_max_entries=response_cache_max_entries,
+            response_cache_max_age_seconds=response_cache_max_age_seconds,
+            bypass_response_cache=bypass_response_cache,
+            resume=resume,
+            max_requests_in_flight=max_requests_in_flight,
+            request_timeout_seconds=request_timeout_seconds,
+            connect_timeout_seconds=connect_timeout_seconds,
+            hedge_requests=hedge_requests,
+            hedge_percentile=hedge_percentile,
+            metrics_snapshot_filepath=metrics_snapshot_filepath,
+            metrics_snapshot_seconds=metrics_snapshot_seconds,
+            metrics_port=metrics_port,
+            precount_tokens=precount_tokens,
+            results_format=results_format,
+            model_rate_limits=model_rate_limits,
+            aggregates_filepath=aggregates_filepath,
+            metrics_host=metrics_host,
+            endpoints=load_endpoints(endpoints_filepath) if endpoints_filepath else None,
         )
     )
@@ -0,0 +1,209 @@
+# benchmark.py
+# Measures how fast api_request_parallel_processor.py can go by driving it against the local mock
+# API in mock_server.py, e.g.:
+#   python -m parallel_processing.benchmark --num-requests 5000 --latency-distribution lognormal
+import aiohttp  # for timing each HTTP request
+import argparse  # for reading benchmark settings from the command line
+import asyncio  # for running the processor
+import json  # for writing requests and reading results
+import multiprocessing  # for running the mock server outside the measured process
+import os  # for temporary file paths
+import resource  # for measuring CPU time and peak memory
+import socket  # for waiting until the mock server is up
+import tempfile  # for the requests and results files
+import time  # for measuring wall-clock time
+
+from parallel_processing.api_request_parallel_processor import (
+    process_api_requests_from_file,
+)
+from parallel_processing.mock_server import latency_distributions, run_mock_server
+
+
+def write_benchmark_requests(
+    requests_filepath: str, num_requests: int, api_endpoint: str, prompt_words: int
+) -> None:
+    """Write synthetic requests shaped like the ones generate_requests.py produces."""
+    with open(requests_filepath, "w") as f:
+        for i in range(num_requests):
+            text = " ".join(f"word{(i + j) % 1000}" for j in range(prompt_words))
+            if api_endpoint == "embeddings":
+                request_json = {"model": "text-embedding-ada-002", "input": text}
+            else:
+                request_json = {
+                    "model": "gpt-3.5-turbo",
+                    "messages": [
+                        {"role": "system", "content": "You are a physician answering board questions."},
+                        {"role": "user", "content": text},
+                    ],
+                    "max_tokens": 256,
+                    "temperature": 0,
+                }
+            request_json["metadata"] = {"benchmark_index": i}
+            f.write(json.dumps(request_json) + "\n")
+
+
+def wait_for_port(port: int, seconds_to_wait: float = 10) -> None:
+    deadline = time.monotonic() + seconds_to_wait
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return float("nan")
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def latency_trace_config(latencies: list) -> aiohttp.TraceConfig:
+    """An aiohttp trace that appends the latency of every HTTP request to `latencies`."""
+
+    async def on_request_start(session, context, params):
+        context.start_time = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        latencies.append(time.monotonic() - context.start_time)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def run_benchmark(
+    num_requests: int = 1000,
+    api_endpoint: str = "chat/completions",
+    prompt_words: int = 200,
+    max_requests_per_minute: float = 100_000,
+    max_tokens_per_minute: float = 100_000_000,
+    max_requests_in_flight: int = 100,
+    port: int = 8089,
+    mock_server_kwargs: dict = None,
+    processor_kwargs: dict = None,
+) -> dict:
+    """Run the processor against a mock server in a child process and return throughput stats."""
+    mock_server_kwargs = dict(
+        mock_server_kwargs or {},
+        # the client, not the server, does the pacing unless the caller says otherwise
+        max_requests_per_minute=(mock_server_kwargs or {}).get(
+            "max_requests_per_minute", max_requests_per_minute * 10
+        ),
+        max_tokens_per_minute=(mock_server_kwargs or {}).get(
+            "max_tokens_per_minute", max_tokens_per_minute * 10
+        ),
+    )
+    server = multiprocessing.Process(
+        target=run_mock_server, args=(port,), kwargs=mock_server_kwargs, daemon=True
+    )
+    server.start()
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            requests_filepath = os.path.join(temp_dir, "requests.jsonl")
+            save_filepath = os.path.join(temp_dir, "results.jsonl")
+            write_benchmark_requests(
+                requests_filepath, num_requests, api_endpoint, prompt_words
+            )
+
+            latencies = []
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            start_time = time.monotonic()
+            status_tracker = asyncio.run(
+                process_api_requests_from_file(
+                    requests_filepath=requests_filepath,
+                    save_filepath=save_filepath,
+                    request_url=f"http://127.0.0.1:{port}/v1/{api_endpoint}",
+                    api_key="mock",
+                    max_requests_per_minute=max_requests_per_minute,
+                    max_tokens_per_minute=max_tokens_per_minute,
+                    token_encoding_name="cl100k_base",
+                    max_attempts=5,
+                    logging_level=30,
+                    max_requests_in_flight=max_requests_in_flight,
+                    trace_configs=[latency_trace_config(latencies)],
+                    **(processor_kwargs or {}),
+                )
+            )
+            seconds_elapsed = time.monotonic() - start_time
+            usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+            total_tokens = 0
+            with open(save_filepath) as file:
+                for line in file:
+                    response = json.loads(line)[1]
+                    if isinstance(response, dict):
+                        total_tokens += response.get("usage", {}).get("total_tokens", 0)
+    finally:
+        server.terminate()
+        server.join()
+
+    cpu_seconds = (usage_after.ru_utime + usage_after.ru_stime) - (
+        usage_before.ru_utime + usage_before.ru_stime
+    )
+    latencies.sort()
+    return {
+        "num_requests": num_requests,
+        "num_succeeded": status_tracker.num_tasks_succeeded,
+        "num_failed": status_tracker.num_tasks_failed,
+        "num_rate_limit_errors": status_tracker.num_rate_limit_errors,
+        "seconds_elapsed": seconds_elapsed,
+        "requests_per_second": status_tracker.num_tasks_succeeded / seconds_elapsed,
+        "tokens_per_second": total_tokens / seconds_elapsed,
+        "latency_p50_seconds": percentile(latencies, 0.50),
+        "latency_p95_seconds": percentile(latencies, 0.95),
+        "latency_p99_seconds": percentile(latencies, 0.99),
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / seconds_elapsed,
+        "peak_rss_megabytes": usage_after.ru_maxrss / 1024,  # ru_maxrss is in kilobytes on Linux
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parallel processor against a local mock API."
+    )
+    parser.add_argument("--num-requests", type=int, default=1000)
+    parser.add_argument(
+        "--api-endpoint", choices=("chat/completions", "embeddings"), default="chat/completions"
+    )
+    parser.add_argument("--prompt-words", type=int, default=200)
+    parser.add_argument("--max-requests-per-minute", type=float, default=100_000)
+    parser.add_argument("--max-tokens-per-minute", type=float, default=100_000_000)
+    parser.add_argument("--max-requests-in-flight", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--seconds-of-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--latency-distribution", choices=latency_distributions, default="constant"
+    )
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        num_requests=args.num_requests,
+        api_endpoint=args.api_endpoint,
+        prompt_words=args.prompt_words,
+        max_requests_per_minute=args.max_requests_per_minute,
+        max_tokens_per_minute=args.max_tokens_per_minute,
+        max_requests_in_flight=args.max_requests_in_flight,
+        port=args.port,
+        mock_server_kwargs={
+            "seconds_of_latency": args.seconds_of_latency,
+            "latency_distribution": args.latency_distribution,
+            "latency_sigma": args.latency_sigma,
+            "rate_limit_error_rate": args.rate_limit_error_rate,
+            "server_error_rate": args.server_error_rate,
+        },
+    )
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print(f"{name:>24}: {value:,.3f}" if isinstance(value, float) else f"{name:>24}: {value:,}")
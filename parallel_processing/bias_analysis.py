@@ -0,0 +1,229 @@
+# bias_analysis.py
+# Measures whether demographics shift accuracy. Every result for a demographic variant of a question is
+# paired with the same model's result for the question without demographics, and the pairs are summarized
+# per demographic slot and value (and per model, specialty or whatever else is asked for): accuracy with
+# and without, the difference, and a bootstrap confidence interval and sign-flip permutation test for it.
+# Both resample whole questions, since a question's variants share its baseline, e.g.:
+#   scored = scoring.score_results("outputs/results_of_chat_completion.jsonl")
+#   bias_table(scored, by=["model"], slots=["race", "ses", ("race", "ses")])
+# or from the command line:
+#   python -m parallel_processing.bias_analysis outputs/results_of_chat_completion.jsonl --by model
+import argparse  # for reading options from the command line
+import concurrent.futures  # for bootstrapping groups in several processes
+import logging  # for logging what was paired
+import numpy as np  # for vectorized resampling
+import pandas as pd  # for pairing and grouping results
+from statsmodels.stats.multitest import multipletests  # for adjusting p-values across groups
+
+demographic_prefix = "demographic_"  # columns added by save_generated_data_to_csv.result_to_row
+no_value = "(none)"  # label for a slot left empty in a variant
+
+
+def demographic_slots(scored: pd.DataFrame) -> list:
+    return [name[len(demographic_prefix) :] for name in scored.columns if name.startswith(demographic_prefix)]
+
+
+def split_baseline(scored: pd.DataFrame, pair_on=("model", "qid")) -> tuple:
+    """Split scored rows into the baseline accuracy of each question and the variant rows.
+
+    Baseline rows are those without demographics (or with every slot left empty). A question asked
+    more than once without demographics gets the mean of its answers' correctness."""
+    pair_on = list(pair_on)
+    slot_columns = [demographic_prefix + slot for slot in demographic_slots(scored)]
+    scored = scored[scored["correct"].notna()]
+    filled = scored[slot_columns].fillna("").astype(str).ne("") if slot_columns else None
+    is_baseline = ~filled.any(axis=1) if filled is not None else pd.Series(True, index=scored.index)
+    baseline = (
+        scored[is_baseline]
+        .groupby(pair_on)["correct"]
+        .mean()
+        .rename("baseline_accuracy")
+    )
+    return baseline, scored[~is_baseline]
+
+
+def pair_results(scored: pd.DataFrame, slots: list = None, pair_on=("model", "qid")) -> pd.DataFrame:
+    """One row per (variant result, slot): its slot value, its correctness and its baseline's.
+
+    A slot may also be a tuple of slots, to compare their combinations. Variants of questions with no
+    baseline result are left out."""
+    baseline, variants = split_baseline(scored, pair_on)
+    variants = variants.join(baseline, on=list(pair_on), how="inner")
+    if variants.empty:
+        logging.warning("No variant results have a baseline result for the same question to pair with")
+    slots = slots if slots is not None else demographic_slots(scored)
+    frames = []
+    for slot in slots:
+        names = slot if isinstance(slot, tuple) else (slot,)
+        values = variants[[demographic_prefix + name for name in names]].fillna("").astype(str)
+        values = values.replace("", no_value)
+        frames.append(
+            variants.assign(
+                slot=" x ".join(names),
+                value=values.iloc[:, 0].str.cat([values[c] for c in values.columns[1:]], sep=" / "),
+            )
+        )
+    if not frames:
+        return variants.assign(slot=pd.Series(dtype=str), value=pd.Series(dtype=str))
+    pairs = pd.concat(frames, ignore_index=True)
+    pairs["correct"] = pairs["correct"].astype(bool)
+    # above 0 where the variant did better than its question's baseline, below where it did worse
+    pairs["difference"] = pairs["correct"].astype(np.float64) - pairs["baseline_accuracy"]
+    return pairs
+
+
+def resample_differences(
+    sum_differences: np.ndarray,
+    num_pairs: np.ndarray,
+    seed_sequence: np.random.SeedSequence,
+    num_resamples: int,
+    confidence: float,
+) -> tuple:
+    """Confidence interval and p-value of the mean paired difference, resampling questions rather than pairs.
+
+    A question's variants share its baseline, so they aren't independent; both the bootstrap and the
+    test treat each question as one unit. The interval draws whole questions with replacement. The
+    test flips the sign of each question's differences at random, which under no effect of
+    demographics leaves their distribution unchanged, and counts how often the flipped mean is at
+    least as far from 0 as the observed one. Each resample is a row of drawn question indices or
+    signs, so all of them together are one gather or product per array."""
+    num_questions = len(num_pairs)
+    rng = np.random.default_rng(seed_sequence)
+    draws = rng.integers(0, num_questions, size=(num_resamples, num_questions))
+    means = sum_differences[draws].sum(axis=1) / np.maximum(num_pairs[draws].sum(axis=1), 1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    # questions that come up heads keep their sign and the rest flip, so each flipped sum is
+    # 2 * (sum over heads) - total
+    heads = rng.integers(0, 2, size=(num_resamples, num_questions), dtype=np.int8).astype(np.float64)
+    total = sum_differences.sum()
+    flipped = np.abs(2 * (heads @ sum_differences) - total)
+    # with a little slack, as summing in another order can change the last bits
+    num_extreme = np.count_nonzero(flipped >= abs(total) - 1e-9 * (abs(total) + 1))
+    p_value = (num_extreme + 1) / (num_resamples + 1)
+    return low, high, p_value
+
+
+def resample_chunk(groups: list, seed_sequences: list, num_resamples: int, confidence: float) -> list:
+    """Resample several groups. Runs in a worker process."""
+    return [
+        resample_differences(sum_differences, num_pairs, seed_sequence, num_resamples, confidence)
+        for (sum_differences, num_pairs), seed_sequence in zip(groups, seed_sequences)
+    ]
+
+
+def resample_groups(
+    groups: list,
+    num_resamples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = None,
+    num_processes: int = None,
+    groups_per_task: int = 50,
+) -> list:
+    """(ci_low, ci_high, p_value) for many groups of (per-question sum of differences, per-question pairs).
+
+    Each group gets its own child of one SeedSequence, so the results are the same whatever the
+    number of processes. With `num_processes` 1 everything runs in this process."""
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(groups))
+    chunks = [
+        (groups[i : i + groups_per_task], seed_sequences[i : i + groups_per_task])
+        for i in range(0, len(groups), groups_per_task)
+    ]
+    if num_processes == 1 or len(chunks) <= 1:
+        return [
+            result
+            for chunk_groups, chunk_seeds in chunks
+            for result in resample_chunk(chunk_groups, chunk_seeds, num_resamples, confidence)
+        ]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [
+            executor.submit(resample_chunk, chunk_groups, chunk_seeds, num_resamples, confidence)
+            for chunk_groups, chunk_seeds in chunks
+        ]
+        return [result for future in futures for result in future.result()]
+
+
+def bias_table(
+    scored: pd.DataFrame,
+    by=("model",),
+    slots: list = None,
+    num_resamples: int = 10000,
+    confidence: float = 0.95,
+    seed: int = None,
+    num_processes: int = None,
+) -> pd.DataFrame:
+    """Paired accuracy differences per group, slot and value of scored results (see scoring.py).
+
+    `by` names columns to compare within, e.g. ["model", "specialty"]; results are always paired
+    within a model. `slots` defaults to every demographic slot on its own; add tuples of slots to
+    compare their combinations. num_baseline_only and num_variant_only count the pairs whose variant
+    did worse or better than its question's baseline accuracy. p-values come from `num_resamples`
+    sign flips, so they can't be smaller than 1 / (num_resamples + 1), and are adjusted for the number
+    of rows with Benjamini-Hochberg."""
+    pair_on = ["model", "qid"] if "model" in scored.columns else ["qid"]
+    pairs = pair_results(scored, slots, pair_on)
+    keys = [name for name in by if name in pairs.columns] + ["slot", "value"]
+
+    per_question = (
+        pairs.groupby(keys + ["qid"], observed=True)["difference"]
+        .agg(sum_differences="sum", num_pairs="size")
+        .reset_index()
+    )
+    grouped = per_question.groupby(keys, observed=True, sort=True)
+    table = pairs.groupby(keys, observed=True, sort=True).agg(
+        num_pairs=("difference", "size"),
+        num_questions=("qid", "nunique"),
+        baseline_accuracy=("baseline_accuracy", "mean"),
+        variant_accuracy=("correct", "mean"),
+        num_baseline_only=("difference", lambda d: int((d < 0).sum())),
+        num_variant_only=("difference", lambda d: int((d > 0).sum())),
+    )
+    table["difference"] = table["variant_accuracy"] - table["baseline_accuracy"]
+
+    groups = [
+        (group["sum_differences"].to_numpy(np.float64), group["num_pairs"].to_numpy(np.float64))
+        for _, group in grouped
+    ]
+    resampled = resample_groups(groups, num_resamples, confidence, seed=seed, num_processes=num_processes)
+    table["ci_low"] = [low for low, _, _ in resampled]
+    table["ci_high"] = [high for _, high, _ in resampled]
+    table["p_value"] = [p_value for _, _, p_value in resampled]
+    table["p_value_adjusted"] = (
+        multipletests(table["p_value"], method="fdr_bh")[1] if len(table) else []
+    )
+    return table
+
+
+if __name__ == "__main__":
+    from parallel_processing.scoring import score_results
+
+    parser = argparse.ArgumentParser(
+        description="Compare accuracy on demographic variants with the same questions without demographics."
+    )
+    parser.add_argument("results_path")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--by", nargs="*", default=["model"])
+    parser.add_argument(
+        "--slots", nargs="*", help='slots to compare, or combinations like "race,ses" (default: each slot)'
+    )
+    parser.add_argument("--num-resamples", type=int, default=10000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--num-processes", type=int, default=None)
+    parser.add_argument("--output", help="also save the table, e.g. to bias.csv")
+    args = parser.parse_args()
+
+    table = bias_table(
+        score_results(args.results_path, data_dir=args.data_dir),
+        by=args.by,
+        slots=[tuple(slot.split(",")) if "," in slot else slot for slot in args.slots]
+        if args.slots
+        else None,
+        num_resamples=args.num_resamples,
+        confidence=args.confidence,
+        seed=args.seed,
+        num_processes=args.num_processes,
+    )
+    print(table.to_string())
+    if args.output:
+        table.to_csv(args.output)
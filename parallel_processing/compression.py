@@ -0,0 +1,127 @@
+# compression.py
+# Compressed JSONL (and CSV) chosen by file extension: .zst or .zstd for zstd, .lz4 for lz4. Files are
+# written as a series of independent frames, one per batch of lines, so they can be appended to by later
+# runs and a frame cut short by a crash can be dropped on resume without losing the ones before it.
+import io  # for text-mode file objects
+import logging  # for logging truncated frames
+import os  # for file extensions
+
+compression_extensions = {".zst": "zstd", ".zstd": "zstd", ".lz4": "lz4"}
+frame_size = 1 << 20  # characters buffered before a writer starts a new frame on its own
+
+
+def compression_for(filename: str):
+    """The compression to use for a file, from its extension, or None for plain text."""
+    return compression_extensions.get(os.path.splitext(str(filename))[1].lower())
+
+
+def compressor_module(compression: str):
+    """Import the library for a compression only when a file needs it."""
+    try:
+        if compression == "zstd":
+            import pyzstd
+
+            return pyzstd
+        import lz4.frame
+
+        return lz4.frame
+    except ImportError as e:
+        raise ImportError(
+            f"Reading and writing {compression} files needs {'pyzstd' if compression == 'zstd' else 'lz4'}"
+        ) from e
+
+
+def compress_frame(data: bytes, compression: str) -> bytes:
+    """Compress `data` into one complete frame."""
+    return compressor_module(compression).compress(data)
+
+
+def open_text(filename: str, mode: str = "r", encoding: str = "utf-8"):
+    """Open a plain or compressed file in text mode ("r", "w" or "a").
+
+    Reading handles any number of concatenated frames. Each `open_text(..., "a")` adds at least one new
+    frame; use `FramedTextWriter` directly to control where frames end."""
+    compression = compression_for(filename)
+    if compression is None:
+        return open(filename, mode, encoding=encoding, newline="" if filename.endswith(".csv") else None)
+    if mode == "r":
+        return compressor_module(compression).open(filename, "rt", encoding=encoding)
+    return FramedTextWriter(filename, mode, compression, encoding=encoding)
+
+
+class FramedTextWriter(io.TextIOBase):
+    """Text file that buffers what is written and compresses it into one frame on every `flush`, or
+    once `frame_size` characters are waiting, so a long stream of writes doesn't build up in memory."""
+
+    def __init__(self, filename: str, mode: str, compression: str, encoding: str = "utf-8"):
+        self.compression = compression
+        self.text_encoding = encoding  # TextIOBase.encoding is read-only
+        self.raw = open(filename, mode + "b")
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, text: str) -> int:
+        self.buffer.append(text)
+        self.buffer_size += len(text)
+        if self.buffer_size >= frame_size:
+            self.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.raw.write(
+                compress_frame("".join(self.buffer).encode(self.text_encoding), self.compression)
+            )
+            self.buffer = []
+            self.buffer_size = 0
+        self.raw.flush()
+
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        if not self.closed:
+            super().close()  # flushes the last frame
+            self.raw.close()
+
+
+def iter_frame_ends(file, new_decompressor):
+    """Yield the byte offset just past each complete frame in a file, stopping at an unreadable one."""
+    decompressor = None
+    offset = 0  # bytes read so far
+    for block in iter(lambda: file.read(1 << 20), b""):
+        offset += len(block)
+        while block:
+            if decompressor is None:
+                decompressor = new_decompressor()
+            try:
+                decompressor.decompress(block)
+            except Exception as e:  # each library raises its own error type
+                logging.warning(f"Unreadable frame in {file.name}: {e}")
+                return
+            if not decompressor.eof:
+                break  # the frame continues in the next block
+            block = decompressor.unused_data or b""  # lz4 gives None when there is none
+            decompressor = None
+            yield offset - len(block)
+
+
+def truncate_partial_frame(filename: str) -> bool:
+    """Cut off a last frame left unfinished by a run that was killed mid-write. Returns whether it did."""
+    compression = compression_for(filename)
+    module = compressor_module(compression)
+    new_decompressor = (
+        module.ZstdDecompressor if compression == "zstd" else module.LZ4FrameDecompressor
+    )
+    with open(filename, "rb+") as file:
+        end_of_last_frame = 0
+        for end_of_last_frame in iter_frame_ends(file, new_decompressor):
+            pass
+        if end_of_last_frame == file.seek(0, os.SEEK_END):
+            return False
+        logging.warning(f"Truncating partial last frame of {filename} at byte {end_of_last_frame}")
+        file.truncate(end_of_last_frame)
+        return True
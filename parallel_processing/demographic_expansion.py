@@ -0,0 +1,149 @@
+# demographic_expansion.py
+# Fills the {dem-char-N} slots in the full_qa_w_placeholders vignettes with every combination (or a
+# sample of combinations) of demographic values, lazily, so large sweeps can stream into the processor:
+#   vignettes = expand_vignettes(df, {1: ["", "Black", "White"], 2: ["", "low-income"]}, {1: "race", 2: "ses"})
+#   requests = iter_chat_completion_requests(vignettes, prompt)
+import hashlib  # for remembering filled vignettes compactly
+import itertools  # for the full product of slot values
+import logging  # for logging slots without values
+import math  # for counting combinations
+import random  # for sampling combinations
+import re  # for finding placeholder slots
+import pandas as pd  # for substituting values across a column at once
+
+placeholder_pattern = re.compile(r"\{dem-char-(\d+)\}")
+
+
+def placeholder(slot: int) -> str:
+    return f"{{dem-char-{slot}}}"
+
+
+def iter_combinations(value_lists: list, sample_size: int = None, seed: int = None):
+    """Yield tuples of one value from each list: all of them, or `sample_size` drawn without replacement.
+
+    Samples are drawn as indices into the product and decoded digit by digit, so the product is never
+    built. Either way the tuples come out in itertools.product order."""
+    num_combinations = math.prod(len(values) for values in value_lists)
+    if sample_size is None or sample_size >= num_combinations:
+        yield from itertools.product(*value_lists)
+        return
+    rng = random.Random(seed)
+    for index in sorted(rng.sample(range(num_combinations), sample_size)):
+        combination = []
+        for values in reversed(value_lists):
+            index, digit = divmod(index, len(values))
+            combination.append(values[digit])
+        yield tuple(reversed(combination))
+
+
+def fill_slots(vignettes: pd.Series, slots: tuple, values: tuple) -> pd.Series:
+    """Substitute one value per slot into every vignette in the series.
+
+    An empty value removes the placeholder along with a space next to it, so "a {dem-char-1} boy"
+    becomes "a boy" rather than "a  boy"."""
+    for slot, value in zip(slots, values):
+        if value:
+            vignettes = vignettes.str.replace(placeholder(slot), value, regex=False)
+        else:
+            vignettes = vignettes.str.replace(" " + placeholder(slot), "", regex=False)
+            vignettes = vignettes.str.replace(placeholder(slot) + " ", "", regex=False)  # at the start
+            vignettes = vignettes.str.replace(placeholder(slot), "", regex=False)
+    return vignettes
+
+
+def group_by_slots(df: pd.DataFrame, column: str) -> dict:
+    """Row positions of the vignettes in `column`, grouped by the tuple of slots each one contains."""
+    slots_per_row = df[column].astype(str).str.findall(placeholder_pattern).map(
+        lambda slots: tuple(sorted({int(slot) for slot in slots}))
+    )
+    slots_per_row = slots_per_row.reset_index(drop=True)  # labels may repeat across concatenated files
+    return slots_per_row.groupby(slots_per_row).indices
+
+
+def slot_value_lists(slots: tuple, slot_values: dict) -> list:
+    """The distinct values for each slot, in order. A slot without values is left empty."""
+    value_lists = []
+    for slot in slots:
+        values = slot_values.get(slot)
+        if not values:
+            logging.debug(f"No values for {placeholder(slot)}, leaving it empty")
+            values = [""]
+        value_lists.append(list(dict.fromkeys(values)))  # identical values would give identical fills
+    return value_lists
+
+
+def count_variants(
+    df: pd.DataFrame,
+    slot_values: dict,
+    column: str = "full_qa_w_placeholders",
+    sample_size: int = None,
+    seed: int = None,
+) -> int:
+    """How many vignettes `expand_vignettes` will yield for the same arguments.
+
+    Combinations that fill a vignette with the same text are only found by filling it, so this takes
+    about as long as the expansion; it is at most `max_variants`."""
+    return sum(
+        1 for _ in expand_vignettes(df, slot_values, column=column, sample_size=sample_size, seed=seed)
+    )
+
+
+def max_variants(
+    df: pd.DataFrame,
+    slot_values: dict,
+    column: str = "full_qa_w_placeholders",
+    sample_size: int = None,
+) -> int:
+    """How many combinations `expand_vignettes` will fill in, before leaving out repeated texts."""
+    num_variants = 0
+    for slots, positions in group_by_slots(df, column).items():
+        num_combinations = math.prod(len(values) for values in slot_value_lists(slots, slot_values))
+        if sample_size is not None:
+            num_combinations = min(num_combinations, sample_size)
+        num_variants += num_combinations * len(positions)
+    return num_variants
+
+
+def expand_vignettes(
+    df: pd.DataFrame,
+    slot_values: dict,
+    slot_names: dict = None,
+    column: str = "full_qa_w_placeholders",
+    metadata_columns: tuple = ("qid",),
+    sample_size: int = None,
+    seed: int = None,
+):
+    """Lazily yield (vignette, metadata) for each combination of demographic values in each vignette.
+
+    `slot_values` maps a slot number N to the values for {dem-char-N}; `slot_names` optionally names the
+    slots (e.g. {1: "race"}) in the metadata, which holds the row's `metadata_columns` and a
+    "demographics" dict of the values used. Only the slots a vignette actually contains are varied, and
+    a combination that fills a vignette with the same text as an earlier one, such as ("", "Black") and
+    ("Black", "") in two adjacent slots, is left out, so it never yields the same text twice. With
+    `sample_size`, that many combinations are drawn per group of vignettes with the same slots, and
+    every vignette in the group gets the same ones, so results stay paired across questions.
+
+    Each combination is substituted into all the vignettes of a group at once, and only one filled
+    column is held in memory at a time, along with a short digest of each text already yielded."""
+    slot_names = slot_names or {}
+    metadata_columns = [name for name in metadata_columns if name in df.columns]
+    for slots, positions in group_by_slots(df, column).items():
+        rows = df.iloc[positions]
+        vignettes = rows[column].astype(str)
+        row_metadata = rows[metadata_columns].to_dict("records")
+        seen = [set() for _ in positions]  # digests of the texts yielded for each vignette
+        for values in iter_combinations(
+            slot_value_lists(slots, slot_values), sample_size=sample_size, seed=seed
+        ):
+            demographics = {
+                slot_names.get(slot, placeholder(slot)): value
+                for slot, value in zip(slots, values)
+            }
+            for vignette, metadata, row_seen in zip(
+                fill_slots(vignettes, slots, values), row_metadata, seen
+            ):
+                digest = hashlib.blake2b(vignette.encode(), digest_size=16).digest()
+                if digest in row_seen:
+                    continue
+                row_seen.add(digest)
+                yield vignette, dict(metadata, demographics=demographics)
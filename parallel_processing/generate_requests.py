@@ -1,5 +1,6 @@
 import json
 import os
+from parallel_processing.compression import open_text
 from parallel_processing.prompts import v1_system_message, v1_prompt_message
 from dotenv import load_dotenv
 
@@ -14,33 +15,84 @@ top_p = float(os.getenv("TOP_P", "0"))
 n = int(os.getenv("N", "1"))
 
 
-def generate_chat_completion_requests(
-    filename,
+def build_chat_completion_request(
+    x,
+    prompt,
+    model_name=os.getenv("MODEL_NAME", "gpt-3.5-turbo"),
+    metadata=None,
+):
+    """Build the request body for one question. `metadata` is saved with its result."""
+    # Concatenate metaprompt and mcq data for each request
+    user_message = f"{prompt}\n'{x}'"
+
+    # Construct the request body with additional parameters
+    request_body = {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": v1_system_message},
+            {"role": "user", "content": user_message},
+        ],
+        "frequency_penalty": frequency_penalty,
+        "max_tokens": max_tokens,
+        "presence_penalty": presence_penalty,
+        "temperature": temperature,
+        "top_p": top_p,
+        "n": n
+        # Add other parameters as needed
+    }
+    if metadata is not None:
+        request_body["metadata"] = metadata
+    return request_body
+
+
+def iter_chat_completion_requests(
     data,
     prompt,
     model_name=os.getenv("MODEL_NAME", "gpt-3.5-turbo"),
+    audit_filename=None,
 ):
-    with open(filename, "w") as f:
+    """Lazily build one chat completion request per item of `data`, e.g. a DataFrame column.
+
+    Items may also be (question, metadata) pairs, as yielded by demographic_expansion.expand_vignettes.
+    Pass the generator straight to process_api_requests_from_file(requests=...). If `audit_filename`
+    is set, each request is also appended to that JSONL file as it is yielded.
+
+    `model_name` may be a list, or a comma-separated string like "gpt-4,gpt-3.5-turbo", to send every
+    question to each model in turn; each request's metadata then says which model it is for."""
+    model_names = model_name.split(",") if isinstance(model_name, str) else list(model_name)
+    audit_file = open_text(audit_filename, "w") if audit_filename else None
+    try:
         for x in data:
-            # Concatenate metaprompt and mcq data for each request
-            user_message = f"{v1_instruction_only_with_cot}\n'{x}'"
-
-            # Construct the request body with additional parameters
-            request_body = {
-                "model": model_name,
-                "messages": [
-                    {"role": "system", "content": v1_system_message},
-                    {"role": "user", "content": user_message},
-                ],
-                "frequency_penalty": frequency_penalty,
-                "max_tokens": max_tokens,
-                "presence_penalty": presence_penalty,
-                "temperature": temperature,
-                "top_p": top_p,
-                "n": n
-                # Add other parameters as needed
-            }
+            metadata = None
+            if isinstance(x, tuple):
+                x, metadata = x
+            for name in model_names:
+                request_body = build_chat_completion_request(
+                    x,
+                    prompt,
+                    model_name=name.strip(),
+                    metadata=(
+                        dict(metadata or {}, model=name.strip())
+                        if len(model_names) > 1
+                        else metadata
+                    ),
+                )
+                if audit_file is not None:
+                    audit_file.write(json.dumps(request_body) + "\n")
+                yield request_body
+    finally:
+        if audit_file is not None:
+            audit_file.close()
+
 
+def generate_chat_completion_requests(
+    filename,
+    data,
+    prompt,
+    model_name=os.getenv("MODEL_NAME", "gpt-3.5-turbo"),
+):
+    with open_text(filename, "w") as f:
+        for request_body in iter_chat_completion_requests(data, prompt, model_name=model_name):
             # Write the request body to the JSONL file
             json_string = json.dumps(request_body)
             f.write(json_string + "\n")
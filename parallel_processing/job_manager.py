@@ -0,0 +1,459 @@
+# job_manager.py
+# Runs batch jobs outside the Streamlit process. Jobs are rows in a SQLite file: the app submits a job and
+# reads its status and progress back by id, and a separate worker process claims queued jobs, running up
+# to MAX_CONCURRENT_JOBS at once, each in its own process. A job's progress is a snapshot of its
+# StatusTracker (see telemetry.py), saved every few seconds, so a page rerun or a reconnecting browser just
+# reads the latest one. Cancelling a job stops its requests in flight and keeps the results written so far.
+#   job_id = JobStore().submit(questions, prompt, model_name="gpt-4")
+#   start_worker()  # unless one is already running
+#   JobStore().get(job_id)["progress"]
+# The worker can also be run by hand:
+#   python -m parallel_processing.job_manager worker
+import argparse  # for reading options from the command line
+import asyncio  # for running a job's requests
+import json  # for storing job parameters and progress
+import logging  # for logging job failures
+import multiprocessing  # for running each job in its own process
+import os  # for reading configuration and checking processes
+import sqlite3  # for the job table
+import subprocess  # for starting the worker outside the app
+import sys  # for starting the worker with the same interpreter
+import time  # for timestamps and polling
+import traceback  # for saving why a job failed
+from dotenv import load_dotenv
+from parallel_processing.telemetry import metrics_snapshot
+
+load_dotenv()
+
+jobs_db_filepath = os.getenv("JOBS_DB_PATH", "outputs/jobs.sqlite")
+jobs_dirname = os.getenv("JOBS_DIR", "outputs/jobs")
+max_concurrent_jobs = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+job_progress_seconds = float(os.getenv("JOB_PROGRESS_SECONDS", "2"))
+
+job_statuses = ("queued", "running", "completed", "failed", "cancelled")
+finished_statuses = ("completed", "failed", "cancelled")
+worker_heartbeat_seconds = 5  # how often the worker says it is alive
+worker_poll_seconds = 1  # how often the worker looks for new jobs and cancellations
+
+
+# everything but the params, which only the job's own process needs
+job_columns = (
+    "id, status, num_requests, progress, error, cancel_requested, pid, results_filepath, output_filepath, "
+    "aggregates_filepath, created_at, started_at, finished_at"
+)
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # it exists, but belongs to someone else
+    return True
+
+
+class JobStore:
+    """The job table. Safe to use from any number of processes at once; each opens its own connection.
+
+    Each job is a dict with its `id`, `status` (one of job_statuses), `num_requests`, the latest
+    `progress` snapshot, `error` if it failed, the paths of its `results_filepath`, `output_filepath`
+    and `aggregates_filepath`, and created, started and finished times. The `params` it was submitted
+    with are read separately by `get_params`, and its data is kept in a file next to its results, so
+    polling a job never reads either."""
+
+    def __init__(self, filename: str = None):
+        self.filename = filename or jobs_db_filepath
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self.connection = sqlite3.connect(self.filename, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                num_requests INTEGER,
+                progress TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                pid INTEGER,
+                results_filepath TEXT,
+                output_filepath TEXT,
+                aggregates_filepath TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )"""
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, heartbeat_at REAL NOT NULL)"
+        )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, data: list, prompt: str, model_name: str = None, dirname: str = None, **kwargs) -> int:
+        """Queue a job that sends every item of `data` to each model; returns its id.
+
+        Items are questions, or [question, metadata] pairs like those of
+        demographic_expansion.expand_vignettes. `model_name` may list several models, comma-separated
+        (see generate_requests.py). The job's files go in `dirname`/<id>. Other `kwargs` are passed on
+        to process_api_requests_from_file, overriding the settings from the environment."""
+        model_name = model_name or os.getenv("MODEL_NAME", "gpt-3.5-turbo")
+        # the row isn't visible to workers until the data file is written and the transaction commits
+        with self.connection:
+            job_id = self.connection.execute(
+                "INSERT INTO jobs (status, params, created_at) VALUES ('queued', '{}', ?)", (time.time(),)
+            ).lastrowid
+            job_dirname = os.path.join(dirname or jobs_dirname, str(job_id))
+            data_filepath = os.path.join(job_dirname, "data.jsonl")
+            os.makedirs(job_dirname, exist_ok=True)
+            num_items = 0
+            with open(data_filepath, "w") as f:
+                for x in data:
+                    f.write(json.dumps(list(x) if isinstance(x, tuple) else x) + "\n")
+                    num_items += 1
+            params = dict(
+                data_filepath=data_filepath,
+                prompt=prompt,
+                model_name=model_name,
+                processor_kwargs=kwargs,
+            )
+            self.connection.execute(
+                """UPDATE jobs SET params = ?, num_requests = ?, results_filepath = ?, output_filepath = ?,
+                aggregates_filepath = ? WHERE id = ?""",
+                (
+                    json.dumps(params),
+                    num_items * len(model_name.split(",")),
+                    os.path.join(job_dirname, "results.jsonl"),
+                    os.path.join(job_dirname, "output.csv"),
+                    os.path.join(job_dirname, "aggregates.sqlite"),
+                    job_id,
+                ),
+            )
+        return job_id
+
+    def get(self, job_id: int):
+        """The job with this id as a dict, or None if there is none."""
+        row = self.connection.execute(
+            f"SELECT {job_columns} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return job_from_row(row) if row is not None else None
+
+    def get_params(self, job_id: int) -> dict:
+        """What the job was submitted with: `data_filepath`, `prompt`, `model_name` and `processor_kwargs`."""
+        (params,) = self.connection.execute("SELECT params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(params)
+
+    def list_jobs(self, statuses=None, limit: int = 100) -> list:
+        """The most recent jobs first, optionally only those with one of `statuses`."""
+        statuses = statuses or job_statuses
+        rows = self.connection.execute(
+            f"""SELECT {job_columns} FROM jobs WHERE status IN ({', '.join('?' * len(statuses))})
+            ORDER BY id DESC LIMIT ?""",
+            (*statuses, limit),
+        ).fetchall()
+        return [job_from_row(row) for row in rows]
+
+    def has_unfinished_jobs(self) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM jobs WHERE status IN ('queued', 'running') LIMIT 1"
+        ).fetchone()
+        return row is not None
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a queued job, or ask a running one to stop. Returns whether the job was unfinished."""
+        with self.connection:
+            num_changed = self.connection.execute(
+                """UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ?
+                WHERE id = ? AND status = 'queued'""",
+                (time.time(), job_id),
+            ).rowcount
+            num_changed += self.connection.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,)
+            ).rowcount
+        return num_changed > 0
+
+    def is_cancel_requested(self, job_id: int) -> bool:
+        row = self.connection.execute(
+            "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def claim_next(self, pid: int, max_running: int):
+        """Mark the oldest queued job as running, unless `max_running` jobs already are. Returns it or None.
+
+        The check and the claim are one write transaction, so several workers never run too many jobs."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            (num_running,) = self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running'"
+            ).fetchone()
+            row = None
+            if num_running < max_running:
+                row = self.connection.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'running', pid = ?, started_at = ? WHERE id = ?",
+                    (pid, time.time(), row["id"]),
+                )
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return self.get(row["id"]) if row is not None else None
+
+    def set_pid(self, job_id: int, pid: int) -> None:
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET pid = ? WHERE id = ?", (pid, job_id))
+
+    def save_progress(self, job_id: int, progress: dict) -> None:
+        with self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id)
+            )
+
+    def finish(self, job_id: int, status: str, error: str = None) -> None:
+        """Record how a running job ended, unless it already has."""
+        with self.connection:
+            self.connection.execute(
+                """UPDATE jobs SET status = ?, error = ?, finished_at = ?
+                WHERE id = ? AND finished_at IS NULL""",
+                (status, error, time.time(), job_id),
+            )
+
+    def fail_orphaned_jobs(self) -> None:
+        """Mark running jobs whose process is gone, e.g. after a crash or reboot, as failed."""
+        for job in self.list_jobs(statuses=("running",), limit=-1):
+            if job["pid"] is None or not is_process_alive(job["pid"]):
+                self.finish(job["id"], "failed", "The job's process exited before it finished")
+
+    def heartbeat(self, pid: int) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO workers (pid, heartbeat_at) VALUES (?, ?)", (pid, time.time())
+            )
+
+    def remove_worker(self, pid: int) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+
+    def has_live_worker(self) -> bool:
+        """Whether a worker has sent a heartbeat recently and its process is still there."""
+        rows = self.connection.execute(
+            "SELECT pid FROM workers WHERE heartbeat_at > ?",
+            (time.time() - 3 * worker_heartbeat_seconds,),
+        ).fetchall()
+        return any(is_process_alive(pid) for (pid,) in rows)
+
+
+def job_from_row(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    job["progress"] = json.loads(job["progress"]) if job["progress"] else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+def job_fraction_done(job: dict) -> float:
+    """How much of a job is done, from 0 to 1, going by its latest progress snapshot."""
+    if job["status"] == "completed":
+        return 1.0
+    progress = job["progress"] or {}
+    num_done = progress.get("num_tasks_succeeded", 0) + progress.get("num_tasks_failed", 0)
+    return min(num_done / job["num_requests"], 1.0) if job["num_requests"] else 0.0
+
+
+def iter_job_data(data_filepath: str):
+    """The items a job was submitted with, read one line at a time."""
+    with open(data_filepath) as f:
+        for line in f:
+            x = json.loads(line)
+            yield tuple(x) if isinstance(x, list) else x
+
+
+async def process_job(job: dict, store: JobStore) -> str:
+    """Send a job's requests, saving progress as it goes. Returns "completed" or "cancelled"."""
+    from parallel_processing import api_request_parallel_processor as processor
+    from parallel_processing.generate_requests import iter_chat_completion_requests
+
+    params = store.get_params(job["id"])
+    status_tracker = processor.StatusTracker()
+    kwargs = dict(
+        request_url=processor.request_url,
+        api_key=processor.api_key,
+        max_requests_per_minute=processor.max_requests_per_minute,
+        max_tokens_per_minute=processor.max_tokens_per_minute,
+        token_encoding_name=processor.token_encoding_name,
+        max_attempts=processor.max_attempts,
+        logging_level=processor.logging_level,
+        learn_completion_budgets=processor.learn_completion_budgets,
+        completion_budget_percentile=processor.completion_budget_percentile,
+        response_cache_filepath=processor.response_cache_filepath,
+        max_requests_in_flight=processor.max_requests_in_flight,
+        request_timeout_seconds=processor.request_timeout_seconds,
+        connect_timeout_seconds=processor.connect_timeout_seconds,
+        model_rate_limits=processor.model_rate_limits,
+        aggregates_filepath=job["aggregates_filepath"],
+        endpoints=(
+            processor.load_endpoints(processor.endpoints_filepath)
+            if processor.endpoints_filepath
+            else None
+        ),
+    )
+    kwargs.update(params["processor_kwargs"])
+    run = asyncio.create_task(
+        processor.process_api_requests_from_file(
+            requests_filepath=None,
+            save_filepath=job["results_filepath"],
+            requests=iter_chat_completion_requests(
+                iter_job_data(params["data_filepath"]), params["prompt"], model_name=params["model_name"]
+            ),
+            status_tracker=status_tracker,
+            resume=True,  # a job restarted by hand picks up where it stopped
+            **kwargs,
+        )
+    )
+    cancelled = False
+    while not run.done():
+        await asyncio.wait([run], timeout=job_progress_seconds)
+        # quick local writes, made on the loop since the connection belongs to this thread
+        store.save_progress(job["id"], metrics_snapshot(status_tracker))
+        if not run.done() and store.is_cancel_requested(job["id"]):
+            run.cancel()
+            cancelled = True
+    try:
+        await run
+    except asyncio.CancelledError:
+        if not cancelled:
+            raise
+    store.save_progress(job["id"], metrics_snapshot(status_tracker))
+    return "cancelled" if cancelled else "completed"
+
+
+def run_job(job_id: int, db_filepath: str) -> None:
+    """Run one claimed job to the end and record how it went. Runs in the job's own process."""
+    from parallel_processing.save_generated_data_to_csv import save_generated_data
+
+    with JobStore(db_filepath) as store:
+        store.set_pid(job_id, os.getpid())
+        job = store.get(job_id)
+        try:
+            os.makedirs(os.path.dirname(job["results_filepath"]), exist_ok=True)
+            status = asyncio.run(process_job(job, store))
+            if os.path.exists(job["results_filepath"]):
+                save_generated_data(job["results_filepath"], job["output_filepath"])
+            store.finish(job_id, status)
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            store.finish(job_id, "failed", "".join(traceback.format_exception(e)))
+
+
+def run_worker(db_filepath: str = None, max_jobs: int = None, idle_exit_seconds: float = None) -> None:
+    """Start queued jobs as others finish, at most `max_jobs` at once, and pass on cancellations.
+
+    With `idle_exit_seconds`, stop after that long with nothing queued or running, so a worker
+    started by the app doesn't outlive it forever; the next submission starts another."""
+    db_filepath = db_filepath or jobs_db_filepath
+    max_jobs = max_jobs or max_concurrent_jobs
+    pid = os.getpid()
+    processes = {}  # job id -> the process running it
+    # spawned rather than forked, so jobs start clean instead of sharing this process's connection
+    context = multiprocessing.get_context("spawn")
+    with JobStore(db_filepath) as store:
+        store.fail_orphaned_jobs()
+        last_heartbeat_time = 0
+        idle_since = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() - last_heartbeat_time >= worker_heartbeat_seconds:
+                    store.heartbeat(pid)
+                    last_heartbeat_time = time.monotonic()
+
+                # forget jobs that finished; any still marked running died without saying so
+                for job_id, process in list(processes.items()):
+                    if not process.is_alive():
+                        process.join()
+                        store.finish(
+                            job_id, "failed", f"The job's process exited with code {process.exitcode}"
+                        )
+                        del processes[job_id]
+
+                while True:
+                    job = store.claim_next(pid, max_jobs)
+                    if job is None:
+                        break
+                    logging.info(f"Starting job {job['id']}")
+                    process = context.Process(target=run_job, args=(job["id"], db_filepath))
+                    process.start()
+                    processes[job["id"]] = process
+
+                if processes or store.has_unfinished_jobs():
+                    idle_since = time.monotonic()
+                elif idle_exit_seconds is not None and time.monotonic() - idle_since > idle_exit_seconds:
+                    logging.info("No jobs left; worker exiting")
+                    break
+                time.sleep(worker_poll_seconds)
+        finally:
+            store.remove_worker(pid)
+
+
+def start_worker(db_filepath: str = None, idle_exit_seconds: float = 300) -> bool:
+    """Start a worker in the background unless one is running. Returns whether it started one.
+
+    The worker is its own session, so it keeps running if the app that started it restarts."""
+    db_filepath = db_filepath or jobs_db_filepath
+    with JobStore(db_filepath) as store:
+        if store.has_live_worker():
+            return False
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "parallel_processing.job_manager",
+                "worker",
+                "--db",
+                db_filepath,
+                "--idle-exit-seconds",
+                str(idle_exit_seconds),
+            ],
+            start_new_session=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        store.heartbeat(process.pid)  # so a rerun right after this doesn't start another
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run or inspect batch jobs.")
+    parser.add_argument("command", choices=["worker", "list", "cancel"])
+    parser.add_argument("job_ids", nargs="*", type=int)
+    parser.add_argument("--db", default=jobs_db_filepath)
+    parser.add_argument("--max-jobs", type=int, default=max_concurrent_jobs)
+    parser.add_argument("--idle-exit-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        logging.basicConfig(level=logging.INFO)
+        run_worker(args.db, args.max_jobs, args.idle_exit_seconds)
+    elif args.command == "list":
+        with JobStore(args.db) as store:
+            for job in store.list_jobs():
+                print(
+                    f"{job['id']:>6}  {job['status']:<10} {job_fraction_done(job):>5.0%}  "
+                    f"{job['num_requests']} requests  {job['output_filepath']}"
+                )
+    else:
+        with JobStore(args.db) as store:
+            for job_id in args.job_ids:
+                print(f"Job {job_id}: {'cancelling' if store.cancel(job_id) else 'already finished'}")
@@ -2,7 +2,7 @@
 import asyncio
 import os
 from parallel_processing.api_request_parallel_processor import process_api_requests_from_file
-from parallel_processing.generate_requests import generate_chat_completion_requests
+from parallel_processing.generate_requests import iter_chat_completion_requests
 from parallel_processing.save_generated_data_to_csv import save_generated_data_to_csv
 from parallel_processing.prompts import v1_system_message, v1_prompt_message
 from dotenv import load_dotenv
@@ -14,12 +14,13 @@ logging.basicConfig(filename='parallel_processing.log', level=logging.INFO, form
 
 async def process_data(requests_file_path, results_file_path, output_file_path, data, prompt, model_name):
     try:
-        # Generate chat completion requests
-        generate_chat_completion_requests(request_file_path, data, model_name=model_name)
+        # Stream chat completion requests straight to the processor; the requests file, if any, is only a record
+        requests = iter_chat_completion_requests(data, prompt, model_name=model_name, audit_filename=requests_file_path or None)
 
         # Process api requests
         await process_api_requests_from_file(
                 requests_filepath=requests_file_path,
+                requests=requests,
                 save_filepath=results_file_path,
                 request_url=os.getenv("API_REQUEST_URL"),
                 api_key=os.getenv("OPENAI_API_KEY"),
@@ -30,8 +31,8 @@ async def process_data(requests_file_path, results_file_path, output_file_path,
                 logging_level=int(os.getenv("LOGGING_LEVEL")),
             )
         # Save generated data to csv
-        save_generated_data_to_csv(result_file_path, output_file_path)
-        logging.info(f"Generation of API requests completed successfully for: {request_file_path}")
+        save_generated_data_to_csv(results_file_path, output_file_path)
+        logging.info(f"Generation of API requests completed successfully for: {results_file_path}")
     except Exception as e:
         logging.error(f"An error occurred during request generation: {e}")
         raise
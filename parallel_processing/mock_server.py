@@ -0,0 +1,232 @@
+# mock_server.py
+# A local stand-in for the OpenAI chat completions and embeddings APIs that enforces its own rate
+# limits, with configurable latency and error rates, so the processor can be exercised offline, e.g.:
+#   python -m parallel_processing.mock_server --port 8080 --max-requests-per-minute 60
+# and then point API_REQUEST_URL at http://localhost:8080/v1/chat/completions
+import argparse  # for reading server settings from the command line
+import asyncio  # for simulating response latency
+import random  # for sampling latency, injecting errors and picking answers
+import time  # for refilling the server-side buckets
+from aiohttp import web  # for serving HTTP requests
+
+from parallel_processing.api_request_parallel_processor import TokenBucket
+
+
+def approximate_num_tokens(text: str) -> int:
+    """Roughly four characters per token, which is close enough for a mock."""
+    return max(len(text) // 4, 1)
+
+
+def rate_limit_headers(request_bucket: TokenBucket, token_bucket: TokenBucket) -> dict:
+    """Build x-ratelimit-* headers in the same format as the OpenAI API."""
+    headers = {}
+    for bucket, kind in ((request_bucket, "requests"), (token_bucket, "tokens")):
+        remaining = max(int(bucket.available), 0)
+        seconds_to_reset = (bucket.capacity - remaining) * 60.0 / bucket.capacity
+        headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+        headers[f"x-ratelimit-remaining-{kind}"] = str(remaining)
+        headers[f"x-ratelimit-reset-{kind}"] = f"{seconds_to_reset:.3f}s"
+    return headers
+
+
+latency_distributions = ("constant", "uniform", "exponential", "lognormal")
+
+
+def sample_latency(distribution: str, seconds_of_latency: float, latency_sigma: float) -> float:
+    """Draw a response latency. `seconds_of_latency` is the mean, except for lognormal where it is the median."""
+    if distribution == "constant":
+        return seconds_of_latency
+    if distribution == "uniform":
+        return random.uniform(0, 2 * seconds_of_latency)
+    if distribution == "exponential":
+        return random.expovariate(1 / seconds_of_latency) if seconds_of_latency else 0
+    if distribution == "lognormal":
+        return seconds_of_latency * random.lognormvariate(0, latency_sigma)
+    raise ValueError(
+        f'Expecting latency distribution to be one of {latency_distributions}, got "{distribution}"'
+    )
+
+
+def rate_limit_error(kind: str, headers: dict, seconds_to_retry_after: float) -> web.Response:
+    """A 429 response shaped like the OpenAI API's."""
+    headers = dict(headers, **{"retry-after": f"{max(seconds_to_retry_after, 0.001):.3f}"})
+    return web.json_response(
+        {
+            "error": {
+                "message": f"Rate limit reached for {kind}. Please try again in {seconds_to_retry_after:.3f}s.",
+                "type": kind,
+                "param": None,
+                "code": "rate_limit_exceeded",
+            }
+        },
+        status=429,
+        headers=headers,
+    )
+
+
+def server_error(headers: dict) -> web.Response:
+    return web.json_response(
+        {
+            "error": {
+                "message": "The server had an error while processing your request.",
+                "type": "server_error",
+                "param": None,
+                "code": None,
+            }
+        },
+        status=500,
+        headers=headers,
+    )
+
+
+def make_app(
+    max_requests_per_minute: float = 500,
+    max_tokens_per_minute: float = 60000,
+    rate_limit_error_rate: float = 0.0,
+    server_error_rate: float = 0.0,
+    seconds_of_latency: float = 0.05,
+    latency_distribution: str = "constant",
+    latency_sigma: float = 0.5,
+) -> web.Application:
+    """Create the mock API application.
+
+    Requests over the server's own limits get a 429, as do `rate_limit_error_rate` of the rest, and
+    `server_error_rate` of the requests that are let through fail with a 500 after the usual latency.
+    Like the real API, a request is charged its prompt tokens plus n * max_tokens."""
+    request_bucket = TokenBucket(capacity=max_requests_per_minute)
+    token_bucket = TokenBucket(capacity=max_tokens_per_minute)
+
+    async def charge(num_tokens: int):
+        """Charge a request against the server-side limits and simulate its latency.
+
+        Returns the rate limit headers, or an error response to send instead."""
+        current_time = time.monotonic()
+        request_bucket.refill(current_time)
+        token_bucket.refill(current_time)
+        for bucket, amount, kind in (
+            (request_bucket, 1, "requests"),
+            (token_bucket, num_tokens, "tokens"),
+        ):
+            seconds_to_wait = bucket.seconds_until_available(amount)
+            if seconds_to_wait > 0:
+                return rate_limit_error(
+                    kind, rate_limit_headers(request_bucket, token_bucket), seconds_to_wait
+                )
+        if random.random() < rate_limit_error_rate:
+            return rate_limit_error(
+                "requests", rate_limit_headers(request_bucket, token_bucket), 1.0
+            )
+        request_bucket.consume(1)
+        token_bucket.consume(num_tokens)
+        headers = rate_limit_headers(request_bucket, token_bucket)
+
+        await asyncio.sleep(
+            sample_latency(latency_distribution, seconds_of_latency, latency_sigma)
+        )
+        if random.random() < server_error_rate:
+            return server_error(headers)
+        return headers
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        request_json = await request.json()
+        prompt_tokens = sum(
+            approximate_num_tokens(message.get("content") or "")
+            for message in request_json.get("messages", [])
+        )
+        headers = await charge(
+            prompt_tokens
+            + request_json.get("n", 1) * request_json.get("max_tokens", 15)
+        )
+        if isinstance(headers, web.Response):
+            return headers
+
+        choices = []
+        completion_tokens = 0
+        for index in range(request_json.get("n", 1)):
+            content = f"The correct answer is {random.choice('ABCDE')}."
+            completion_tokens += approximate_num_tokens(content)
+            choices.append(
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            )
+        return web.json_response(
+            {
+                "id": f"chatcmpl-mock-{random.getrandbits(32):08x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request_json.get("model"),
+                "choices": choices,
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+            headers=headers,
+        )
+
+    async def embeddings(request: web.Request) -> web.Response:
+        request_json = await request.json()
+        inputs = request_json["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        prompt_tokens = sum(approximate_num_tokens(text) for text in inputs)
+        headers = await charge(prompt_tokens)
+        if isinstance(headers, web.Response):
+            return headers
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": [random.uniform(-1, 1) for _ in range(8)],
+                    }
+                    for index in range(len(inputs))
+                ],
+                "model": request_json.get("model"),
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            },
+            headers=headers,
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    return app
+
+
+def run_mock_server(port: int, **app_kwargs) -> None:
+    """Serve the mock API until the process is stopped, e.g. as a multiprocessing target."""
+    web.run_app(make_app(**app_kwargs), port=port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a rate-limited mock OpenAI API.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-requests-per-minute", type=float, default=500)
+    parser.add_argument("--max-tokens-per-minute", type=float, default=60000)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--seconds-of-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--latency-distribution", choices=latency_distributions, default="constant"
+    )
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    args = parser.parse_args()
+    web.run_app(
+        make_app(
+            max_requests_per_minute=args.max_requests_per_minute,
+            max_tokens_per_minute=args.max_tokens_per_minute,
+            rate_limit_error_rate=args.rate_limit_error_rate,
+            server_error_rate=args.server_error_rate,
+            seconds_of_latency=args.seconds_of_latency,
+            latency_distribution=args.latency_distribution,
+            latency_sigma=args.latency_sigma,
+        ),
+        port=args.port,
+    )
@@ -0,0 +1,349 @@
+# multiprocess_runner.py
+# Runs process_api_requests_from_file in several processes, so parsing, tokenizing and decoding responses
+# are spread over cores. Process i sends the requests on lines i, i + N, i + 2N, ... of the requests file
+# and saves them to <results file>.shard<i>. Every process draws on the same per-minute budgets, kept in
+# shared memory, so together they stay within the account's limits. When all are done, the shards are
+# merged into the results file in requests-file order, e.g.:
+#   NUM_PROCESSES=4 python -m parallel_processing.multiprocess_runner
+import asyncio  # for running each shard's event loop
+import collections  # for matching results to request lines
+import contextlib  # for locking the shared buckets
+import dataclasses  # for combining the shards' status trackers
+import itertools  # for picking every Nth line
+import json  # for parsing requests and results
+import logging  # for logging progress
+import multiprocessing  # for the worker processes and the shared budgets
+import os  # for reading configuration and removing shards
+import time  # for refilling the shared buckets
+from dotenv import load_dotenv
+from parallel_processing.aggregates import merge_aggregates
+from parallel_processing.api_request_parallel_processor import (
+    Endpoint,
+    RateLimiter,
+    StatusTracker,
+    TokenBucket,
+    process_api_requests_from_file,
+    request_key,
+)
+from parallel_processing.compression import open_text
+from parallel_processing.request_store import MappedRequestsFile, open_requests
+from parallel_processing.telemetry import Histogram
+
+load_dotenv()
+
+num_processes = int(os.getenv("NUM_PROCESSES", "0")) or None
+
+shard_endpoints = None  # set in each worker process by `init_worker`
+
+
+class SharedTokenBucket:
+    """A TokenBucket whose state is in shared memory, so several processes draw on one budget.
+
+    Each operation locks the state, applies TokenBucket's own logic to it, and writes it back."""
+
+    def __init__(self, capacity: float):
+        self.state = multiprocessing.RawArray("d", [capacity, capacity, time.monotonic()])
+        self.lock = multiprocessing.Lock()
+
+    @contextlib.contextmanager
+    def bucket(self):
+        with self.lock:
+            bucket = TokenBucket(
+                capacity=self.state[0], available=self.state[1], last_update_time=self.state[2]
+            )
+            yield bucket
+            self.state[:] = [bucket.capacity, bucket.available, bucket.last_update_time]
+
+    @property
+    def capacity(self) -> float:
+        return self.state[0]
+
+    @capacity.setter
+    def capacity(self, capacity: float) -> None:
+        with self.lock:
+            self.state[0] = capacity
+
+    @property
+    def available(self) -> float:
+        return self.state[1]
+
+    @available.setter
+    def available(self, available: float) -> None:
+        with self.lock:
+            self.state[1] = available
+
+    def refill(self, current_time: float) -> None:
+        with self.bucket() as bucket:
+            bucket.refill(current_time)
+
+    def seconds_until_available(self, amount: float) -> float:
+        with self.bucket() as bucket:
+            return bucket.seconds_until_available(amount)
+
+    def consume(self, amount: float) -> None:
+        with self.bucket() as bucket:
+            bucket.consume(amount)
+
+    def refund(self, amount: float) -> None:
+        with self.bucket() as bucket:
+            bucket.refund(amount)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter over shared buckets. Create it before starting the processes that share it.
+
+    Checking for capacity and consuming it are separate steps, so two processes can both take the last
+    of it; the buckets then go briefly into debt, which later requests wait out, as with a hedge."""
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        super().__init__(max_requests_per_minute, max_tokens_per_minute)
+        self.request_bucket = SharedTokenBucket(max_requests_per_minute)
+        self.token_bucket = SharedTokenBucket(max_tokens_per_minute)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["wakeup"]  # each process wakes its own dispatch loop
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.wakeup = asyncio.Event()
+
+
+def shard_filepath(save_filepath: str, shard_index: int) -> str:
+    return f"{save_filepath}.shard{shard_index}"
+
+
+def iter_lines(file):
+    """Lines of a file opened by `open_requests`."""
+    if isinstance(file, MappedRequestsFile):
+        return (line for _, line in file.iter_lines())
+    return file
+
+
+def iter_shard(requests_filepath: str, shard_index: int, num_shards: int):
+    """Yield the requests on lines `shard_index`, `shard_index + num_shards`, ... parsing only those."""
+    with open_requests(requests_filepath) as file:
+        for line in itertools.islice(iter_lines(file), shard_index, None, num_shards):
+            yield json.loads(line)
+
+
+def models_in_requests(requests_filepath: str) -> set:
+    """The models the requests in a file are for, so their shared budgets exist before the processes start."""
+    with open_requests(requests_filepath) as file:
+        return {json.loads(line).get("model") for line in iter_lines(file)} - {None}
+
+
+def init_worker(endpoints: list) -> None:
+    global shard_endpoints
+    shard_endpoints = endpoints
+
+
+def run_shard(
+    shard_index: int, num_shards: int, requests_filepath: str, save_filepath: str, kwargs: dict
+) -> StatusTracker:
+    """Process one shard of the requests file. Runs in a worker process."""
+    kwargs = dict(kwargs)
+    # give each process its own metrics outputs
+    if kwargs.get("metrics_snapshot_filepath"):
+        kwargs["metrics_snapshot_filepath"] = shard_filepath(
+            kwargs["metrics_snapshot_filepath"], shard_index
+        )
+    if kwargs.get("metrics_port"):
+        kwargs["metrics_port"] += shard_index
+    if kwargs.get("aggregates_filepath"):
+        kwargs["aggregates_filepath"] = shard_filepath(kwargs["aggregates_filepath"], shard_index)
+    return asyncio.run(
+        process_api_requests_from_file(
+            requests_filepath=requests_filepath,
+            save_filepath=shard_filepath(save_filepath, shard_index),
+            endpoints=shard_endpoints,
+            requests=iter_shard(requests_filepath, shard_index, num_shards),
+            **kwargs,
+        )
+    )
+
+
+def combine_status_trackers(status_trackers: list) -> StatusTracker:
+    """Add up the shards' counters and histograms."""
+    combined = StatusTracker()
+    for f in dataclasses.fields(StatusTracker):
+        values = [getattr(status_tracker, f.name) for status_tracker in status_trackers]
+        if isinstance(getattr(combined, f.name), Histogram):
+            for histogram in values:
+                getattr(combined, f.name).merge(histogram)
+        elif f.name == "time_of_last_rate_limit_error":
+            setattr(combined, f.name, max(values, default=0))
+        else:
+            setattr(combined, f.name, sum(values))
+    return combined
+
+
+def merge_shard_results(requests_filepath: str, shard_filepaths: list, save_filepath: str) -> int:
+    """Write the results in the shard files to `save_filepath` in the order of the requests file.
+
+    Results are matched to request lines by request key. Only the line numbers and the results'
+    offsets in the shard files are held in memory. Results that match no line, e.g. because the
+    requests file changed, go at the end. Returns the number of results written."""
+    line_numbers = collections.defaultdict(list)  # request key -> lines with that request
+    with open_requests(requests_filepath) as file:
+        for line_number, line in enumerate(iter_lines(file)):
+            request_json = json.loads(line)
+            metadata = request_json.pop("metadata", None)
+            line_numbers[request_key(request_json, metadata)].append(line_number)
+    for numbers in line_numbers.values():
+        numbers.reverse()  # pop from the end to match duplicates in order
+
+    shard_files = [MappedRequestsFile(filepath) for filepath in shard_filepaths]
+    try:
+        results_by_line = collections.defaultdict(list)  # line number -> (shard, offset, length)
+        unmatched_results = []
+        for shard_index, shard_file in enumerate(shard_files):
+            for offset, line in shard_file.iter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                numbers = line_numbers.get(request_key(data[0], data[2] if len(data) > 2 else None))
+                location = (shard_index, offset, len(line))
+                if numbers:
+                    # a request retried on resume has an error line before its result; keep both
+                    results_by_line[numbers[-1]].append(location)
+                    if len(numbers) > 1 and not isinstance(data[1], list):
+                        numbers.pop()  # succeeded, so the next identical request gets the next result
+                else:
+                    unmatched_results.append(location)
+        if unmatched_results:
+            logging.warning(
+                f"{len(unmatched_results)} results match no request in {requests_filepath}; "
+                "writing them last"
+            )
+
+        num_results = 0
+        with open_text(save_filepath, "w") as f:
+            for locations in itertools.chain(
+                (results_by_line[n] for n in sorted(results_by_line)), [unmatched_results]
+            ):
+                for shard_index, offset, length in locations:
+                    f.write(shard_files[shard_index].read(offset, length).decode("utf-8") + "\n")
+                    num_results += 1
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+    return num_results
+
+
+def process_api_requests_in_processes(
+    requests_filepath: str,
+    save_filepath: str,
+    num_processes: int = None,
+    keep_shards: bool = False,
+    **kwargs,
+) -> StatusTracker:
+    """Run process_api_requests_from_file over `num_processes` shards of the requests file at once.
+
+    `kwargs` are passed on to process_api_requests_from_file; its per-minute limits, or those of each
+    of its `endpoints`, and any `model_rate_limits` are shared by all the processes, one budget per
+    model in the requests file, while `max_requests_in_flight` applies to each.
+    With `resume`, each process resumes from its own shard file, so an interrupted run can be restarted
+    with the same number of processes. The shard files are removed once merged into `save_filepath`,
+    unless `keep_shards`. Each process keeps its own `aggregates_filepath`, added to the file when
+    the shards are merged. Returns a StatusTracker with the totals of all the shards."""
+    num_processes = num_processes or os.cpu_count()
+    if kwargs.get("results_format", "jsonl") != "jsonl":
+        raise ValueError("Expecting results_format jsonl; shards are merged line by line")
+    if kwargs.get("requests") is not None:
+        raise ValueError("Expecting requests in requests_filepath, which every process reads")
+
+    # the shared budgets must exist before the processes start, so they inherit them
+    endpoints = kwargs.pop("endpoints", None) or [
+        Endpoint(
+            request_url=kwargs["request_url"],
+            api_key=kwargs["api_key"],
+            max_requests_per_minute=kwargs["max_requests_per_minute"],
+            max_tokens_per_minute=kwargs["max_tokens_per_minute"],
+            model_rate_limits=kwargs.get("model_rate_limits"),
+        )
+    ]
+    models = models_in_requests(requests_filepath)
+    for endpoint in endpoints:
+        endpoint.rate_limiter = SharedRateLimiter(
+            endpoint.max_requests_per_minute, endpoint.max_tokens_per_minute
+        )
+        for model in models:
+            endpoint.rate_limiter_for(model)  # so every model's budget is shared, not made per process
+        endpoint.model_rate_limiters = {
+            model: SharedRateLimiter(
+                rate_limiter.max_requests_per_minute, rate_limiter.max_tokens_per_minute
+            )
+            for model, rate_limiter in endpoint.model_rate_limiters.items()
+        }
+
+    shard_filepaths = [shard_filepath(save_filepath, i) for i in range(num_processes)]
+    logging.info(f"Processing {requests_filepath} in {num_processes} processes")
+    with multiprocessing.Pool(
+        num_processes, initializer=init_worker, initargs=(endpoints,)
+    ) as pool:
+        status_trackers = pool.starmap(
+            run_shard,
+            [
+                (i, num_processes, requests_filepath, save_filepath, kwargs)
+                for i in range(num_processes)
+            ],
+        )
+
+    num_results = merge_shard_results(requests_filepath, shard_filepaths, save_filepath)
+    logging.info(f"Merged {num_results} results from {num_processes} shards into {save_filepath}")
+    aggregates_filepath = kwargs.get("aggregates_filepath")
+    if aggregates_filepath:
+        aggregates_shard_filepaths = [
+            shard_filepath(aggregates_filepath, i) for i in range(num_processes)
+        ]
+        merge_aggregates(aggregates_shard_filepaths, aggregates_filepath)
+        shard_filepaths += aggregates_shard_filepaths
+    if not keep_shards:
+        for filepath in shard_filepaths:
+            os.remove(filepath)
+    return combine_status_trackers(status_trackers)
+
+
+if __name__ == "__main__":
+    from parallel_processing import api_request_parallel_processor as processor
+
+    process_api_requests_in_processes(
+        requests_filepath=processor.requests_filepath,
+        save_filepath=processor.save_filepath,
+        num_processes=num_processes,
+        request_url=processor.request_url,
+        api_key=processor.api_key,
+        max_requests_per_minute=processor.max_requests_per_minute,
+        max_tokens_per_minute=processor.max_tokens_per_minute,
+        token_encoding_name=processor.token_encoding_name,
+        max_attempts=processor.max_attempts,
+        logging_level=processor.logging_level,
+        learn_completion_budgets=processor.learn_completion_budgets,
+        completion_budget_percentile=processor.completion_budget_percentile,
+        results_flush_lines=processor.results_flush_lines,
+        results_flush_seconds=processor.results_flush_seconds,
+        results_fsync_policy=processor.results_fsync_policy,
+        response_cache_filepath=processor.response_cache_filepath,
+        response_cache_max_entries=processor.response_cache_max_entries,
+        response_cache_max_age_seconds=processor.response_cache_max_age_seconds,
+        bypass_response_cache=processor.bypass_response_cache,
+        resume=processor.resume,
+        max_requests_in_flight=processor.max_requests_in_flight,
+        request_timeout_seconds=processor.request_timeout_seconds,
+        connect_timeout_seconds=processor.connect_timeout_seconds,
+        hedge_requests=processor.hedge_requests,
+        hedge_percentile=processor.hedge_percentile,
+        metrics_snapshot_filepath=processor.metrics_snapshot_filepath,
+        metrics_snapshot_seconds=processor.metrics_snapshot_seconds,
+        metrics_port=processor.metrics_port,
+        model_rate_limits=processor.model_rate_limits,
+        aggregates_filepath=processor.aggregates_filepath,
+        metrics_host=processor.metrics_host,
+        endpoints=(
+            processor.load_endpoints(processor.endpoints_filepath)
+            if processor.endpoints_filepath
+            else None
+        ),
+    )
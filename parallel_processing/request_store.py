@@ -0,0 +1,67 @@
+# request_store.py
+# Keeps the bodies of queued requests out of the Python heap. A plain requests file is memory-mapped, and
+# each queued request holds only the byte offset and length of its line, which are re-parsed when it is
+# sent; the OS pages the file in and out as needed. Requests from compressed files or in-memory iterables
+# are kept as their encoded JSON instead, which is still far smaller than the parsed dicts.
+import json  # for encoding and parsing request bodies
+import mmap  # for reading request lines without loading the file
+from parallel_processing.compression import compression_for, open_text
+
+
+class MappedRequestsFile:
+    """A plain requests file, memory-mapped for reading lines back by offset."""
+
+    def __init__(self, filename: str):
+        self.name = filename
+        self.file = open(filename, "rb")
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can't be mapped
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def iter_lines(self):
+        """Yield (offset, line) for each line, without its line break."""
+        if self.mmap is None:
+            return
+        offset = 0
+        size = len(self.mmap)
+        while offset < size:
+            end = self.mmap.find(b"\n", offset)
+            if end == -1:
+                end = size
+            yield offset, self.mmap[offset:end]
+            offset = end + 1
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self.mmap[offset : offset + length]
+
+    def close(self) -> None:
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+
+def open_requests(filename: str):
+    """Open a requests file for the processor: memory-mapped if it is plain, otherwise as text."""
+    if compression_for(filename) is None:
+        return MappedRequestsFile(filename)
+    return open_text(filename)
+
+
+def encode_request(request_json: dict, metadata: dict = None) -> bytes:
+    """The in-memory form of a request that isn't in a mapped file, as it would be written to one."""
+    if metadata is not None:
+        request_json = dict(request_json, metadata=metadata)
+    return json.dumps(request_json).encode("utf-8")
+
+
+def decode_request(body: bytes) -> tuple:
+    """Parse a request line into (request_json, metadata)."""
+    request_json = json.loads(body)
+    return request_json, request_json.pop("metadata", None)
@@ -0,0 +1,117 @@
+# response_cache.py
+import hashlib  # for content-addressing requests
+import json  # for canonicalizing requests and storing responses
+import sqlite3  # for the on-disk cache
+import time  # for age-based eviction
+
+
+def canonical_hash(obj) -> str:
+    """Hash a JSON-serializable object so that equal contents always give the same key."""
+    canonical = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_deterministic_request(request_json: dict) -> bool:
+    """Whether repeating the request should give the same response, so it is safe to cache.
+
+    Requests without a temperature use the API's default of 1, so they are not cached."""
+    if "messages" not in request_json and "prompt" not in request_json:
+        return True  # embeddings
+    return request_json.get("temperature") == 0 or request_json.get("top_p") == 0
+
+
+class ResponseCache:
+    """Persistent cache of API responses, keyed by a canonical hash of the request URL and body, so
+    deployments of different models behind the same API endpoint don't share responses.
+
+    Entries older than `max_age_seconds` are ignored and evicted, and once there are more than
+    `max_entries` the least recently used are evicted. Either limit can be None to disable it.
+    Writes are committed every `commit_every` writes and when the cache is closed."""
+
+    def __init__(
+        self,
+        filename: str,
+        max_entries: int = None,
+        max_age_seconds: float = None,
+        commit_every: int = 100,
+    ):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.commit_every = commit_every
+        self.num_uncommitted_writes = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)"
+        )
+        self.evict()
+
+    def key(self, request_json: dict, request_url: str) -> str:
+        return canonical_hash([request_url, request_json])
+
+    def get(self, key: str):
+        """Return the cached response for `key`, or None on a miss."""
+        row = self.connection.execute(
+            "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        current_time = time.time()
+        if self.max_age_seconds is not None and current_time - created_at > self.max_age_seconds:
+            return None
+        self.connection.execute(
+            "UPDATE responses SET last_used_at = ? WHERE key = ?", (current_time, key)
+        )
+        self.count_write()
+        return json.loads(response)
+
+    def put(self, key: str, response: dict) -> None:
+        current_time = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response), current_time, current_time),
+        )
+        self.count_write()
+
+    def count_write(self) -> None:
+        self.num_uncommitted_writes += 1
+        if self.num_uncommitted_writes >= self.commit_every:
+            self.connection.commit()
+            self.num_uncommitted_writes = 0
+
+    def evict(self) -> None:
+        """Delete entries that are too old, then the least recently used ones over max_entries."""
+        if self.max_age_seconds is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+        if self.max_entries is not None:
+            self.connection.execute(
+                """DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+        self.connection.commit()
+        self.num_uncommitted_writes = 0
+
+    def close(self) -> None:
+        self.evict()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
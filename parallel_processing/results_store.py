@@ -0,0 +1,284 @@
+# results_store.py
+# A normalized layout for results, selected with RESULTS_FORMAT=normalized. Instead of one JSONL file
+# that repeats every request in full, the results path is a directory holding:
+#   contents.jsonl  [hash, value] for each distinct message, text chunk and parameter set, written once
+#   results.jsonl   [request, response, metadata] with the request's text and parameters replaced by hashes
+# If the directory's name ends in .zst or .lz4, both files are compressed the same way and named to match.
+# Each distinct message is stored as its sentences and lines, themselves stored once, so demographic
+# variants of a vignette share everything but the sentences that differ. `iter_results` reads either layout
+# back as the usual [request_json, response, metadata] lists.
+import asyncio  # for opening files off the event loop
+import json  # for reading and writing results
+import logging  # for logging truncated files
+import os  # for the store's directory and fsync
+import re  # for splitting text into chunks
+import time  # for waiting on files that are still being written
+from parallel_processing.compression import compression_for, open_text, truncate_partial_frame
+from parallel_processing.response_cache import canonical_hash
+from parallel_processing.results_writer import ResultsWriter
+
+results_formats = ("jsonl", "normalized")
+contents_filename = "contents.jsonl"
+results_filename = "results.jsonl"
+
+# split after a line break or a sentence end, keeping the separators so chunks join back exactly
+chunk_boundary_pattern = re.compile(r"(?<=\n)|(?<=[.?!] )")
+min_chunk_length = 48  # shorter texts are kept inline, since a hash would be about as long
+
+
+hash_length = 16  # hex digits, i.e. 64 bits
+
+
+def content_hash(value) -> str:
+    return canonical_hash(value)[:hash_length]
+
+
+def request_key(request_json: dict, metadata: dict) -> str:
+    """Identify a request by its content, so its result can be found again after a restart."""
+    return canonical_hash([request_json, metadata])
+
+
+def is_normalized_store(path: str) -> bool:
+    return os.path.isdir(path)
+
+
+def store_filepath(dirname: str, filename: str) -> str:
+    """Path of one of a store's files, with the store's compression extension if it has one."""
+    dirname = os.path.normpath(dirname)
+    extension = os.path.splitext(dirname)[1] if compression_for(dirname) else ""
+    return os.path.join(dirname, filename + extension)
+
+
+def truncate_partial_last_line(filename: str) -> bool:
+    """Cut off a last line left unfinished by a run that was killed mid-write. Returns whether it did.
+
+    In a compressed file, a last frame cut short is cut off instead."""
+    if compression_for(filename):
+        return truncate_partial_frame(filename)
+    with open(filename, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        if end == 0:
+            return False
+        file.seek(end - 1)
+        if file.read(1) == b"\n":
+            return False
+        # walk back to the end of the last complete line
+        position = end
+        while position > 0:
+            block_start = max(position - 65536, 0)
+            file.seek(block_start)
+            block = file.read(position - block_start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = block_start + newline + 1
+                break
+            position = block_start
+        logging.warning(f"Truncating partial last line of {filename} at byte {position}")
+        file.truncate(position)
+        return True
+
+
+def iter_complete_lines(filename: str, follow=False, follow_idle_seconds=60.0, poll_seconds=1.0):
+    """Yield complete lines of a file one at a time.
+
+    With `follow`, keep waiting for new lines, like `tail -f`, until none have arrived for
+    `follow_idle_seconds`. A partial last line is held back until the rest of it is written. Following
+    is only supported for uncompressed files."""
+    with open_text(filename) as file:
+        partial_line = ""
+        last_line_time = time.monotonic()
+        while True:
+            line = file.readline()
+            if line:
+                partial_line += line
+                if partial_line.endswith("\n"):
+                    yield partial_line
+                    partial_line = ""
+                    last_line_time = time.monotonic()
+                continue
+            if not follow or time.monotonic() - last_line_time > follow_idle_seconds:
+                return
+            time.sleep(poll_seconds)
+
+
+def iter_chunks(text: str):
+    """Split a text at sentence and line ends into chunks of at least `min_chunk_length` characters,
+    except perhaps the last. Short sentences and lines, such as answer choices, are merged into the next."""
+    chunk = ""
+    for sentence in chunk_boundary_pattern.split(text):
+        chunk += sentence
+        if len(chunk) >= min_chunk_length:
+            yield chunk
+            chunk = ""
+    if chunk:
+        yield chunk
+
+
+def normalize_text(text: str, known_hashes: set, new_contents: list):
+    """Replace a text with a [hash] reference, or return it as is if it is short.
+
+    The first time a text is seen, it is stored as {"chunks": <the hashes of its chunks, concatenated>},
+    and each chunk is stored once, so texts that differ in one sentence share the rest."""
+    if len(text) < min_chunk_length:
+        return text
+    text_hash = content_hash([text])  # not content_hash(text), which a text of one chunk would have
+    if text_hash in known_hashes:
+        return [text_hash]
+    chunk_hashes = []
+    for chunk in iter_chunks(text):
+        h = content_hash(chunk)
+        if h not in known_hashes:
+            known_hashes.add(h)
+            new_contents.append([h, chunk])
+        chunk_hashes.append(h)
+    known_hashes.add(text_hash)
+    new_contents.append([text_hash, {"chunks": "".join(chunk_hashes)}])
+    return [text_hash]
+
+
+def normalize_result(data: list, known_hashes: set, new_contents: list) -> list:
+    """Turn a [request_json, response, metadata] result into its normalized form.
+
+    Chat messages with text content become (role, text reference) pairs, and messages with any other
+    content, such as None or a list of parts, are kept whole as [message]. Every other request field goes
+    into one stored parameter set. New chunks and parameter sets are added to `known_hashes` and
+    `new_contents`."""
+    request_json = dict(data[0])
+    messages = request_json.pop("messages", None)
+    h = content_hash(request_json)
+    if h not in known_hashes:
+        known_hashes.add(h)
+        new_contents.append([h, request_json])
+    request = {"params": h}
+    if messages is not None:
+        request["messages"] = [
+            [
+                {key: value for key, value in message.items() if key != "content"},
+                normalize_text(message["content"], known_hashes, new_contents),
+            ]
+            if isinstance(message.get("content"), str)
+            else [message]
+            for message in messages
+        ]
+    return [request] + data[1:]
+
+
+class ContentsIndex:
+    """Reads a store's contents file on demand, so results can be loaded while the store is written."""
+
+    def __init__(self, filename: str):
+        self.file = open_text(filename)
+        self.contents = {}
+        self.partial_line = ""
+
+    def __getitem__(self, h: str):
+        while h not in self.contents:
+            line = self.file.readline()
+            if not line:
+                raise KeyError(f"{h} is not in {self.file.name}")
+            self.partial_line += line
+            if self.partial_line.endswith("\n"):
+                stored_hash, value = json.loads(self.partial_line)
+                self.contents[stored_hash] = value
+                self.partial_line = ""
+        return self.contents[h]
+
+    def text(self, reference) -> str:
+        """Rebuild a text from `normalize_text`'s reference to it."""
+        if isinstance(reference, str):
+            return reference
+        chunk_hashes = self[reference[0]]["chunks"]
+        return "".join(
+            self[chunk_hashes[i : i + hash_length]]
+            for i in range(0, len(chunk_hashes), hash_length)
+        )
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def denormalize_result(data: list, contents: ContentsIndex) -> list:
+    request = data[0]
+    request_json = dict(contents[request["params"]])
+    if "messages" in request:
+        request_json["messages"] = [
+            dict(message, content=contents.text(reference[0])) if reference else message
+            for message, *reference in request["messages"]
+        ]
+    return [request_json] + data[1:]
+
+
+def iter_results(path: str, follow=False, follow_idle_seconds=60.0):
+    """Yield [request_json, response, metadata] lists from a JSONL results file or a normalized store.
+
+    Results without metadata have just two items, as in the JSONL file. Unreadable lines are logged
+    and skipped. See `iter_complete_lines` for `follow`."""
+    normalized = is_normalized_store(path)
+    contents = ContentsIndex(store_filepath(path, contents_filename)) if normalized else None
+    try:
+        for line in iter_complete_lines(
+            store_filepath(path, results_filename) if normalized else path,
+            follow=follow,
+            follow_idle_seconds=follow_idle_seconds,
+        ):
+            try:
+                data = json.loads(line)
+                yield denormalize_result(data, contents) if normalized else data
+            except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                logging.warning(f"Skipping unreadable result in {path}: {e}")
+    finally:
+        if contents is not None:
+            contents.close()
+
+
+class NormalizedResultsWriter(ResultsWriter):
+    """ResultsWriter for the normalized layout. `dirname` is created if it doesn't exist.
+
+    In each batch, new contents are flushed before the results that refer to them, so a complete
+    results line can always be read back."""
+
+    def __init__(self, dirname: str, **kwargs):
+        super().__init__(store_filepath(dirname, results_filename), **kwargs)
+        self.dirname = dirname
+        self.contents_filename = store_filepath(dirname, contents_filename)
+        self.contents_file = None
+        self.known_hashes = set()
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.open_contents)
+        return await super().__aenter__()
+
+    def open_contents(self) -> None:
+        os.makedirs(self.dirname, exist_ok=True)
+        if os.path.exists(self.contents_filename):
+            truncate_partial_last_line(self.contents_filename)
+            for line in iter_complete_lines(self.contents_filename):
+                self.known_hashes.add(json.loads(line)[0])
+        self.contents_file = open_text(self.contents_filename, "a")
+
+    def write_batch(self, batch: list) -> None:
+        """Normalize and write a batch of results. Runs in a worker thread."""
+        new_contents = []
+        lines = "".join(
+            json.dumps(normalize_result(data, self.known_hashes, new_contents)) + "\n"
+            for data in batch
+        )
+        if new_contents:
+            self.contents_file.write("".join(json.dumps(item) + "\n" for item in new_contents))
+            self.contents_file.flush()
+            if self.fsync_policy == "batch":
+                os.fsync(self.contents_file.fileno())
+        self.file.write(lines)
+        self.file.flush()
+        if self.fsync_policy == "batch":
+            os.fsync(self.file.fileno())
+        self.num_lines_written += len(batch)
+
+    def close_file(self) -> None:
+        if self.contents_file is not None:
+            self.contents_file.flush()
+            if self.fsync_policy == "close":
+                os.fsync(self.contents_file.fileno())
+            self.contents_file.close()
+            self.contents_file = None
+        super().close_file()
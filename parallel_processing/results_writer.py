@@ -0,0 +1,134 @@
+# results_writer.py
+import asyncio  # for running the writer as its own task
+import json  # for serializing results as jsonl
+import logging  # for logging write failures
+import os  # for fsyncing the results file
+from parallel_processing.compression import open_text
+
+fsync_policies = ("never", "batch", "close")
+
+
+class ResultsWriter:
+    """Single writer task that appends results to a file in batches.
+
+    `write` only enqueues a result, so request coroutines never block on file I/O. The writer task
+    collects queued results and writes them in one go, off the event loop, once `flush_lines` are
+    waiting or `flush_seconds` have passed since the oldest unwritten one. As the only writer, it never
+    interleaves lines.
+
+    fsync_policy is "never" (leave it to the OS), "batch" (after every write) or "close" (once at the end).
+    Pass `serialize` to write another line format; it turns one result into one line of text.
+    Each of `observers` is called with every batch once it is written, in the writer's thread, as a list
+    of (result, stats) pairs, where stats is whatever was passed to `write` with the result (or None).
+    A filename ending in .zst or .lz4 is compressed, one frame per batch (see compression.py)."""
+
+    def __init__(
+        self,
+        filename: str,
+        flush_lines: int = 100,
+        flush_seconds: float = 1.0,
+        fsync_policy: str = "close",
+        serialize=json.dumps,
+        observers: list = None,
+    ):
+        if fsync_policy not in fsync_policies:
+            raise ValueError(
+                f'Expecting fsync_policy to be one of {fsync_policies}, got "{fsync_policy}"'
+            )
+        self.filename = filename
+        self.flush_lines = flush_lines
+        self.flush_seconds = flush_seconds
+        self.fsync_policy = fsync_policy
+        self.serialize = serialize
+        self.observers = observers or []
+        self.queue = asyncio.Queue()
+        self.file = None
+        self.task = None
+        self.num_lines_written = 0
+
+    def write(self, data, stats: dict = None) -> None:
+        """Queue one result to be written, with any `stats` about it for the observers."""
+        self.queue.put_nowait((data, stats))
+
+    async def __aenter__(self):
+        self.file = await asyncio.to_thread(open_text, self.filename, "a")
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def check(self) -> None:
+        """Raise the error that stopped the writer task, if it has stopped before being told to.
+
+        Results written after that would only pile up in the queue, so callers check this as they go."""
+        if self.task is not None and self.task.done():
+            if not self.task.cancelled() and self.task.exception() is not None:
+                raise self.task.exception()
+            raise RuntimeError(f"Writer for {self.filename} has stopped")
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.queue.put_nowait(None)  # tells the writer task to flush and stop
+        try:
+            await self.task
+        finally:
+            await asyncio.to_thread(self.close_file)
+
+    async def run(self) -> None:
+        """Write queued results in batches until `None` is queued."""
+        loop = asyncio.get_running_loop()
+        batch = []
+        flush_time = None  # when the oldest unwritten result is due to be flushed
+        finished = False
+        while not finished:
+            timeout = None if flush_time is None else max(flush_time - loop.time(), 0)
+            try:
+                data = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                data = ...  # nothing new, but the batch is due
+            # take everything else that is already waiting
+            while True:
+                if data is None:
+                    finished = True
+                elif data is not ...:
+                    batch.append(data)
+                    if flush_time is None:
+                        flush_time = loop.time() + self.flush_seconds
+                if finished or self.queue.empty():
+                    break
+                data = self.queue.get_nowait()
+
+            if batch and (
+                finished
+                or len(batch) >= self.flush_lines
+                or loop.time() >= flush_time
+            ):
+                try:
+                    await asyncio.to_thread(self.write_and_observe, batch)
+                except Exception as e:
+                    logging.error(
+                        f"Failed to write {len(batch)} results to {self.filename}: {e}"
+                    )
+                    raise
+                batch = []
+                flush_time = None
+
+    def write_and_observe(self, batch: list) -> None:
+        """Write a batch of (result, stats) pairs, then pass it to the observers. Runs in a worker thread."""
+        self.write_batch([data for data, _ in batch])
+        for observer in self.observers:
+            observer(batch)
+
+    def write_batch(self, batch: list) -> None:
+        """Serialize and write a batch of results. Runs in a worker thread."""
+        self.file.write("".join(self.serialize(data) + "\n" for data in batch))
+        self.file.flush()
+        if self.fsync_policy == "batch":
+            os.fsync(self.file.fileno())
+        self.num_lines_written += len(batch)
+
+    def close_file(self) -> None:
+        if self.file is None:
+            return
+        self.file.flush()
+        if self.fsync_policy == "close":
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
@@ -2,69 +2,253 @@
 import csv
 import json
 import os
+import re
 from dotenv import load_dotenv
+from parallel_processing.compression import open_text
+from parallel_processing.results_store import iter_results
 
 load_dotenv()
 
+# "The correct answer is B", "Answer: (C)", "Answer choice D"; some questions go up to H. Responses may
+# restate their answer, so the greedy prefix makes the last of these count. Only capitals count as
+# letters, so "the answer is a bit tricky" isn't read as A
+answer_pattern = re.compile(
+    r"\A(?s:.*)(?i:\banswer\s*(?:is\b|choice\b|[:\-])(?:\s*[:\-])?)\s*\**\(?([A-H])\b"
+)
+# without one, "I choose D" or "option E"; explanations mention other options too ("we do not select
+# A"), so these only count when there is no answer statement
+choice_pattern = re.compile(r"\A(?s:.*)(?i:\boption|\bcho{1,2}se|\bselect)\s*[:\-]?\s*\**\(?([A-H])\b")
+# failing those, a line starting "D)", "**C.**" or "B:", but not one starting "A 77-year-old"
+line_answer_pattern = re.compile(r"^\s*\**\(?([A-H])[).:]", re.MULTILINE)
+answer_patterns = (answer_pattern, choice_pattern, line_answer_pattern)  # tried in order
 
-def save_generated_data_to_csv(input_filename, output_filename):
-    responses = []
+# the CSV keeps its original layout, with the system message at the top of the prompt
+csv_columns = {
+    "model": "Model",
+    "input_prompt": "Input Prompt",
+    "answer_text": "Output Answer",
+    "prompt_tokens": "Prompt Tokens",
+    "completion_tokens": "Completion Tokens",
+}
 
-    # Read the input file and collect responses
-    try:
-        with open(input_filename, "r", encoding="utf-8") as file:
-            for line in file:
-                data = json.loads(line)
-                responses.append(data)
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON: {e}")
-        return
-
-    # Create a CSV file for writing
-    try:
-        with open(output_filename, "w", newline="", encoding="utf-8") as csv_file:
-            csv_writer = csv.writer(csv_file)
-
-            # Write the header row
-            csv_writer.writerow(
-                [
-                    "Model",
-                    "Input Prompt",
-                    "Output Answer",
-                    "Prompt Tokens",
-                    "Completion Tokens",
-                ]
+
+def extract_answer(text):
+    """Pull the chosen answer letter out of a response, or None if there isn't one."""
+    for pattern in answer_patterns:
+        match = pattern.search(text or "")
+        if match:
+            return match[1]
+    return None
+
+
+def result_to_row(result):
+    """Flatten one [request, response, metadata] result into typed columns.
+
+    The system message is kept in its own column rather than repeated in the prompt; columnar
+    formats store it once per chunk."""
+    request_json, response = result[0], result[1]
+    metadata = result[2] if len(result) > 2 else {}
+    messages = request_json.get("messages") or [{}, {}]
+    row = {
+        "model": request_json.get("model", ""),
+        "qid": metadata.get("qid"),
+        "system_message": messages[0].get("content", ""),
+        "user_message": messages[-1].get("content", ""),
+        "answer_text": None,
+        "extracted_answer": None,
+        "prompt_tokens": None,
+        "completion_tokens": None,
+        "error": None,
+    }
+    for name, value in (metadata.get("demographics") or {}).items():
+        row[f"demographic_{name}"] = value
+    if isinstance(response, dict) and "choices" in response:
+        row["answer_text"] = response["choices"][0]["message"].get("content", "")
+        row["extracted_answer"] = extract_answer(row["answer_text"])
+        usage = response.get("usage")  # some servers leave it out; then the token counts are unknown
+        if usage is not None:
+            row["prompt_tokens"] = usage.get("prompt_tokens", 0)
+            row["completion_tokens"] = usage.get("completion_tokens", 0)
+    else:
+        # failed requests are saved with a list of errors in place of the response
+        row["error"] = json.dumps(response)
+    return row
+
+
+def iter_result_rows(input_filename, **follow_kwargs):
+    """Yield one row per result in a JSONL results file or normalized results store."""
+    for result in iter_results(input_filename, **follow_kwargs):
+        try:
+            yield result_to_row(result)
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            print(f"Error processing response: {e}")
+            print(f"Problematic response: {json.dumps(result)[:200]}")
+
+
+def demographic_columns(rows, demographic_slots=None):
+    """The demographic columns of some rows, in the order they first appear, after any named slots."""
+    names = [f"demographic_{slot}" for slot in demographic_slots or ()]
+    for row in rows:
+        names += [name for name in row if name.startswith("demographic_") and name not in names]
+    return names
+
+
+def arrow_schema(demographic_column_names):
+    """Column types for the columnar formats, with the given demographic columns."""
+    import pyarrow as pa
+
+    fields = [
+        pa.field("model", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("qid", pa.int64()),
+        pa.field("system_message", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("user_message", pa.string()),
+        pa.field("answer_text", pa.string()),
+        pa.field("extracted_answer", pa.dictionary(pa.int8(), pa.string())),
+        pa.field("prompt_tokens", pa.int32()),
+        pa.field("completion_tokens", pa.int32()),
+        pa.field("error", pa.string()),
+    ]
+    fields += [pa.field(name, pa.dictionary(pa.int32(), pa.string())) for name in demographic_column_names]
+    return pa.schema(fields)
+
+
+def iter_chunks(rows, chunk_rows):
+    """Group rows into lists of `chunk_rows`. Always yields at least one list, even if it is empty."""
+    chunk = []
+    num_chunks = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+            num_chunks += 1
+    if chunk or not num_chunks:
+        yield chunk
+
+
+def extend_dictionaries(batch, dictionaries):
+    """Re-encode a batch's dictionary columns against `dictionaries` of values seen so far, which only grow.
+
+    An Arrow IPC file can add to a column's dictionary from one batch to the next but not replace it,
+    so every batch's dictionary has to start with the one before it."""
+    import pyarrow as pa
+    import pyarrow.compute
+
+    columns = []
+    for field, column in zip(batch.schema, batch.columns):
+        if pa.types.is_dictionary(field.type):
+            # starting with "" even if nothing uses it, as an empty dictionary can't be added to
+            values = dictionaries.setdefault(field.name, {"": 0})
+            codes = [values.setdefault(value, len(values)) for value in column.dictionary.to_pylist()]
+            column = pa.DictionaryArray.from_arrays(
+                pa.compute.take(pa.array(codes, field.type.index_type), column.indices),
+                pa.array(list(values), field.type.value_type),
             )
+        columns.append(column)
+    return pa.record_batch(columns, schema=batch.schema)
+
+
+def write_columnar(rows, output_filename, output_format, chunk_rows, demographic_slots=None):
+    """Write rows to Parquet or Arrow IPC, one record batch of `chunk_rows` at a time.
+
+    The file's demographic columns are `demographic_slots` and any others in the first chunk, since a
+    file's schema can't change once it is written. Baseline rows have no demographics, so a chunk of
+    only those would otherwise leave the columns out."""
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(f"Writing {output_format} needs pyarrow: pip install pyarrow") from e
 
-            # Iterate through the responses and write data to the CSV
-            for response in responses:
-                try:
-                    # Extract the required data from the response
-                    model = response[0].get("model", "")
-                    system_message = response[0]["messages"][0].get("content", "")
-                    user_message = response[0]["messages"][1].get("content", "")
-                    input_prompt = f"System message: {system_message}\n\n{user_message}"
-                    output_answer = response[1]["choices"][0]["message"].get(
-                        "content", ""
+    writer = None
+    num_rows = 0
+    dropped = set()
+    dictionaries = {}
+    try:
+        for chunk in iter_chunks(rows, chunk_rows):
+            if writer is None:
+                columns = demographic_columns(chunk, demographic_slots)
+                schema = arrow_schema(columns)
+                writer = (
+                    pa.parquet.ParquetWriter(output_filename, schema)
+                    if output_format == "parquet"
+                    else pa.ipc.new_file(
+                        output_filename, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
                     )
-                    prompt_tokens = response[1]["usage"].get("prompt_tokens", 0)
-                    completion_tokens = response[1]["usage"].get("completion_tokens", 0)
-
-                    # Write data to the CSV file
-                    csv_writer.writerow(
-                        [
-                            model,
-                            input_prompt,
-                            output_answer,
-                            prompt_tokens,
-                            completion_tokens,
-                        ]
+                )
+            else:
+                new_columns = set(demographic_columns(chunk)) - set(columns) - dropped
+                if new_columns:
+                    print(
+                        f"Leaving out {', '.join(sorted(new_columns))}, first seen after the first "
+                        f"{num_rows} rows; pass them as demographic_slots to keep them"
                     )
-                except Exception as e:
-                    print(f"Error processing response: {e}")
-                    print(f"Problematic response: {response}")
+                    dropped |= new_columns
+            batch = pa.RecordBatch.from_pylist(chunk, schema=schema)
+            if output_format == "arrow":
+                batch = extend_dictionaries(batch, dictionaries)
+            writer.write_batch(batch)
+            num_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+
+def write_csv(rows, output_filename):
+    with open_text(output_filename, "w") as csv_file:
+        csv_writer = csv.writer(csv_file)
+
+        # Write the header row
+        csv_writer.writerow(csv_columns.values())
 
-        print(f"CSV file created successfully at {output_filename}.")
+        num_rows = 0
+        for row in rows:
+            row["input_prompt"] = f"System message: {row['system_message']}\n\n{row['user_message']}"
+            csv_writer.writerow([row[name] for name in csv_columns])
+            num_rows += 1
+    return num_rows
+
+
+def save_generated_data(
+    input_filename,
+    output_filename,
+    output_format=None,
+    chunk_rows=10000,
+    follow=False,
+    follow_idle_seconds=60.0,
+    demographic_slots=None,
+):
+    """Convert a results file or normalized results store to CSV, Parquet or Arrow, one result at a time.
+
+    The format comes from the output file's extension (.csv, .parquet, .arrow or .feather) unless
+    `output_format` is given; anything else, such as .csv.zst, is written as CSV, compressed by
+    extension. Memory use doesn't grow with the size of the run: CSV rows are written as they are read
+    and columnar rows in chunks of `chunk_rows`. With `follow`, keep converting results as they are
+    appended, until none have arrived for `follow_idle_seconds`. Columnar files get a column for each of
+    `demographic_slots` and for any other demographic in the first chunk (see write_columnar)."""
+    if output_format is None:
+        extension = os.path.splitext(output_filename)[1].lower()
+        output_format = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}.get(
+            extension, "csv"
+        )
+    rows = iter_result_rows(
+        input_filename, follow=follow, follow_idle_seconds=follow_idle_seconds
+    )
+    if output_format == "csv":
+        num_rows = write_csv(rows, output_filename)
+    elif output_format in ("parquet", "arrow"):
+        num_rows = write_columnar(rows, output_filename, output_format, chunk_rows, demographic_slots)
+    else:
+        raise ValueError(f'Expecting output_format to be csv, parquet or arrow, got "{output_format}"')
+    print(f"{output_format} file with {num_rows} rows created successfully at {output_filename}.")
+    return num_rows
+
+
+def save_generated_data_to_csv(input_filename, output_filename):
+    try:
+        save_generated_data(input_filename, output_filename, output_format="csv")
     except Exception as e:
         print(f"Error writing data to CSV file: {e}")
 
@@ -74,4 +258,8 @@ if __name__ == "__main__":
         "REQUESTS_FILE_PATH", "requests_to_chat_completion.jsonl"
     )
     output_filename = os.getenv("OUTPUT_FILE_PATH", "output.csv")
-    save_generated_data_to_csv(input_filename, output_filename)
+    save_generated_data(
+        input_filename,
+        output_filename,
+        follow=os.getenv("FOLLOW_RESULTS", "false").lower() in ("1", "true", "yes"),
+    )
@@ -0,0 +1,248 @@
+# scoring.py
+# Grades results against the gold answers in data/*.csv. Answer letters are pulled out of whole columns of
+# responses at once, trying a series of compiled patterns on only the rows earlier ones missed, and joined
+# to the gold answers through a qid index, e.g.:
+#   scored = score_results("outputs/results_of_chat_completion.jsonl")
+#   accuracy_table(scored, by=["model", "specialty"])
+# or from the command line:
+#   python -m parallel_processing.scoring outputs/results_of_chat_completion.jsonl --by model specialty
+import argparse  # for reading options from the command line
+import collections  # for matching failed results with later successes
+import functools  # for caching parsed options
+import glob  # for finding the question files
+import json  # for parsing results as they land
+import os  # for naming specialties after their files
+import re  # for extraction patterns
+import numpy as np  # for vectorized correctness
+import pandas as pd  # for scoring whole columns at once
+from parallel_processing.compression import open_text
+from parallel_processing.results_store import (
+    ContentsIndex,
+    contents_filename,
+    denormalize_result,
+    is_normalized_store,
+    iter_results,
+    request_key,
+    results_filename,
+    store_filepath,
+)
+from parallel_processing.save_generated_data_to_csv import answer_patterns, result_to_row
+
+# tried in order, each only on the responses the ones before it found nothing in
+extraction_patterns = [
+    *answer_patterns,  # the last "The answer is B", else the last "I choose D", else a line starting "D)"
+    re.compile(r"\(([A-H])\)"),  # "(C)" anywhere
+    re.compile(r"\A\W*([A-H])\W*\Z"),  # nothing but the letter
+]
+option_pattern = re.compile(r"^\(?([A-H])[).]\s*(.+?)\s*$", re.MULTILINE)  # "A) Capsule endoscopy"
+qid_pattern = re.compile(r"\(qid: (\d+)\)")
+
+
+def load_gold_answers(data_dir: str = "data") -> pd.DataFrame:
+    """Gold answers and specialties from the question files, indexed by qid."""
+    frames = [
+        pd.read_csv(path, usecols=["qid", "correct_answer"]).assign(
+            specialty=os.path.splitext(os.path.basename(path))[0]
+        )
+        for path in sorted(glob.glob(os.path.join(data_dir, "*.csv")))
+    ]
+    if not frames:
+        raise FileNotFoundError(f"No question files in {data_dir}")
+    gold = pd.concat(frames, ignore_index=True).drop_duplicates("qid").set_index("qid")
+    gold["correct_answer"] = gold["correct_answer"].str.strip().str.upper()
+    return gold
+
+
+@functools.lru_cache(maxsize=4096)
+def question_options(question: str) -> tuple:
+    """(letter, lowercased text) of each option in a question. Questions repeat across variants."""
+    return tuple((letter, option.lower()) for letter, option in option_pattern.findall(question))
+
+
+def answer_from_options(answer_text: str, question: str):
+    """The letter of the only option whose text the response mentions, or None."""
+    answer_text = answer_text.lower()
+    letters = {
+        letter for letter, option in question_options(question or "") if option in answer_text
+    }
+    return letters.pop() if len(letters) == 1 else None
+
+
+def extract_answers(answer_text: pd.Series, questions: pd.Series = None) -> pd.Series:
+    """The chosen option letter of each response, or None where there isn't one.
+
+    With `questions`, responses no pattern matched are compared with the text of the question's
+    options as a last resort. That step runs per row, but only over those few responses."""
+    answer_text = answer_text.fillna("").astype(str)
+    letters = pd.Series(None, index=answer_text.index, dtype=object)
+    for pattern in extraction_patterns:
+        missing = letters.isna()
+        if not missing.any():
+            break
+        groups = answer_text[missing].str.extract(pattern)
+        found = groups[0]
+        for column in groups.columns[1:]:
+            found = found.fillna(groups[column])  # patterns with alternatives have a group for each
+        letters[missing] = found
+    missing = letters.isna() & (answer_text != "")
+    if questions is not None and missing.any():
+        letters[missing] = [
+            answer_from_options(text, question)
+            for text, question in zip(answer_text[missing], questions[missing])
+        ]
+    letters = letters.str.upper()
+    return letters.where(letters.notna(), None)
+
+
+def score_frame(rows: pd.DataFrame, gold: pd.DataFrame) -> pd.DataFrame:
+    """Add the scored columns to a frame of result rows (see save_generated_data_to_csv.result_to_row).
+
+    A response counts as correct only if its letter matches the gold answer; unanswered questions count
+    as incorrect. Failed requests never got an answer to grade, and rows whose qid has no gold answer
+    can't be graded, so both get a missing `correct`."""
+    rows = rows.copy()
+    qids = pd.to_numeric(rows["qid"], errors="coerce") if "qid" in rows else pd.Series(
+        np.nan, index=rows.index
+    )
+    missing = qids.isna()
+    if missing.any():
+        # results without a qid in their metadata still have it in the question text
+        qids[missing] = pd.to_numeric(
+            rows.loc[missing, "user_message"].fillna("").str.extract(qid_pattern)[0],
+            errors="coerce",
+        )
+    rows["qid"] = qids.astype("Int64")
+    rows["extracted_answer"] = extract_answers(rows["answer_text"], rows["user_message"])
+    matched = gold.reindex(rows["qid"].to_numpy())
+    rows["correct_answer"] = matched["correct_answer"].to_numpy()
+    rows["specialty"] = matched["specialty"].to_numpy()
+    rows["answered"] = rows["extracted_answer"].notna().to_numpy()
+    failed = rows["error"].notna() if "error" in rows else pd.Series(False, index=rows.index)
+    has_gold = (rows["correct_answer"].notna() & ~failed).to_numpy()
+    is_correct = rows["extracted_answer"].to_numpy() == rows["correct_answer"].to_numpy()
+    rows["correct"] = pd.array(np.where(has_gold, is_correct, pd.NA), dtype="boolean")
+    return rows
+
+
+def replaced_failures(results: list, failed, labels, pending: dict = None) -> list:
+    """Labels of failed results that a later success of the same request replaces.
+
+    A resumed run sends the requests that failed again but leaves their failures in the file. Each
+    success replaces at most one earlier failure of its request, as a request may be asked more than
+    once. Requests are only hashed once there is a failure to match. Pass the same `pending` dict to
+    match across calls."""
+    pending = {} if pending is None else pending
+    replaced = []
+    for result, is_failed, label in zip(results, failed, labels):
+        if not is_failed and not pending:
+            continue
+        key = request_key(result[0], result[2] if len(result) > 2 else None)
+        if is_failed:
+            pending.setdefault(key, collections.deque()).append(label)
+        elif key in pending:
+            replaced.append(pending[key].popleft())
+            if not pending[key]:
+                del pending[key]
+    return replaced
+
+
+def score_results(path: str, gold: pd.DataFrame = None, data_dir: str = "data") -> pd.DataFrame:
+    """Score every result in a results file or normalized store, leaving out failures retried later."""
+    gold = load_gold_answers(data_dir) if gold is None else gold
+    results = list(iter_results(path))
+    rows = pd.DataFrame([result_to_row(result) for result in results])
+    if rows.empty:
+        rows = pd.DataFrame(columns=["model", "qid", "user_message", "answer_text", "error"])
+    rows = rows.drop(replaced_failures(results, rows["error"].notna(), rows.index))
+    return score_frame(rows.reset_index(drop=True), gold)
+
+
+def accuracy_table(scored: pd.DataFrame, by=("model",)) -> pd.DataFrame:
+    """Accuracy, answer rate and counts per group of scored rows."""
+    by = [name for name in by if name in scored.columns]
+    grouped = scored.groupby(by, dropna=False) if by else scored.groupby(lambda _: "all")
+    return grouped.agg(
+        num_results=("correct", "size"),
+        num_graded=("correct", "count"),
+        answered=("answered", "mean"),
+        accuracy=("correct", "mean"),
+    )
+
+
+class IncrementalScorer:
+    """Scores results as they are appended to a results file or normalized store.
+
+    Each call to `update` reads the complete lines written since the last call, scores them and adds
+    them to `scored`, dropping failures that a new result retried successfully (see
+    `replaced_failures`). Only uncompressed files can be read as they grow."""
+
+    def __init__(self, path: str, gold: pd.DataFrame = None, data_dir: str = "data"):
+        self.path = path
+        self.gold = load_gold_answers(data_dir) if gold is None else gold
+        self.file = None
+        self.contents = None
+        self.partial_line = ""
+        self.scored = pd.DataFrame()
+        self.num_results = 0  # read so far, which labels the rows of `scored`
+        self.pending_failures = {}  # failed results not yet retried, by request key
+
+    def open(self) -> bool:
+        normalized = is_normalized_store(self.path)
+        results_filepath = store_filepath(self.path, results_filename) if normalized else self.path
+        if not os.path.exists(results_filepath):
+            return False  # nothing written yet
+        self.file = open_text(results_filepath)
+        if normalized:
+            self.contents = ContentsIndex(store_filepath(self.path, contents_filename))
+        return True
+
+    def update(self) -> pd.DataFrame:
+        """Score the results written since the last call. Returns just those rows."""
+        if self.file is None and not self.open():
+            return pd.DataFrame()
+        results = []
+        for line in self.file:
+            self.partial_line += line
+            if not self.partial_line.endswith("\n"):
+                break  # the rest of it hasn't been written yet
+            data = json.loads(self.partial_line)
+            self.partial_line = ""
+            results.append(
+                denormalize_result(data, self.contents) if self.contents is not None else data
+            )
+        if not results:
+            return pd.DataFrame()
+        new_rows = score_frame(pd.DataFrame([result_to_row(result) for result in results]), self.gold)
+        new_rows.index = pd.RangeIndex(self.num_results, self.num_results + len(new_rows))
+        self.num_results += len(new_rows)
+        replaced = replaced_failures(
+            results, new_rows["error"].notna(), new_rows.index, self.pending_failures
+        )
+        new_rows = new_rows.drop([label for label in replaced if label in new_rows.index])
+        self.scored = pd.concat(
+            [self.scored.drop([label for label in replaced if label in self.scored.index]), new_rows]
+        )
+        return new_rows
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        if self.contents is not None:
+            self.contents.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score results against the gold answers.")
+    parser.add_argument("results_path", nargs="?", default=os.getenv("RESULTS_FILE_PATH"))
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--by", nargs="*", default=["model"])
+    parser.add_argument("--output", help="also save the scored rows, e.g. to scored.parquet")
+    args = parser.parse_args()
+
+    scored = score_results(args.results_path, data_dir=args.data_dir)
+    print(accuracy_table(scored, by=args.by).to_string())
+    if args.output:
+        if args.output.endswith(".parquet"):
+            scored.to_parquet(args.output)
+        else:
+            scored.to_csv(args.output, index=False)
@@ -0,0 +1,178 @@
+# telemetry.py
+import asyncio  # for writing snapshots periodically
+import bisect  # for finding a value's histogram bucket
+import dataclasses  # for reading the StatusTracker's counters
+import json  # for writing snapshots
+import logging  # for logging exporter failures
+import math  # for spacing bucket bounds
+import time  # for timestamping snapshots
+from aiohttp import web  # for serving Prometheus metrics
+
+
+def log_spaced_buckets(smallest: float, largest: float, per_decade: int = 4) -> list:
+    """Upper bounds from `smallest` to at least `largest`, `per_decade` of them per power of ten."""
+    num_buckets = math.ceil(per_decade * math.log10(largest / smallest)) + 1
+    return [smallest * 10 ** (i / per_decade) for i in range(num_buckets)]
+
+
+seconds_buckets = log_spaced_buckets(0.001, 600)  # 1ms to 10 minutes
+tokens_buckets = log_spaced_buckets(1, 1_000_000)
+attempts_buckets = [1, 2, 3, 4, 5, 6, 8, 10, 15, 20]
+# StatusTracker fields that can go down or jump, rather than only count up
+gauges = (
+    "num_tasks_in_progress",
+    "time_of_last_rate_limit_error",
+    "num_completion_tokens_refunded",  # net of completions longer than their reservation
+)
+
+
+class Histogram:
+    """Counts observations in fixed buckets, so recording one is a bisect and an increment.
+
+    Quantiles are estimated as the upper bound of the bucket they fall in, capped at the largest
+    value seen."""
+
+    def __init__(self, buckets: list = seconds_buckets):
+        self.buckets = buckets  # upper bounds, ascending
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket holds values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> None:
+        """Add another histogram's observations, e.g. from another process. The buckets must match."""
+        if other.buckets != self.buckets:
+            raise ValueError("Expecting histograms with the same buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q: float):
+        """Estimate the `q` quantile, or None if nothing has been observed."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+def metrics_snapshot(status_tracker) -> dict:
+    """The StatusTracker's counters and histogram summaries as a JSON-serializable dict."""
+    snapshot = {"time": time.time()}
+    for f in dataclasses.fields(status_tracker):
+        value = getattr(status_tracker, f.name)
+        snapshot[f.name] = value.snapshot() if isinstance(value, Histogram) else value
+    return snapshot
+
+
+def prometheus_text(status_tracker, prefix: str = "api_request_processor") -> str:
+    """The StatusTracker in the Prometheus text exposition format."""
+    lines = []
+    for f in dataclasses.fields(status_tracker):
+        name = f"{prefix}_{f.name}"
+        value = getattr(status_tracker, f.name)
+        if isinstance(value, Histogram):
+            lines.append(f"# TYPE {name} histogram")
+            cumulative_count = 0
+            for upper_bound, count in zip(value.buckets, value.counts):
+                cumulative_count += count
+                lines.append(f'{name}_bucket{{le="{upper_bound:.6g}"}} {cumulative_count}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {value.count}')
+            lines.append(f"{name}_sum {value.sum}")
+            lines.append(f"{name}_count {value.count}")
+        elif isinstance(value, (int, float)):
+            metric_type = "gauge" if f.name in gauges else "counter"
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Publishes a StatusTracker while a run is going.
+
+    With `snapshot_filepath`, a JSON snapshot is appended every `snapshot_seconds` and once at the end.
+    With `port`, Prometheus metrics are served at http://<host>:<port>/metrics. `host` defaults to this
+    machine only; use "0.0.0.0" to let others scrape them."""
+
+    def __init__(
+        self,
+        status_tracker,
+        snapshot_filepath: str = None,
+        snapshot_seconds: float = 10,
+        port: int = None,
+        host: str = "127.0.0.1",
+    ):
+        self.status_tracker = status_tracker
+        self.snapshot_filepath = snapshot_filepath
+        self.snapshot_seconds = snapshot_seconds
+        self.port = port
+        self.host = host
+        self.snapshot_task = None
+        self.runner = None
+
+    async def __aenter__(self):
+        if self.snapshot_filepath:
+            self.snapshot_task = asyncio.create_task(self.write_snapshots())
+        if self.port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.serve_metrics)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, host=self.host, port=self.port).start()
+            logging.info(f"Serving metrics at http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            await asyncio.gather(self.snapshot_task, return_exceptions=True)
+            await asyncio.to_thread(
+                self.append_snapshot, json.dumps(metrics_snapshot(self.status_tracker))
+            )
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def serve_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=prometheus_text(self.status_tracker),
+            content_type="text/plain",
+            headers={"Cache-Control": "no-store"},
+        )
+
+    async def write_snapshots(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_seconds)
+            # take the snapshot on the event loop so the counters are consistent, then write it off the loop
+            snapshot = json.dumps(metrics_snapshot(self.status_tracker))
+            try:
+                await asyncio.to_thread(self.append_snapshot, snapshot)
+            except OSError as e:
+                logging.warning(f"Failed to write metrics to {self.snapshot_filepath}: {e}")
+
+    def append_snapshot(self, snapshot: str) -> None:
+        with open(self.snapshot_filepath, "a") as f:
+            f.write(snapshot + "\n")
@@ -0,0 +1,291 @@
+# token_counts.py
+# Counts the tokens of every request in a requests file ahead of a run, in a process pool, and saves
+# them next to the file so the processor doesn't have to tokenize while dispatching, e.g.:
+#   python -m parallel_processing.token_counts requests_to_chat_completion.jsonl --prompt-price-per-1k 0.0015
+import argparse  # for reading estimate settings from the command line
+import array  # for storing counts compactly
+import concurrent.futures  # for counting tokens in several processes
+import itertools  # for reading compressed requests in chunks of lines
+import json  # for parsing requests and the sidecar header
+import logging  # for logging progress
+import os  # for checking whether the sidecar is stale
+from dataclasses import dataclass  # for holding the counts
+from parallel_processing.compression import compression_for, open_text
+
+sidecar_version = 1
+
+
+def sidecar_filepath_for(requests_filepath: str) -> str:
+    return requests_filepath + ".tokens"
+
+
+@dataclass
+class TokenCounts:
+    """Token counts for every line of a requests file, indexed by line number (the task ID).
+
+    `token_consumption` is what the rate limiter is charged: prompt tokens plus the full completion
+    reservation, which is `completion_token_reservation`."""
+
+    api_endpoint: str
+    token_encoding_name: str
+    requests_size: int  # of the requests file when counted, to notice when it has changed
+    requests_mtime_ns: int
+    offsets: array.array  # byte offset of each line
+    token_consumption: array.array
+    completion_token_reservation: array.array
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def is_current(self, requests_filepath: str, api_endpoint: str, token_encoding_name: str) -> bool:
+        """Whether these counts still describe the requests file, as counted for this endpoint and encoding."""
+        stat = os.stat(requests_filepath)
+        return (
+            self.api_endpoint == api_endpoint
+            and self.token_encoding_name == token_encoding_name
+            and self.requests_size == stat.st_size
+            and self.requests_mtime_ns == stat.st_mtime_ns
+        )
+
+    def save(self, sidecar_filepath: str) -> None:
+        """Write a JSON header line followed by the three arrays as raw bytes."""
+        header = {
+            "version": sidecar_version,
+            "api_endpoint": self.api_endpoint,
+            "token_encoding_name": self.token_encoding_name,
+            "requests_size": self.requests_size,
+            "requests_mtime_ns": self.requests_mtime_ns,
+            "num_requests": len(self),
+        }
+        temp_filepath = sidecar_filepath + ".tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for counts in (self.offsets, self.token_consumption, self.completion_token_reservation):
+                counts.tofile(f)
+        os.replace(temp_filepath, sidecar_filepath)  # never leave a half-written sidecar behind
+
+    @classmethod
+    def load(cls, sidecar_filepath: str):
+        """Read a sidecar written by `save`, or return None if it is unreadable or from another version."""
+        try:
+            with open(sidecar_filepath, "rb") as f:
+                header = json.loads(f.readline())
+                if header.get("version") != sidecar_version:
+                    return None
+                num_requests = header["num_requests"]
+                arrays = []
+                for typecode in ("Q", "I", "I"):
+                    counts = array.array(typecode)
+                    counts.fromfile(f, num_requests)
+                    arrays.append(counts)
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable token counts in {sidecar_filepath}: {e}")
+            return None
+        return cls(
+            api_endpoint=header["api_endpoint"],
+            token_encoding_name=header["token_encoding_name"],
+            requests_size=header["requests_size"],
+            requests_mtime_ns=header["requests_mtime_ns"],
+            offsets=arrays[0],
+            token_consumption=arrays[1],
+            completion_token_reservation=arrays[2],
+        )
+
+
+def line_offsets(requests_filepath: str) -> array.array:
+    """Byte offset of the start of every line."""
+    offsets = array.array("Q")
+    offset = 0
+    with open(requests_filepath, "rb") as f:
+        for line in f:
+            offsets.append(offset)
+            offset += len(line)
+    return offsets
+
+
+def count_tokens_in_lines(lines: list, api_endpoint: str, token_encoding_name: str) -> tuple:
+    """Count the tokens of the requests in a list of lines. Runs in a worker process."""
+    # imported here because the processor imports this module
+    from parallel_processing.api_request_parallel_processor import (
+        num_completion_tokens_reserved,
+        num_tokens_consumed_from_request,
+    )
+
+    token_consumption = array.array("I")
+    completion_token_reservation = array.array("I")
+    for line in lines:
+        request_json = json.loads(line)
+        request_json.pop("metadata", None)
+        token_consumption.append(
+            num_tokens_consumed_from_request(request_json, api_endpoint, token_encoding_name)
+        )
+        completion_token_reservation.append(
+            num_completion_tokens_reserved(request_json, api_endpoint)
+        )
+    return token_consumption, completion_token_reservation
+
+
+def count_tokens_in_chunk(
+    requests_filepath: str, start: int, end: int, api_endpoint: str, token_encoding_name: str
+) -> tuple:
+    """Count the tokens of the requests between two byte offsets. Runs in a worker process."""
+    with open(requests_filepath, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    return count_tokens_in_lines(lines, api_endpoint, token_encoding_name)
+
+
+def count_tokens_in_file(
+    requests_filepath: str,
+    api_endpoint: str,
+    token_encoding_name: str,
+    num_processes: int = None,
+    lines_per_chunk: int = 2000,
+) -> TokenCounts:
+    """Count the tokens of every request in a file, `lines_per_chunk` lines at a time in a process pool.
+
+    Workers read their own chunks of a plain file. A compressed file can't be read from an offset, so
+    its lines are decompressed here and sent to the workers, and its offsets are into the decompressed
+    text."""
+    stat = os.stat(requests_filepath)
+    token_consumption = array.array("I")
+    completion_token_reservation = array.array("I")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        if compression_for(requests_filepath) is None:
+            offsets = line_offsets(requests_filepath)
+            futures = [
+                executor.submit(
+                    count_tokens_in_chunk,
+                    requests_filepath,
+                    offsets[i],
+                    offsets[i + lines_per_chunk] if i + lines_per_chunk < len(offsets) else stat.st_size,
+                    api_endpoint,
+                    token_encoding_name,
+                )
+                for i in range(0, len(offsets), lines_per_chunk)
+            ]
+        else:
+            offsets = array.array("Q")
+            offset = 0
+            futures = []
+            with open_text(requests_filepath) as f:
+                while lines := list(itertools.islice(f, lines_per_chunk)):
+                    for line in lines:
+                        offsets.append(offset)
+                        offset += len(line.encode("utf-8"))
+                    futures.append(
+                        executor.submit(
+                            count_tokens_in_lines, lines, api_endpoint, token_encoding_name
+                        )
+                    )
+        # collect in file order so the counts line up with the offsets
+        for future in futures:
+            chunk_token_consumption, chunk_completion_token_reservation = future.result()
+            token_consumption.extend(chunk_token_consumption)
+            completion_token_reservation.extend(chunk_completion_token_reservation)
+    logging.info(f"Counted tokens for {len(offsets)} requests in {requests_filepath}")
+    return TokenCounts(
+        api_endpoint=api_endpoint,
+        token_encoding_name=token_encoding_name,
+        requests_size=stat.st_size,
+        requests_mtime_ns=stat.st_mtime_ns,
+        offsets=offsets,
+        token_consumption=token_consumption,
+        completion_token_reservation=completion_token_reservation,
+    )
+
+
+def load_or_count_tokens(
+    requests_filepath: str,
+    api_endpoint: str,
+    token_encoding_name: str,
+    count_if_missing: bool = True,
+    num_processes: int = None,
+):
+    """Return the token counts saved next to the requests file if they are current.
+
+    Otherwise count them and save them, or return None if `count_if_missing` is False."""
+    sidecar_filepath = sidecar_filepath_for(requests_filepath)
+    if os.path.exists(sidecar_filepath):
+        token_counts = TokenCounts.load(sidecar_filepath)
+        if token_counts is not None and token_counts.is_current(
+            requests_filepath, api_endpoint, token_encoding_name
+        ):
+            logging.debug(f"Using token counts from {sidecar_filepath}")
+            return token_counts
+        logging.info(f"Token counts in {sidecar_filepath} are out of date")
+    if not count_if_missing:
+        return None
+    token_counts = count_tokens_in_file(
+        requests_filepath, api_endpoint, token_encoding_name, num_processes=num_processes
+    )
+    token_counts.save(sidecar_filepath)
+    return token_counts
+
+
+def estimate_run(
+    token_counts: TokenCounts,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+    prompt_price_per_1k: float = 0.0,
+    completion_price_per_1k: float = 0.0,
+    completion_fraction: float = 1.0,
+) -> dict:
+    """Estimate the cost and duration of a run from its token counts.
+
+    `completion_fraction` is the expected share of each completion reservation actually used; 1.0 gives
+    an upper bound. The duration assumes the run keeps up with the rate limits without errors, and that
+    unused completion tokens are refunded as responses come back."""
+    num_requests = len(token_counts)
+    num_tokens_reserved = sum(token_counts.token_consumption)
+    num_completion_tokens_reserved = sum(token_counts.completion_token_reservation)
+    num_prompt_tokens = num_tokens_reserved - num_completion_tokens_reserved
+    num_completion_tokens = num_completion_tokens_reserved * completion_fraction
+    return {
+        "num_requests": num_requests,
+        "num_prompt_tokens": num_prompt_tokens,
+        "num_completion_tokens": num_completion_tokens,
+        "cost": (
+            num_prompt_tokens * prompt_price_per_1k
+            + num_completion_tokens * completion_price_per_1k
+        )
+        / 1000,
+        "minutes": max(
+            num_requests / max_requests_per_minute,
+            (num_prompt_tokens + num_completion_tokens) / max_tokens_per_minute,
+        ),
+    }
+
+
+if __name__ == "__main__":
+    from parallel_processing import api_request_parallel_processor as processor
+
+    parser = argparse.ArgumentParser(
+        description="Count the tokens in a requests file and estimate the run's cost and duration."
+    )
+    parser.add_argument("requests_filepath", nargs="?", default=processor.requests_filepath)
+    parser.add_argument("--request-url", default=processor.request_url)
+    parser.add_argument("--token-encoding-name", default=processor.token_encoding_name)
+    parser.add_argument("--max-requests-per-minute", type=float, default=processor.max_requests_per_minute)
+    parser.add_argument("--max-tokens-per-minute", type=float, default=processor.max_tokens_per_minute)
+    parser.add_argument("--prompt-price-per-1k", type=float, default=0.0)
+    parser.add_argument("--completion-price-per-1k", type=float, default=0.0)
+    parser.add_argument("--completion-fraction", type=float, default=1.0)
+    parser.add_argument("--num-processes", type=int, default=None)
+    args = parser.parse_args()
+
+    token_counts = load_or_count_tokens(
+        args.requests_filepath,
+        processor.api_endpoint_from_url(args.request_url),
+        args.token_encoding_name,
+        num_processes=args.num_processes,
+    )
+    estimate = estimate_run(
+        token_counts,
+        args.max_requests_per_minute,
+        args.max_tokens_per_minute,
+        prompt_price_per_1k=args.prompt_price_per_1k,
+        completion_price_per_1k=args.completion_price_per_1k,
+        completion_fraction=args.completion_fraction,
+    )
+    print(json.dumps(estimate, indent=2))
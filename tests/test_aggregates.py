@@ -0,0 +1,34 @@
+# test_aggregates.py
+import pandas as pd  # for the gold answers
+from parallel_processing.aggregates import ResultsAggregates, overall, read_aggregates
+
+gold = pd.DataFrame({"correct_answer": ["B"], "specialty": ["cardiology"]}, index=pd.Index([1], name="qid"))
+
+
+def result(content, usage=None):
+    response = {"choices": [{"message": {"content": content}}]}
+    if usage is not None:
+        response["usage"] = usage
+    request = {"model": "m", "messages": [{"content": "system"}, {"content": "question"}]}
+    return [request, response, {"qid": 1}]
+
+
+def test_results_without_usage_or_that_cant_be_read_dont_stop_the_rest(tmp_path):
+    filename = str(tmp_path / "aggregates.sqlite")
+    with ResultsAggregates(filename, gold=gold) as aggregates:
+        aggregates(
+            [
+                (
+                    result("The answer is B", {"prompt_tokens": 10, "completion_tokens": 4}),
+                    {"latency_seconds": 1.0},
+                ),
+                (result("The answer is C"), {"latency_seconds": 3.0}),  # no usage
+                ("not a result", None),
+            ]
+        )
+        aggregate = aggregates.aggregates[("m", *overall)]
+    assert aggregate.num_results == 2
+    assert aggregate.num_correct == 1
+    assert aggregate.prompt_tokens.count == 1 and aggregate.prompt_tokens.total == 10
+    assert aggregate.latency_seconds.mean == 2.0
+    assert read_aggregates(filename, dimension="specialty")["num_results"].tolist() == [2]
@@ -0,0 +1,176 @@
+# test_api_request_parallel_processor.py
+# Runs the processor against the mock server in this process, e.g.:
+#   python -m pytest tests
+import asyncio  # for running the processor
+import json  # for writing requests and reading results
+import time  # for timing the run
+import pytest  # for parametrizing and temporary files
+import tiktoken  # for replacing the encoding, which would be downloaded
+from aiohttp import web  # for serving the mock server
+from parallel_processing import mock_server
+from parallel_processing.api_request_parallel_processor import (
+    Endpoint,
+    EndpointPool,
+    StatusTracker,
+    process_api_requests_from_file,
+)
+from parallel_processing.results_writer import ResultsWriter
+
+
+class WordEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+async def run_against_mock_server(requests_filepath, save_filepath, app=None, **kwargs):
+    runner = web.AppRunner(app or mock_server.make_app(seconds_of_latency=0.01))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        await process_api_requests_from_file(
+            requests_filepath=str(requests_filepath),
+            save_filepath=str(save_filepath),
+            request_url=f"http://127.0.0.1:{port}/v1/chat/completions",
+            api_key="test",
+            max_requests_per_minute=6000,
+            max_tokens_per_minute=10**7,
+            token_encoding_name="cl100k_base",
+            max_attempts=3,
+            logging_level=30,
+            **kwargs,
+        )
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.parametrize("max_requests_in_flight", [1, 2, 10])
+def test_every_request_is_written_when_requests_outnumber_max_in_flight(
+    tmp_path, monkeypatch, max_requests_in_flight
+):
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: WordEncoding())
+    requests_filepath = tmp_path / "requests.jsonl"
+    save_filepath = tmp_path / "results.jsonl"
+    with open(requests_filepath, "w") as f:
+        for qid in range(50):
+            request = {
+                "model": "gpt-test",
+                "messages": [{"role": "user", "content": f"Question {qid}? A) a B) b"}],
+                "max_tokens": 10,
+                "metadata": {"qid": qid},
+            }
+            f.write(json.dumps(request) + "\n")
+
+    asyncio.run(
+        run_against_mock_server(
+            requests_filepath, save_filepath, max_requests_in_flight=max_requests_in_flight
+        )
+    )
+
+    with open(save_filepath) as f:
+        qids = sorted(json.loads(line)[-1]["qid"] for line in f)
+    assert qids == list(range(50))
+
+
+def test_a_failed_write_stops_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: WordEncoding())
+
+    def write_batch(self, batch):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(ResultsWriter, "write_batch", write_batch)
+    requests_filepath = tmp_path / "requests.jsonl"
+    with open(requests_filepath, "w") as f:
+        for _ in range(500):
+            request = {"model": "gpt-test", "messages": [{"role": "user", "content": "?"}], "max_tokens": 10}
+            f.write(json.dumps(request) + "\n")
+    status_tracker = StatusTracker()
+
+    with pytest.raises(OSError, match="No space left on device"):
+        asyncio.run(
+            run_against_mock_server(
+                requests_filepath,
+                tmp_path / "results.jsonl",
+                max_requests_in_flight=5,
+                results_flush_lines=1,
+                status_tracker=status_tracker,
+            )
+        )
+    assert status_tracker.num_tasks_started < 500
+
+
+def test_one_models_rate_limit_headers_leave_other_models_budgets_alone():
+    endpoint = Endpoint(
+        request_url="http://127.0.0.1/v1/chat/completions",
+        api_key="test",
+        max_requests_per_minute=1000,
+        max_tokens_per_minute=100000,
+    )
+    endpoint.rate_limiter_for("small").update_from_headers(
+        {"x-ratelimit-limit-requests": "10", "x-ratelimit-remaining-requests": "0"}
+    )
+    assert endpoint.rate_limiter_for("small").request_bucket.capacity == 10
+    assert endpoint.rate_limiter_for("large").request_bucket.capacity == 1000
+    assert endpoint.rate_limiter_for("large").try_acquire(100)
+    assert not endpoint.rate_limiter_for("small").try_acquire(100)
+
+
+def make_endpoint(name):
+    return Endpoint(
+        request_url=f"http://{name}/v1/chat/completions",
+        api_key="test",
+        max_requests_per_minute=1000,
+        max_tokens_per_minute=100000,
+    )
+
+
+def test_a_failing_endpoint_is_taken_out_of_rotation_only_if_another_can_take_its_requests():
+    failing, healthy = make_endpoint("failing"), make_endpoint("healthy")
+    endpoint_pool = EndpointPool([failing, healthy])
+    for _ in range(3):
+        endpoint_pool.record_failure(failing)
+    assert failing.time_back_in_rotation > time.monotonic()
+    for _ in range(3):
+        endpoint_pool.record_failure(healthy)
+    assert healthy.time_back_in_rotation == 0
+    assert endpoint_pool.try_acquire(10) is healthy
+
+
+def test_a_lone_endpoint_stays_in_rotation_after_three_server_errors_in_a_row(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: WordEncoding())
+    num_server_errors = 0
+
+    @web.middleware
+    async def fail_first_three(request, handler):
+        nonlocal num_server_errors
+        if num_server_errors < 3:
+            num_server_errors += 1
+            return web.json_response({"error": {"message": "The server had an error"}}, status=500)
+        return await handler(request)
+
+    app = mock_server.make_app(seconds_of_latency=0.01)
+    app.middlewares.append(fail_first_three)
+    requests_filepath = tmp_path / "requests.jsonl"
+    save_filepath = tmp_path / "results.jsonl"
+    with open(requests_filepath, "w") as f:
+        for qid in range(3):
+            request = {
+                "model": "gpt-test",
+                "messages": [{"role": "user", "content": "?"}],
+                "max_tokens": 10,
+                "metadata": {"qid": qid},
+            }
+            f.write(json.dumps(request) + "\n")
+
+    start_time = time.monotonic()
+    asyncio.run(
+        run_against_mock_server(requests_filepath, save_filepath, app=app, max_requests_in_flight=1)
+    )
+
+    # the first request fails all three attempts; the rest go out after it without waiting
+    # the 30 seconds an endpoint spends out of rotation
+    assert time.monotonic() - start_time < 20
+    with open(save_filepath) as f:
+        results = [json.loads(line) for line in f]
+    assert sum("choices" in result[1] for result in results) == 2
@@ -0,0 +1,33 @@
+# test_bias_analysis.py
+import pandas as pd  # for building scored results
+from parallel_processing.bias_analysis import bias_table, split_baseline
+
+
+def scored_results(baselines: dict, variants: dict) -> pd.DataFrame:
+    """Scored rows for one model from {qid: [correct, ...]} without and with race filled in."""
+    rows = [
+        {"model": "m", "qid": qid, "demographic_race": "", "correct": correct}
+        for qid, answers in baselines.items()
+        for correct in answers
+    ]
+    rows += [
+        {"model": "m", "qid": qid, "demographic_race": "Black", "correct": correct}
+        for qid, answers in variants.items()
+        for correct in answers
+    ]
+    return pd.DataFrame(rows)
+
+
+def test_baseline_accuracy_is_the_mean_of_repeated_baselines():
+    baseline, _ = split_baseline(scored_results({1: [True, True, False], 2: [False]}, {}))
+    assert baseline.to_dict() == {("m", 1): 2 / 3, ("m", 2): 0.0}
+
+
+def test_variants_of_a_few_questions_are_not_independent_evidence():
+    # 90 variants all doing worse, but only 3 questions: sign flips of 3 questions can't be significant
+    scored = scored_results({1: [True], 2: [True], 3: [True]}, {qid: [False] * 30 for qid in (1, 2, 3)})
+    table = bias_table(scored, slots=["race"], num_resamples=2000, seed=0, num_processes=1)
+    row = table.loc[("m", "race", "Black")]
+    assert row["num_pairs"] == 90 and row["num_baseline_only"] == 90
+    assert row["difference"] == -1.0
+    assert row["p_value"] > 0.2
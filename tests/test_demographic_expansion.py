@@ -0,0 +1,27 @@
+# test_demographic_expansion.py
+import pandas as pd  # for the vignettes
+from parallel_processing.demographic_expansion import count_variants, expand_vignettes, max_variants
+
+df = pd.DataFrame(
+    {
+        "qid": [1, 2],
+        "full_qa_w_placeholders": ["A {dem-char-1} {dem-char-2} boy", "A {dem-char-1} girl, {dem-char-2}"],
+    }
+)
+slot_values = {1: ["", "Black"], 2: ["Black", ""]}
+
+
+def test_combinations_that_fill_the_same_text_are_yielded_once():
+    texts = [(metadata["qid"], vignette) for vignette, metadata in expand_vignettes(df, slot_values)]
+    assert len(texts) == len(set(texts))
+    # ("", "Black") and ("Black", "") give "A Black boy" but different girls
+    assert [vignette for qid, vignette in texts if qid == 1] == ["A Black boy", "A boy", "A Black Black boy"]
+    assert len([vignette for qid, vignette in texts if qid == 2]) == 4
+
+
+def test_count_variants_matches_expand_vignettes():
+    assert count_variants(df, slot_values) == len(list(expand_vignettes(df, slot_values))) == 7
+    assert max_variants(df, slot_values) == 8
+    assert count_variants(df, slot_values, sample_size=2, seed=0) == len(
+        list(expand_vignettes(df, slot_values, sample_size=2, seed=0))
+    )
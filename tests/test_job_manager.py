@@ -0,0 +1,15 @@
+# test_job_manager.py
+from parallel_processing.job_manager import JobStore, iter_job_data
+
+
+def test_job_data_is_kept_in_a_file_and_polling_leaves_it_out(tmp_path):
+    data = [("Question 1?", {"qid": 1}), ("Question 2?", {"qid": 2})]
+    with JobStore(str(tmp_path / "jobs.sqlite")) as store:
+        job_id = store.submit(data, "Answer:", model_name="m1,m2", dirname=str(tmp_path / "jobs"))
+        job = store.get(job_id)
+        assert "params" not in job and job["status"] == "queued" and job["num_requests"] == 4
+        assert store.has_unfinished_jobs()
+        params = store.get_params(job_id)
+        assert "data" not in params
+        assert list(iter_job_data(params["data_filepath"])) == data
+        assert store.cancel(job_id) and not store.has_unfinished_jobs()
@@ -0,0 +1,18 @@
+# test_response_cache.py
+from parallel_processing.response_cache import ResponseCache
+
+request_json = {"messages": [{"role": "user", "content": "Question? A) a B) b"}], "temperature": 0}
+
+
+def test_responses_from_different_deployments_are_cached_apart(tmp_path):
+    deployment_urls = [
+        f"https://example.openai.azure.com/openai/deployments/{deployment}/chat/completions"
+        for deployment in ("gpt-35-turbo", "gpt-4")
+    ]
+    response_cache = ResponseCache(str(tmp_path / "response_cache.sqlite"))
+    response_cache.put(response_cache.key(request_json, deployment_urls[0]), {"model": "gpt-35-turbo"})
+
+    assert response_cache.get(response_cache.key(request_json, deployment_urls[0])) == {
+        "model": "gpt-35-turbo"
+    }
+    assert response_cache.get(response_cache.key(request_json, deployment_urls[1])) is None
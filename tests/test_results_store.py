@@ -0,0 +1,45 @@
+# test_results_store.py
+import asyncio  # for running the writer
+from parallel_processing.results_store import NormalizedResultsWriter, iter_results
+
+response = {"choices": [{"message": {"content": "The answer is B"}}]}
+
+
+def write_and_read_back(tmp_path, results):
+    async def write():
+        async with NormalizedResultsWriter(str(tmp_path / "store")) as results_writer:
+            for data in results:
+                results_writer.write(data)
+
+    asyncio.run(write())
+    return list(iter_results(str(tmp_path / "store")))
+
+
+def test_none_and_empty_content_read_back_as_written(tmp_path):
+    results = [
+        [
+            {
+                "model": "m",
+                "messages": [
+                    {"role": "system", "content": "You are a doctor. " * 5},
+                    {"role": "user", "content": ""},
+                    {"role": "assistant", "content": None},
+                ],
+            },
+            response,
+            {"qid": 1},
+        ]
+    ]
+    assert write_and_read_back(tmp_path, results) == results
+
+
+def test_multi_part_content_reads_back_as_written(tmp_path):
+    content = [
+        {"type": "text", "text": "Which finding does this image show? " * 3},
+        {"type": "image_url", "image_url": {"url": "https://example.com/x-ray.png"}},
+    ]
+    results = [
+        [{"model": "m", "messages": [{"role": "user", "content": content}]}, response, {"qid": qid}]
+        for qid in range(2)
+    ]
+    assert write_and_read_back(tmp_path, results) == results
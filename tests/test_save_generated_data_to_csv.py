@@ -0,0 +1,50 @@
+# test_save_generated_data_to_csv.py
+import csv  # for reading back the CSV
+import json  # for writing results
+import pyarrow.parquet  # for reading back what was written
+from parallel_processing.save_generated_data_to_csv import save_generated_data
+
+
+def write_results(path):
+    """A results file whose first result is the baseline, without demographics."""
+    demographics = [None, {"race": "Black", "ses": ""}, {"race": "", "ses": "low-income"}]
+    with open(path, "w") as f:
+        for i, slots in enumerate(demographics):
+            request = {"model": "m", "messages": [{"content": "system"}, {"content": f"Question {i}"}]}
+            response = {
+                "choices": [{"message": {"content": "The answer is B"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+            }
+            metadata = {"qid": 1} if slots is None else {"qid": 1, "demographics": slots}
+            f.write(json.dumps([request, response, metadata]) + "\n")
+
+
+def test_demographic_columns_are_kept_when_the_first_row_is_the_baseline(tmp_path):
+    write_results(tmp_path / "results.jsonl")
+    save_generated_data(str(tmp_path / "results.jsonl"), str(tmp_path / "output.parquet"))
+    table = pyarrow.parquet.read_table(tmp_path / "output.parquet").to_pydict()
+    assert table["demographic_race"] == [None, "Black", ""]
+    assert table["demographic_ses"] == [None, "", "low-income"]
+
+
+def test_demographic_slots_are_kept_when_the_first_chunk_is_all_baselines(tmp_path):
+    write_results(tmp_path / "results.jsonl")
+    save_generated_data(
+        str(tmp_path / "results.jsonl"),
+        str(tmp_path / "output.arrow"),
+        chunk_rows=1,
+        demographic_slots=["race", "ses"],
+    )
+    with pyarrow.ipc.open_file(tmp_path / "output.arrow") as reader:
+        table = reader.read_all().to_pydict()
+    assert table["demographic_race"] == [None, "Black", ""]
+    assert table["demographic_ses"] == [None, "", "low-income"]
+
+
+def test_the_csv_prompt_starts_with_the_system_message(tmp_path):
+    write_results(tmp_path / "results.jsonl")
+    save_generated_data(str(tmp_path / "results.jsonl"), str(tmp_path / "output.csv"))
+    with open(tmp_path / "output.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]["Input Prompt"] == "System message: system\n\nQuestion 0"
+    assert rows[0]["Output Answer"] == "The answer is B"
@@ -0,0 +1,65 @@
+# test_scoring.py
+import json  # for writing results
+import pandas as pd  # for scoring a column of responses
+import pytest  # for parametrizing
+from parallel_processing.save_generated_data_to_csv import extract_answer
+from parallel_processing.scoring import IncrementalScorer, extract_answers, score_results
+
+responses = [
+    ("A 77-year-old man presents with chest pain. The correct answer is D", "D"),
+    ("The answer is a bit tricky here, but weighing the options I choose D", "D"),
+    ("Answer choice D is correct", "D"),
+    ("The answer is C. Option D is incorrect", "C"),
+    ("Answer: B\n\nExplanation: We do not select A because it ignores the history.", "B"),
+    ("Option B fits the history, but the answer is C.", "C"),
+    ("**Answer: (E)**", "E"),
+    ("Reasoning first.\n**B)** Capsule endoscopy", "B"),
+    ("(F)", "F"),
+    ("A patient like this needs more tests.", None),
+]
+
+
+@pytest.mark.parametrize("text, letter", responses)
+def test_extract_answer(text, letter):
+    assert extract_answer(text) == letter
+
+
+def test_extract_answers_matches_extract_answer():
+    texts = pd.Series([text for text, _ in responses] + ["G"])
+    assert extract_answers(texts).tolist() == [letter for _, letter in responses] + ["G"]
+
+
+def write_results(path, results):
+    with open(path, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+gold = pd.DataFrame({"correct_answer": ["B"], "specialty": ["cardiology"]}, index=pd.Index([1], name="qid"))
+request = {"model": "m", "messages": [{"content": "system"}, {"content": "question"}]}
+failure = [request, [{"error": "Cannot connect to host"}], {"qid": 1}]
+success = [request, {"choices": [{"message": {"content": "The answer is B"}}]}, {"qid": 1}]
+
+
+def test_failures_are_not_graded_and_are_replaced_by_a_later_success(tmp_path):
+    write_results(tmp_path / "results.jsonl", [failure, success])
+    scored = score_results(str(tmp_path / "results.jsonl"), gold=gold)
+    assert scored["correct"].tolist() == [True]
+
+    write_results(tmp_path / "failed.jsonl", [success, failure])  # failed again after succeeding
+    scored = score_results(str(tmp_path / "failed.jsonl"), gold=gold)
+    assert scored["error"].notna().tolist() == [False, True]
+    assert scored["correct"].isna().tolist() == [False, True]
+
+
+def test_incremental_scorer_drops_failures_retried_in_a_later_update(tmp_path):
+    path = tmp_path / "results.jsonl"
+    write_results(path, [failure])
+    scorer = IncrementalScorer(str(path), gold=gold)
+    scorer.update()
+    assert scorer.scored["correct"].isna().tolist() == [True]
+    with open(path, "a") as f:
+        f.write(json.dumps(success) + "\n")
+    scorer.update()
+    scorer.close()
+    assert scorer.scored["correct"].tolist() == [True]
@@ -0,0 +1,25 @@
+# test_telemetry.py
+import asyncio  # for running the exporter
+import socket  # for finding a free port
+from parallel_processing.api_request_parallel_processor import StatusTracker
+from parallel_processing.telemetry import MetricsExporter, prometheus_text
+
+
+def test_metrics_that_can_go_down_are_gauges():
+    text = prometheus_text(StatusTracker(), prefix="p")
+    assert "# TYPE p_num_tasks_in_progress gauge" in text
+    assert "# TYPE p_time_of_last_rate_limit_error gauge" in text
+    assert "# TYPE p_num_completion_tokens_refunded gauge" in text
+    assert "# TYPE p_num_tasks_succeeded counter" in text
+
+
+def test_metrics_are_served_on_localhost_only_by_default():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def serve():
+        async with MetricsExporter(StatusTracker(), port=port) as exporter:
+            return exporter.runner.addresses
+
+    assert asyncio.run(serve()) == [("127.0.0.1", port)]